@@ -0,0 +1,135 @@
+"""
+Shared fixtures of the benchmark suite
+
+Every benchmark runs on a sparse image file in a temporary directory. Besides the
+wall time measured by pytest-benchmark, the peak memory allocated by each round,
+as traced by tracemalloc, and the bytes written by each round are stored with the
+results, so that saved runs can be compared between versions:
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare
+
+"""
+import tracemalloc
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import pytest
+
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+KIB = 1024
+MIB = 1024 * KIB
+GIB = 1024 * MIB
+
+IMAGE_SIZES = [16 * MIB, 256 * MIB, 4 * GIB, 64 * GIB]
+# rounds of each benchmark, the images are rebuilt before every round
+ROUNDS = 3
+
+
+def pytest_addoption(parser: Any) -> None:
+    parser.addoption(
+        "--data-limit",
+        type=int,
+        default=256 * MIB,
+        help="skip benchmarks that copy more partition data than this many bytes",
+    )
+
+
+def _size_id(size: int) -> str:
+    if size >= GIB:
+        return f"{size // GIB}G"
+    return f"{size // MIB}M"
+
+
+@pytest.fixture(params=IMAGE_SIZES, ids=_size_id)
+def image_size(request: Any) -> int:
+    return int(request.param)
+
+
+@pytest.fixture
+def data_limit(request: Any) -> Callable[[int], None]:
+    """Skip the benchmark if it copies more than the data limit"""
+
+    def check(size: int) -> None:
+        limit = request.config.getoption("--data-limit")
+        if size > limit:
+            pytest.skip(f"copies {_size_id(size)} of data, over --data-limit {limit}")
+
+    return check
+
+
+def partition_size(image_size: int) -> int:
+    return image_size // 4
+
+
+def build_image(path: Any, image_size: int, partitions: int = 3) -> Disk:
+    """Create a sparse image with partitions of a quarter of its size"""
+
+    if path.exists():
+        path.unlink()
+    disk = Disk(path)
+    disk.create(image_size)
+    for i in range(partitions):
+        disk.table.partitions.add(
+            Partition(
+                f"partition{i}",
+                partition_size(image_size),
+                PartitionType.LINUX_FILE_SYSTEM.value,
+            )
+        )
+    disk.commit()
+    return disk
+
+
+def _bytes_written() -> Optional[int]:
+    """Bytes passed to write system calls by the process, where the OS reports it"""
+
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(counters["wchar"])
+
+
+@pytest.fixture
+def measure(benchmark: Any) -> Callable[..., Any]:
+    """Benchmark a function, storing the peak memory and bytes written per round
+
+    The setup function runs before every round, outside of the timing, and
+    returns the arguments of the benchmarked function.
+    """
+
+    def run(
+        target: Callable[..., Any], setup: Callable[[], Tuple[Any, ...]]
+    ) -> Any:
+        written = []
+        peaks = []
+
+        def counted(*args: Any) -> Any:
+            # the peak is reset per round, so earlier rounds and benchmarks and
+            # the setup do not count
+            tracemalloc.reset_peak()
+            before = _bytes_written()
+            result = target(*args)
+            after = _bytes_written()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            if before is not None and after is not None:
+                written.append(after - before)
+            return result
+
+        tracemalloc.start()
+        try:
+            result = benchmark.pedantic(
+                counted, setup=lambda: (setup(), {}), rounds=ROUNDS, iterations=1
+            )
+        finally:
+            tracemalloc.stop()
+        info: Dict[str, Any] = benchmark.extra_info
+        info["peak_memory"] = max(peaks)
+        if written:
+            info["bytes_written"] = max(written)
+        return result
+
+    return run
@@ -0,0 +1,63 @@
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+from .conftest import MIB, build_image, partition_size
+
+
+def test_create(measure, tmp_path, image_size):
+    path = tmp_path / "bench.img"
+
+    def setup():
+        if path.exists():
+            path.unlink()
+        return (path,)
+
+    measure(lambda p: Disk(p).create(image_size), setup)
+
+
+def test_open(measure, tmp_path, image_size):
+    path = tmp_path / "bench.img"
+    build_image(path, image_size)
+    measure(Disk.open, lambda: (path,))
+
+
+def test_commit(measure, tmp_path, image_size):
+    """Commit of a metadata only change"""
+
+    path = tmp_path / "bench.img"
+    build_image(path, image_size)
+
+    def setup():
+        disk = Disk.open(path)
+        disk.table.partitions.entries[-1].partition_name = "renamed"
+        disk.table.partitions.add(
+            Partition("new", MIB, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+        return (disk,)
+
+    measure(lambda disk: disk.commit(), setup)
+
+
+def test_resize_relocation(measure, tmp_path, image_size, data_limit):
+    """Grow the first partition, moving the other two towards the end"""
+
+    data_limit(2 * partition_size(image_size))
+    path = tmp_path / "bench.img"
+
+    def setup():
+        disk = build_image(path, image_size)
+        disk.table.partitions.resize("partition0", partition_size(image_size) + MIB)
+        return (disk,)
+
+    measure(lambda disk: disk.commit(), setup)
+
+
+def test_resize_image(measure, tmp_path, image_size):
+    """Grow the image, rewriting only the GPT metadata"""
+
+    path = tmp_path / "bench.img"
+
+    def setup():
+        return (build_image(path, image_size),)
+
+    measure(lambda disk: disk.resize(2 * image_size), setup)
@@ -0,0 +1,38 @@
+from gpt_image.disk import Disk
+
+from .conftest import build_image, partition_size
+
+
+def test_remove_relocation(measure, tmp_path, image_size, data_limit):
+    """Remove the first partition, moving the other two towards the start"""
+
+    data_limit(2 * partition_size(image_size))
+    path = tmp_path / "bench.img"
+
+    def setup():
+        disk = build_image(path, image_size)
+        disk.table.partitions.remove("partition0")
+        return (disk,)
+
+    measure(lambda disk: disk.commit(), setup)
+
+
+def test_read(measure, tmp_path, image_size, data_limit):
+    size = partition_size(image_size)
+    data_limit(size)
+    path = tmp_path / "bench.img"
+    build_image(path, image_size)
+    disk = Disk.open(path)
+    partition = disk.table.partitions.find("partition1")
+    measure(lambda: partition.read(disk), lambda: ())
+
+
+def test_write_data(measure, tmp_path, image_size, data_limit):
+    size = partition_size(image_size)
+    data_limit(size)
+    path = tmp_path / "bench.img"
+    build_image(path, image_size)
+    disk = Disk.open(path)
+    partition = disk.table.partitions.find("partition1")
+    data = bytes(range(256)) * (size // 256)
+    measure(lambda: partition.write_data(disk, data), lambda: ())
@@ -1 +1,21 @@
-from . import disk, partition, table
+from . import (
+    backend,
+    bmap,
+    cache,
+    compress,
+    delta,
+    disk,
+    fat,
+    flash,
+    hashing,
+    instrument,
+    journal,
+    move,
+    partition,
+    scan,
+    sparse,
+    table,
+    transfer,
+    validate,
+    verify,
+)
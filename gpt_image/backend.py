@@ -0,0 +1,394 @@
+"""
+Storage backends that disk images are read from and written to
+
+A backend provides positional reads and writes, resizing, deallocation and syncing
+of the bytes of an image. Reads and writes may be made from several threads at once.
+Each backend reports the I/O size it performs best with, so that bulk copies can
+pick their chunk size.
+
+Backends:
+    FileBackend: regular image file, with positional reads and writes
+    MmapBackend: image file mapped into memory
+    MemoryBackend: image built in memory, written out to a file once
+    BlockDeviceBackend: raw block device opened with O_DIRECT
+
+"""
+import abc
+import contextlib
+import mmap
+import os
+import stat
+import threading
+from typing import Any, ContextManager, List, Optional, Tuple
+
+from gpt_image import extents
+
+# preferred I/O size of images held in memory
+MEMORY_IO_SIZE = 1024 * 1024
+
+
+class BackendError(Exception):
+    """Error reading, writing or resizing a storage backend"""
+
+
+class Backend(abc.ABC):
+    """Storage of a disk image
+
+    Attributes:
+        path: path of the image file or device, None if the image is only held in
+            memory. Commits to backends with a path are journaled next to it.
+        preferred_io_size: integer I/O size in bytes that the backend performs
+            best with
+    """
+
+    def __init__(self, path: Optional[str], preferred_io_size: int):
+        self.path = path
+        self.preferred_io_size = preferred_io_size
+
+    def __enter__(self) -> "Backend":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    @abc.abstractmethod
+    def size(self) -> int:
+        """Size of the image in bytes"""
+
+    @abc.abstractmethod
+    def pread(self, size: int, offset: int) -> bytes:
+        """Read bytes at an offset, fewer if the image ends first"""
+
+    @abc.abstractmethod
+    def pwrite(self, data: bytes, offset: int) -> int:
+        """Write bytes at an offset and return the count written"""
+
+    @abc.abstractmethod
+    def truncate(self, size: int) -> None:
+        """Resize the image, new bytes read as zeros"""
+
+    def data_extents(self, start: int, end: int) -> List[extents.Extent]:
+        """Find the extents of a byte range that may hold data
+
+        Backends that cannot detect holes report the whole range.
+
+        Args:
+            start: first byte of the range
+            end: byte after the last byte of the range
+        Returns:
+            sorted list of (start, end) byte extents
+        """
+
+        return [(start, end)] if start < end else []
+
+    def deallocate(self, start: int, end: int) -> bool:
+        """Zero a byte range without writing the zeros
+
+        Args:
+            start: first byte of the range
+            end: byte after the last byte of the range
+        Returns:
+            True if the range was zeroed, False if the backend does not support it
+        """
+
+        return False
+
+    def zero(self, start: int, end: int) -> None:
+        """Zero a byte range, writing zeros only if it cannot be deallocated
+
+        Args:
+            start: first byte of the range
+            end: byte after the last byte of the range
+        """
+
+        if start >= end or self.deallocate(start, end):
+            return
+        zeros = bytes(min(extents.ZERO_CHUNK_SIZE, end - start))
+        while start < end:
+            size = min(len(zeros), end - start)
+            start += self.pwrite(zeros if size == len(zeros) else zeros[:size], start)
+
+    def sync(self) -> None:
+        """Make the writes durable"""
+
+    def close(self) -> None:
+        """Release the backend"""
+
+
+class FileBackend(Backend):
+    """Image file read and written with positional I/O
+
+    Args:
+        path: path of the image file
+        writable: open the file for writing
+    """
+
+    def __init__(self, path: str, writable: bool = True):
+        self.fd = os.open(path, os.O_RDWR if writable else os.O_RDONLY)
+        super().__init__(str(path), os.fstat(self.fd).st_blksize or 4096)
+
+    def size(self) -> int:
+        return os.lseek(self.fd, 0, os.SEEK_END)
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return os.pread(self.fd, size, offset)
+
+    def pwrite(self, data: bytes, offset: int) -> int:
+        return os.pwrite(self.fd, data, offset)
+
+    def truncate(self, size: int) -> None:
+        os.ftruncate(self.fd, size)
+
+    def data_extents(self, start: int, end: int) -> List[extents.Extent]:
+        return extents.data_extents(self.fd, start, end)
+
+    def deallocate(self, start: int, end: int) -> bool:
+        return extents.deallocate(self.fd, start, end)
+
+    def sync(self) -> None:
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class MmapBackend(FileBackend):
+    """Image file mapped into memory
+
+    Reads and writes are memory copies; the image cannot be written past its end
+    without resizing it first.
+
+    Args:
+        path: path of the image file
+        writable: map the file for writing
+    """
+
+    def __init__(self, path: str, writable: bool = True):
+        super().__init__(path, writable)
+        self.preferred_io_size = max(self.preferred_io_size, mmap.PAGESIZE)
+        self._access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._map: Optional[mmap.mmap] = None
+        self._remap()
+
+    def _remap(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        # an empty file cannot be mapped
+        if super().size():
+            self._map = mmap.mmap(self.fd, 0, access=self._access)
+
+    def size(self) -> int:
+        return len(self._map) if self._map is not None else 0
+
+    def pread(self, size: int, offset: int) -> bytes:
+        if self._map is None:
+            return b""
+        return self._map[offset : offset + size]
+
+    def pwrite(self, data: bytes, offset: int) -> int:
+        end = offset + len(data)
+        if self._map is None or end > len(self._map):
+            raise BackendError(f"write past the end of the mapped image: {end}")
+        self._map[offset:end] = data
+        return len(data)
+
+    def truncate(self, size: int) -> None:
+        if self._map is not None:
+            self._map.flush()
+        super().truncate(size)
+        self._remap()
+
+    def sync(self) -> None:
+        if self._map is not None:
+            self._map.flush()
+        super().sync()
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        super().close()
+
+
+class MemoryBackend(Backend):
+    """Image held in memory
+
+    Commits to an image in memory are not journaled. The image is written to a
+    file in one pass with write_to.
+
+    Args:
+        data: initial image bytes
+    """
+
+    def __init__(self, data: bytes = b""):
+        super().__init__(None, MEMORY_IO_SIZE)
+        self.data = bytearray(data)
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        return len(self.data)
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return bytes(self.data[offset : offset + size])
+
+    def pwrite(self, data: bytes, offset: int) -> int:
+        end = offset + len(data)
+        with self._lock:
+            if end > len(self.data):
+                self.data.extend(bytes(end - len(self.data)))
+        self.data[offset:end] = data
+        return len(data)
+
+    def truncate(self, size: int) -> None:
+        with self._lock:
+            if size < len(self.data):
+                del self.data[size:]
+            else:
+                self.data.extend(bytes(size - len(self.data)))
+
+    def deallocate(self, start: int, end: int) -> bool:
+        end = min(end, len(self.data))
+        if start < end:
+            self.data[start:end] = bytes(end - start)
+        return True
+
+    def write_to(self, path: str) -> int:
+        """Write the image to a file
+
+        Blocks of zeros are skipped, so the file is sparse where the filesystem
+        supports it.
+
+        Args:
+            path: path of the image file, replaced if it exists
+        Returns:
+            integer count of bytes written
+        """
+
+        written = 0
+        view = memoryview(self.data)
+        zeros = bytes(self.preferred_io_size)
+        with open(path, "wb") as f:
+            for offset in range(0, len(view), self.preferred_io_size):
+                block = view[offset : offset + self.preferred_io_size]
+                if block != zeros[: len(block)]:
+                    f.seek(offset)
+                    written += f.write(block)
+            f.truncate(len(view))
+            os.fsync(f.fileno())
+        return written
+
+
+def _queue_limit(device: int, name: str) -> int:
+    """Read a request queue limit of a block device from sysfs, 0 if unknown"""
+
+    path = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}/queue/{name}"
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return 0
+
+
+class BlockDeviceBackend(Backend):
+    """Raw block device opened with O_DIRECT
+
+    Direct I/O bypasses the page cache and must be aligned to the logical block
+    size of the device. Aligned reads and writes go straight to the device;
+    unaligned ones are widened to whole blocks, writes by reading the blocks at
+    the edges first.
+
+    Attributes:
+        block_size: integer logical block size, the alignment of direct I/O
+
+    Args:
+        path: path of the block device
+        writable: open the device for writing
+    """
+
+    def __init__(self, path: str, writable: bool = True):
+        flags = os.O_RDWR if writable else os.O_RDONLY
+        self.fd = os.open(path, flags | getattr(os, "O_DIRECT", 0))
+        device = os.fstat(self.fd).st_rdev
+        self.block_size = _queue_limit(device, "logical_block_size") or 4096
+        preferred = _queue_limit(device, "optimal_io_size") or _queue_limit(
+            device, "minimum_io_size"
+        )
+        super().__init__(str(path), max(preferred, self.block_size))
+        # widened writes of partial blocks are made one at a time
+        self._lock = threading.Lock()
+
+    def _aligned(self, size: int, offset: int) -> mmap.mmap:
+        """Read whole blocks into a page aligned buffer"""
+
+        buffer = mmap.mmap(-1, size)
+        if os.preadv(self.fd, [buffer], offset) != size:
+            buffer.close()
+            raise BackendError(f"unexpected end of device at byte {offset}")
+        return buffer
+
+    def _span(self, size: int, offset: int) -> Tuple[int, int]:
+        start = offset - offset % self.block_size
+        end = -(-(offset + size) // self.block_size) * self.block_size
+        return start, end
+
+    def size(self) -> int:
+        return os.lseek(self.fd, 0, os.SEEK_END)
+
+    def pread(self, size: int, offset: int) -> bytes:
+        size = max(0, min(size, self.size() - offset))
+        if size == 0:
+            return b""
+        start, end = self._span(size, offset)
+        buffer = self._aligned(end - start, start)
+        try:
+            return buffer[offset - start : offset - start + size]
+        finally:
+            buffer.close()
+
+    def pwrite(self, data: bytes, offset: int) -> int:
+        start, end = self._span(len(data), offset)
+        if end > self.size():
+            raise BackendError(f"write past the end of the device: {offset + len(data)}")
+        aligned = start == offset and end == offset + len(data)
+        lock: ContextManager[Any] = contextlib.nullcontext() if aligned else self._lock
+        with lock:
+            if aligned:
+                buffer = mmap.mmap(-1, len(data))
+            else:
+                buffer = self._aligned(end - start, start)
+            try:
+                buffer[offset - start : offset - start + len(data)] = data
+                os.pwritev(self.fd, [buffer], start)
+            finally:
+                buffer.close()
+        return len(data)
+
+    def truncate(self, size: int) -> None:
+        if size != self.size():
+            raise BackendError(f"block devices cannot be resized: {self.path}")
+
+    def sync(self) -> None:
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def open_backend(path: str, writable: bool = True) -> Backend:
+    """Open the backend for an image path
+
+    Args:
+        path: path of an image file or block device
+        writable: open the image for writing
+    Returns:
+        BlockDeviceBackend for block devices, FileBackend otherwise
+    """
+
+    if stat.S_ISBLK(os.stat(path).st_mode):
+        return BlockDeviceBackend(path, writable)
+    return FileBackend(path, writable)
@@ -0,0 +1,200 @@
+"""
+Block map (bmap) files for flashing only the mapped blocks of an image
+
+The file format is the one used by bmaptool, version 2.0:
+https://github.com/yoctoproject/bmaptool/blob/main/docs/README
+
+"""
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import os
+import stat
+import xml.etree.ElementTree as ElementTree
+from typing import TYPE_CHECKING, ContextManager, List, Optional, Tuple
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.disk import Disk
+
+from gpt_image import backend, extents, hashing, transfer
+
+
+class BmapError(Exception):
+    """Error reading a bmap file or flashing with it"""
+
+
+BMAP_VERSION = "2.0"
+CHECKSUM_TYPE = "sha256"
+# placeholder for the file checksum while the file checksum is calculated
+_ZERO_CHECKSUM = "0" * 64
+
+
+def _format_range(first: int, last: int) -> str:
+    if first == last:
+        return str(first)
+    return f"{first}-{last}"
+
+
+def write_bmap(
+    disk: Disk, path: str, block_size: int = 4096, partitions_only: bool = False
+) -> int:
+    """Write a bmap file describing the mapped blocks of a disk image
+
+    The mapped blocks are the GPT metadata and every data extent of the image
+    file. Each mapped range is hashed in a single streaming pass.
+
+    Args:
+        disk: GPT Disk instance
+        path: path of the bmap file to create
+        block_size: bmap block size in bytes
+        partitions_only: only map data within the partitions and GPT metadata
+    Returns:
+        integer count of mapped blocks
+    """
+
+    mapped = extents.align(disk.mapped_extents(partitions_only), block_size, disk.size)
+    ranges: List[str] = []
+    mapped_blocks = 0
+    with disk.storage(writable=False) as image:
+        for start, end in mapped:
+            first = start // block_size
+            last = (end - 1) // block_size
+            mapped_blocks += last - first + 1
+            checksum = hashing.hash_range(image, start, end).hex()
+            ranges.append(
+                f'        <Range chksum="{checksum}"> {_format_range(first, last)} </Range>'
+            )
+    lines = [
+        '<?xml version="1.0" ?>',
+        f'<bmap version="{BMAP_VERSION}">',
+        f"    <ImageSize> {disk.size} </ImageSize>",
+        f"    <BlockSize> {block_size} </BlockSize>",
+        f"    <BlocksCount> {-(-disk.size // block_size)} </BlocksCount>",
+        f"    <MappedBlocksCount> {mapped_blocks} </MappedBlocksCount>",
+        f"    <ChecksumType> {CHECKSUM_TYPE} </ChecksumType>",
+        f"    <BmapFileChecksum> {_ZERO_CHECKSUM} </BmapFileChecksum>",
+        "    <BlockMap>",
+        *ranges,
+        "    </BlockMap>",
+        "</bmap>",
+        "",
+    ]
+    document = "\n".join(lines)
+    # the file checksum is calculated with the checksum field zeroed
+    checksum = hashlib.sha256(document.encode()).hexdigest()
+    document = document.replace(_ZERO_CHECKSUM, checksum, 1)
+    with open(path, "w") as f:
+        f.write(document)
+    return mapped_blocks
+
+
+def read_bmap(path: str) -> Tuple[int, List[Tuple[int, int, str]]]:
+    """Read and verify a bmap file
+
+    Args:
+        path: path of the bmap file
+    Returns:
+        tuple of the image size and a list of (start, end, sha256) byte ranges
+    Raises:
+        BmapError if the file is invalid or its checksum does not match
+    """
+
+    with open(path, "r") as f:
+        document = f.read()
+    try:
+        root = ElementTree.fromstring(document)
+    except ElementTree.ParseError as e:
+        raise BmapError(f"invalid bmap file: {e}") from e
+    if root.tag != "bmap" or not root.get("version", "").startswith("2."):
+        raise BmapError(f"unsupported bmap version: {root.get('version')}")
+
+    def field(name: str) -> str:
+        value = root.findtext(name)
+        if value is None:
+            raise BmapError(f"bmap file is missing {name}")
+        return value.strip()
+
+    if field("ChecksumType") != CHECKSUM_TYPE:
+        raise BmapError(f"unsupported checksum type: {field('ChecksumType')}")
+    file_checksum = field("BmapFileChecksum")
+    zeroed = document.replace(file_checksum, _ZERO_CHECKSUM, 1)
+    if hashlib.sha256(zeroed.encode()).hexdigest() != file_checksum:
+        raise BmapError("bmap file checksum does not match")
+
+    image_size = int(field("ImageSize"))
+    block_size = int(field("BlockSize"))
+    ranges: List[Tuple[int, int, str]] = []
+    for element in root.iterfind("BlockMap/Range"):
+        first, _, last = (element.text or "").strip().partition("-")
+        start = int(first) * block_size
+        end = min(image_size, (int(last or first) + 1) * block_size)
+        ranges.append((start, end, element.get("chksum", "")))
+    return image_size, ranges
+
+
+def flash(
+    image_path: str,
+    dest: str,
+    bmap_path: str,
+    progress: Optional[transfer.ProgressCallback] = None,
+    bandwidth_limit: Optional[int] = None,
+    storage: Optional[backend.Backend] = None,
+) -> int:
+    """Copy the mapped ranges of an image to a destination
+
+    Each range is verified against its checksum as it is copied. A regular file
+    destination is truncated to the image size so that unmapped ranges read back as
+    zeros.
+
+    Args:
+        image_path: path of the source disk image
+        dest: path of the destination device or file
+        bmap_path: path of the bmap file describing the image
+        progress: function called with the bytes done, total and estimated seconds
+            left
+        bandwidth_limit: most bytes written per second
+        storage: Backend of the source image, opened from the image path if not set
+    Returns:
+        integer count of bytes written
+    Raises:
+        BmapError if a range does not match its checksum
+    """
+
+    image_size, ranges = read_bmap(bmap_path)
+    opened: ContextManager[backend.Backend] = (
+        backend.open_backend(image_path, writable=False)
+        if storage is None
+        else contextlib.nullcontext(storage)
+    )
+    written = 0
+    with opened as image:
+        if image.size() != image_size:
+            raise BmapError(f"image size does not match bmap image size: {image_size}")
+        tracker = transfer.start(
+            sum(e - s for s, e, _ in ranges), progress, bandwidth_limit
+        )
+        out = os.open(dest, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if stat.S_ISREG(os.fstat(out).st_mode):
+                os.ftruncate(out, 0)
+                os.ftruncate(out, image_size)
+            for start, end, checksum in ranges:
+                digest = hashlib.sha256()
+                offset = start
+                while offset < end:
+                    data = image.pread(min(end - offset, hashing.CHUNK_SIZE), offset)
+                    if not data:
+                        raise BmapError(f"unexpected end of image at byte {offset}")
+                    digest.update(data)
+                    os.pwrite(out, data, offset)
+                    offset += len(data)
+                    if tracker is not None:
+                        tracker.update(len(data))
+                if digest.hexdigest() != checksum:
+                    raise BmapError(f"checksum mismatch for byte range {start}-{end}")
+                written += end - start
+            os.fsync(out)
+        finally:
+            os.close(out)
+    return written
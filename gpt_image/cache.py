@@ -0,0 +1,255 @@
+"""
+Persistent cache of disk image metadata and partition digests
+
+Entries are keyed by the image path together with its inode, size and modification
+time, so any change to an image invalidates its entries. Partition digests are
+further keyed by the partition LBA range and the hashing parameters.
+
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from gpt_image.hashing import MerkleTree, PartitionDigest
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.partition import Partition
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    image_size INTEGER,
+    head BLOB,
+    tail BLOB
+);
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT NOT NULL REFERENCES images(path) ON DELETE CASCADE,
+    first_lba INTEGER NOT NULL,
+    last_lba INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    block_size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    leaves BLOB,
+    PRIMARY KEY (path, first_lba, last_lba, algorithm, block_size)
+);
+"""
+
+
+class MetadataCache:
+    """On-disk cache of GPT metadata and partition digests
+
+    Attributes:
+        path: path of the sqlite database
+        max_age: entries not used for this many seconds are evicted, or None
+        max_entries: the least recently used images beyond this count are evicted,
+            or None
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_age: Optional[float] = None,
+        max_entries: Optional[int] = None,
+    ):
+        """Open or create the cache database and evict stale entries
+
+        Args:
+            path: path of the sqlite database
+            max_age: maximum age in seconds since an entry was last used
+            max_entries: maximum number of cached images
+        """
+
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript(_SCHEMA)
+        self.evict()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> "MetadataCache":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def _key(self, image_path: str) -> Tuple[str, int, int, int]:
+        stat = os.stat(image_path)
+        return (
+            os.path.abspath(image_path),
+            stat.st_ino,
+            stat.st_size,
+            stat.st_mtime_ns,
+        )
+
+    def _valid(self, image_path: str) -> Optional[str]:
+        """Return the cache path of an image if its entry is current
+
+        Entries for an image that has changed are removed.
+        """
+
+        path, inode, file_size, mtime_ns = self._key(image_path)
+        row = self._db.execute(
+            "SELECT inode, file_size, mtime_ns FROM images WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        if tuple(row) != (inode, file_size, mtime_ns):
+            with self._db:
+                self._db.execute("DELETE FROM images WHERE path = ?", (path,))
+            return None
+        with self._db:
+            self._db.execute(
+                "UPDATE images SET accessed = ? WHERE path = ?", (time.time(), path)
+            )
+        return path
+
+    def _touch(self, image_path: str) -> str:
+        """Create or refresh the entry of an image"""
+
+        if self._valid(image_path) is None:
+            path, inode, file_size, mtime_ns = self._key(image_path)
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO images (path, inode, file_size, mtime_ns, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (path, inode, file_size, mtime_ns, time.time()),
+                )
+            self.evict()
+        return os.path.abspath(image_path)
+
+    def get_metadata(self, image_path: str) -> Optional[Tuple[int, bytes, bytes]]:
+        """Get the cached GPT metadata of an image
+
+        Args:
+            image_path: path of the disk image
+        Returns:
+            tuple of the image size, head and tail bytes, or None if not cached
+        """
+
+        path = self._valid(image_path)
+        if path is None:
+            return None
+        row = self._db.execute(
+            "SELECT image_size, head, tail FROM images WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return int(row[0]), bytes(row[1]), bytes(row[2])
+
+    def put_metadata(self, image_path: str, image_size: int, head: bytes, tail: bytes) -> None:
+        """Cache the GPT metadata of an image
+
+        Args:
+            image_path: path of the disk image
+            image_size: image size in bytes
+            head: bytes before the first usable LBA
+            tail: bytes from the backup partition array to the end of the image
+        """
+
+        path = self._touch(image_path)
+        with self._db:
+            self._db.execute(
+                "UPDATE images SET image_size = ?, head = ?, tail = ? WHERE path = ?",
+                (image_size, head, tail, path),
+            )
+
+    def get_digest(
+        self,
+        image_path: str,
+        partition: Partition,
+        algorithm: str,
+        merkle: bool,
+        block_size: int,
+    ) -> Optional[PartitionDigest]:
+        """Get the cached digest of a partition
+
+        Args:
+            image_path: path of the disk image
+            partition: the hashed partition
+            algorithm: hashlib algorithm name
+            merkle: whether a MerkleTree is required
+            block_size: MerkleTree block size in bytes
+        Returns:
+            PartitionDigest or None if not cached
+        """
+
+        path = self._valid(image_path)
+        if path is None:
+            return None
+        row = self._db.execute(
+            "SELECT digest, leaves FROM digests WHERE path = ? AND first_lba = ? "
+            "AND last_lba = ? AND algorithm = ? AND block_size = ?",
+            (path, partition.first_lba, partition.last_lba, algorithm, block_size),
+        ).fetchone()
+        if row is None or (merkle and row[1] is None):
+            return None
+        tree = None
+        if merkle:
+            size = len(bytes.fromhex(row[0]))
+            leaves = bytes(row[1])
+            tree = MerkleTree(
+                [leaves[i : i + size] for i in range(0, len(leaves), size)],
+                block_size,
+                algorithm,
+            )
+        return PartitionDigest(partition, algorithm, row[0], tree)
+
+    def put_digest(self, image_path: str, digest: PartitionDigest, block_size: int) -> None:
+        """Cache the digest of a partition
+
+        Args:
+            image_path: path of the disk image
+            digest: PartitionDigest to cache
+            block_size: MerkleTree block size in bytes
+        """
+
+        path = self._touch(image_path)
+        leaves = b"".join(digest.tree.levels[0]) if digest.tree is not None else None
+        with self._db:
+            self._db.execute(
+                "INSERT INTO digests VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path, first_lba, last_lba, algorithm, block_size) "
+                "DO UPDATE SET digest = excluded.digest, "
+                "leaves = COALESCE(excluded.leaves, leaves)",
+                (
+                    path,
+                    digest.first_lba,
+                    digest.last_lba,
+                    digest.algorithm,
+                    block_size,
+                    digest.digest,
+                    leaves,
+                ),
+            )
+
+    def evict(self) -> int:
+        """Evict entries by age and count
+
+        Returns:
+            integer count of images evicted
+        """
+
+        evicted = 0
+        with self._db:
+            if self.max_age is not None:
+                evicted += self._db.execute(
+                    "DELETE FROM images WHERE accessed < ?", (time.time() - self.max_age,)
+                ).rowcount
+            if self.max_entries is not None:
+                evicted += self._db.execute(
+                    "DELETE FROM images WHERE path NOT IN "
+                    "(SELECT path FROM images ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_entries,),
+                ).rowcount
+        return evicted
@@ -0,0 +1,647 @@
+"""
+Compressed disk images
+
+On export, the image is split into fixed size blocks that are compressed
+independently, in parallel, and written as a sequence of gzip members, bzip2
+streams or xz streams. Standard decompressors accept these concatenated streams as
+a single file.
+
+On read, only the parts of a compressed image that are needed are decompressed.
+xz files are located with the block index stored in the file. gzip and bzip2 files
+are indexed by their member boundaries when opened; the index can be kept in a
+sidecar file next to the image so that later opens skip the scan. The decompressor
+of a read is kept for the next one, so reading an image in order decompresses
+every byte once, even from a single gzip member or xz block. Disks opened from
+compressed images read their data through a read-only CompressedBackend.
+
+xz format reference: https://tukaani.org/xz/xz-file-format.txt
+
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import bisect
+import bz2
+import collections
+import gzip
+import json
+import lzma
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import IO, TYPE_CHECKING, Any, Deque, Dict, List, Optional, Tuple, Union
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.disk import Disk
+
+from gpt_image import transfer
+from gpt_image.backend import Backend, BackendError
+
+COMPRESSION_TYPES = ("gz", "xz", "bz2")
+# uncompressed size of each independently compressed block
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class CompressionError(Exception):
+    """Error compressing or decompressing a disk image"""
+
+
+def compress_block(compression: str, data: bytes) -> bytes:
+    """Compress a block of data as a complete, independent stream
+
+    Args:
+        compression: one of COMPRESSION_TYPES
+        data: uncompressed bytes
+    Returns:
+        compressed bytes
+    Raises:
+        CompressionError if the compression type is not supported
+    """
+
+    if compression == "gz":
+        return gzip.compress(data, mtime=0)
+    if compression == "xz":
+        return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64)
+    if compression == "bz2":
+        return bz2.compress(data)
+    raise CompressionError(f"unsupported compression type: {compression}")
+
+
+def export(
+    disk: Disk,
+    dest: str,
+    compression: str = "xz",
+    threads: Optional[int] = None,
+    block_size: int = BLOCK_SIZE,
+    progress: Optional[transfer.ProgressCallback] = None,
+    bandwidth_limit: Optional[int] = None,
+    partitions_only: bool = False,
+) -> int:
+    """Write a compressed copy of a disk image
+
+    Only the data extents of the image file are read, holes are written as zeros.
+    Blocks that contain no mapped data are compressed once and the result is
+    reused.
+
+    Args:
+        disk: GPT Disk instance
+        dest: path of the compressed image to create
+        compression: one of COMPRESSION_TYPES
+        threads: number of compression processes (default CPU count), 1 compresses
+            in the calling process
+        block_size: uncompressed size of each independently compressed block
+        progress: function called with the mapped bytes read, total and estimated
+            seconds left
+        bandwidth_limit: most mapped bytes read per second
+        partitions_only: write zeros for data outside of the partitions and GPT
+            metadata
+    Returns:
+        integer count of compressed bytes written
+    Raises:
+        CompressionError if the compression type is not supported
+    """
+
+    if compression not in COMPRESSION_TYPES:
+        raise CompressionError(f"unsupported compression type: {compression}")
+    threads = threads or os.cpu_count() or 1
+    mapped = disk.mapped_extents(partitions_only)
+    zero_blocks: Dict[int, bytes] = {}
+    pending: Deque[Union["Future[bytes]", bytes]] = collections.deque()
+    written = 0
+    executor = ProcessPoolExecutor(max_workers=threads) if threads > 1 else None
+    # only the mapped bytes are read, blocks of holes are not counted
+    tracker = transfer.start(sum(e - s for s, e in mapped), progress, bandwidth_limit)
+    try:
+        with disk.storage(writable=False) as image, open(dest, "wb") as out:
+
+            def write_next() -> int:
+                item = pending.popleft()
+                data = item if isinstance(item, bytes) else item.result()
+                out.write(data)
+                return len(data)
+
+            for start in range(0, disk.size, block_size):
+                end = min(start + block_size, disk.size)
+                data_extents = [
+                    (max(s, start), min(e, end)) for s, e in mapped if s < end and e > start
+                ]
+                if not data_extents:
+                    if end - start not in zero_blocks:
+                        zero_blocks[end - start] = compress_block(
+                            compression, bytes(end - start)
+                        )
+                    pending.append(zero_blocks[end - start])
+                else:
+                    block = bytearray(end - start)
+                    for s, e in data_extents:
+                        block[s - start : e - start] = image.pread(e - s, s)
+                    if tracker is not None:
+                        tracker.update(sum(e - s for s, e in data_extents))
+                    if executor is None:
+                        pending.append(compress_block(compression, bytes(block)))
+                    else:
+                        pending.append(
+                            executor.submit(compress_block, compression, bytes(block))
+                        )
+                # bound the number of blocks held in memory
+                while len(pending) > 2 * threads:
+                    written += write_next()
+            while pending:
+                written += write_next()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return written
+
+
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+_XZ_FOOTER_MAGIC = b"YZ"
+_GZ_MAGIC = b"\x1f\x8b"
+_BZ2_MAGIC = b"BZh"
+# check field size in bytes for each xz check type
+_XZ_CHECK_SIZES = (0, 4, 4, 4, 8, 8, 8, 16, 16, 16, 32, 32, 32, 64, 64, 64)
+INDEX_SUFFIX = ".gptidx"
+_INDEX_VERSION = 1
+# compressed bytes read at a time when scanning
+_SCAN_INPUT = 64 * 1024
+# maximum bytes decompressed at a time when scanning
+_SCAN_OUTPUT = 4 * 1024 * 1024
+# the uncompressed tail kept in the index covers the backup GPT of 4 KiB sectors
+_TAIL_SIZE = 33 * 4096
+# the tail is kept in the index when the last member is larger than this
+_TAIL_MEMBER_SIZE = 64 * 1024 * 1024
+# decompressors kept open between reads, for reads in order from several threads
+_READERS = 4
+
+
+def detect(path: str) -> Optional[str]:
+    """Detect the compression type of a file from its magic bytes
+
+    Args:
+        path: file path
+    Returns:
+        one of COMPRESSION_TYPES or None if the file is not compressed
+    """
+
+    with open(path, "rb") as f:
+        magic = f.read(len(_XZ_MAGIC))
+    if magic.startswith(_XZ_MAGIC):
+        return "xz"
+    if magic.startswith(_GZ_MAGIC):
+        return "gz"
+    if magic.startswith(_BZ2_MAGIC):
+        return "bz2"
+    return None
+
+
+def _xz_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = 0
+    for i in range(9):
+        byte = data[offset + i]
+        value |= (byte & 0x7F) << (i * 7)
+        if not byte & 0x80:
+            return value, offset + i + 1
+    raise CompressionError("invalid xz variable length integer")
+
+
+def _xz_encode_varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+class _XzBlock:
+    """Location of a single block within an xz file"""
+
+    def __init__(
+        self,
+        stream_header: bytes,
+        offset: int,
+        unpadded_size: int,
+        uncompressed_offset: int,
+        uncompressed_size: int,
+    ):
+        self.stream_header = stream_header
+        self.offset = offset
+        self.unpadded_size = unpadded_size
+        self.uncompressed_offset = uncompressed_offset
+        self.uncompressed_size = uncompressed_size
+
+    def stream(self, f: IO[bytes]) -> bytes:
+        """Wrap the block in a single block xz stream
+
+        Args:
+            f: the open xz file
+        Returns:
+            bytes of an xz stream that decompresses to the block
+        """
+
+        f.seek(self.offset)
+        block = f.read(-(-self.unpadded_size // 4) * 4)
+        index = (
+            b"\x00"
+            + _xz_encode_varint(1)
+            + _xz_encode_varint(self.unpadded_size)
+            + _xz_encode_varint(self.uncompressed_size)
+        )
+        index += b"\x00" * (-len(index) % 4)
+        index += struct.pack("<I", binascii.crc32(index))
+        footer = struct.pack("<I", len(index) // 4 - 1) + self.stream_header[6:8]
+        return (
+            self.stream_header
+            + block
+            + index
+            + struct.pack("<I", binascii.crc32(footer))
+            + footer
+            + _XZ_FOOTER_MAGIC
+        )
+
+
+def _xz_blocks(f: IO[bytes]) -> List[_XzBlock]:
+    """Read the block indexes of every stream in an xz file
+
+    Streams are walked backwards from the end of the file using the stream footers,
+    so no compressed data is read.
+    """
+
+    streams: List[List[Tuple[bytes, int, int, int]]] = []
+    position = f.seek(0, os.SEEK_END)
+    while position > 0:
+        # skip stream padding
+        f.seek(position - 4)
+        if f.read(4) == b"\x00" * 4:
+            position -= 4
+            continue
+        f.seek(position - 12)
+        footer = f.read(12)
+        if footer[10:12] != _XZ_FOOTER_MAGIC:
+            raise CompressionError("invalid xz stream footer")
+        backward_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+        index_start = position - 12 - backward_size
+        f.seek(index_start)
+        index = f.read(backward_size)
+        if index[0] != 0:
+            raise CompressionError("invalid xz index")
+        count, offset = _xz_varint(index, 1)
+        records = []
+        for _ in range(count):
+            unpadded_size, offset = _xz_varint(index, offset)
+            uncompressed_size, offset = _xz_varint(index, offset)
+            records.append((unpadded_size, uncompressed_size))
+        blocks_size = sum(-(-unpadded // 4) * 4 for unpadded, _ in records)
+        stream_start = index_start - blocks_size - 12
+        f.seek(stream_start)
+        header = f.read(12)
+        if not header.startswith(_XZ_MAGIC):
+            raise CompressionError("invalid xz stream header")
+        stream = []
+        block_offset = stream_start + 12
+        for unpadded_size, uncompressed_size in records:
+            stream.append((header, block_offset, unpadded_size, uncompressed_size))
+            block_offset += -(-unpadded_size // 4) * 4
+        streams.insert(0, stream)
+        position = stream_start
+
+    blocks: List[_XzBlock] = []
+    uncompressed_offset = 0
+    for stream in streams:
+        for header, block_offset, unpadded_size, uncompressed_size in stream:
+            blocks.append(
+                _XzBlock(
+                    header, block_offset, unpadded_size, uncompressed_offset, uncompressed_size
+                )
+            )
+            uncompressed_offset += uncompressed_size
+    return blocks
+
+
+class _Inflater:
+    """Incremental gzip or bzip2 decompression of a single member"""
+
+    def __init__(self, compression: str):
+        self._gzip = compression == "gz"
+        self._d: Any = zlib.decompressobj(wbits=31) if self._gzip else bz2.BZ2Decompressor()
+        self._pending = b""
+        self._drained = False
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress up to _SCAN_OUTPUT bytes, buffering any unused input"""
+
+        if self._gzip:
+            out: bytes = self._d.decompress(self._pending + data, _SCAN_OUTPUT)
+            self._pending = self._d.unconsumed_tail
+            self._drained = not self._pending and len(out) < _SCAN_OUTPUT
+        else:
+            out = self._d.decompress(data, _SCAN_OUTPUT)
+            self._drained = bool(self._d.needs_input)
+        return out
+
+    @property
+    def drained(self) -> bool:
+        """True if more input is needed to produce output"""
+
+        return self._drained or self.eof
+
+    @property
+    def eof(self) -> bool:
+        return bool(self._d.eof)
+
+    @property
+    def unused_data(self) -> bytes:
+        return bytes(self._d.unused_data)
+
+
+def _scan_members(f: IO[bytes], compression: str) -> Tuple[List[List[int]], int, bytes]:
+    """Decompress a gzip or bzip2 file once, recording its member boundaries
+
+    Returns:
+        tuple of the [compressed offset, uncompressed offset] member list, the
+        uncompressed size and the uncompressed tail of the file
+    Raises:
+        CompressionError if the file is invalid or truncated
+    """
+
+    members: List[List[int]] = []
+    size = 0
+    tail = bytearray()
+    position = 0
+    inflater: Optional[_Inflater] = None
+    data = b""
+    f.seek(0)
+    while True:
+        if not data and (inflater is None or inflater.drained):
+            data = f.read(_SCAN_INPUT)
+            position += len(data)
+            if not data:
+                break
+        if inflater is None:
+            if members and not data.strip(b"\x00"):
+                # padding after the last member
+                data = b""
+                continue
+            members.append([position - len(data), size])
+            inflater = _Inflater(compression)
+        try:
+            out = inflater.decompress(data)
+        except (OSError, EOFError, zlib.error) as e:
+            raise CompressionError(f"invalid {compression} data: {e}") from e
+        data = b""
+        size += len(out)
+        tail += out
+        del tail[:-_TAIL_SIZE]
+        if inflater.eof:
+            data = inflater.unused_data
+            inflater = None
+    if inflater is not None or not members:
+        raise CompressionError(f"truncated {compression} data")
+    return members, size, bytes(tail)
+
+
+class _Reader:
+    """Reads in order from a gzip or bzip2 member or an xz block of an image
+
+    Args:
+        image: CompressedImage read from
+        index: member or xz block the reads start at
+    """
+
+    def __init__(self, image: CompressedImage, index: int):
+        self.position = image._offsets[index]
+        self._blocks = image._blocks
+        self._file = open(image.path, "rb")
+        self._block = index
+        self._xz: Optional[lzma.LZMADecompressor] = None
+        self._stream: Optional[Union[gzip.GzipFile, bz2.BZ2File]] = None
+        if image.compression != "xz":
+            self._file.seek(image._members[index][0])
+            if image.compression == "gz":
+                self._stream = gzip.GzipFile(fileobj=self._file)
+            else:
+                self._stream = bz2.BZ2File(self._file)
+
+    def read(self, size: int) -> bytes:
+        """Decompress the next bytes, fewer than size at the end of the image"""
+
+        if self._stream is not None:
+            data = self._stream.read(size)
+        else:
+            data = self._read_xz(size)
+        self.position += len(data)
+        return data
+
+    def _read_xz(self, size: int) -> bytes:
+        blocks = self._blocks
+        data = bytearray()
+        while len(data) < size and self._block < len(blocks):
+            if self._xz is None:
+                self._xz = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+                compressed = blocks[self._block].stream(self._file)
+            else:
+                compressed = b""
+            out = self._xz.decompress(compressed, max_length=size - len(data))
+            data += out
+            if self._xz.eof:
+                self._block += 1
+                self._xz = None
+            elif not out and self._xz.needs_input:
+                break
+        return bytes(data)
+
+    def skip(self, offset: int) -> bool:
+        """Decompress up to an offset, returning False if the image ends first"""
+
+        while self.position < offset:
+            if not self.read(min(offset - self.position, _SCAN_OUTPUT)):
+                return False
+        return True
+
+    def close(self) -> None:
+        if self._stream is not None:
+            self._stream.close()
+        self._file.close()
+
+    def __del__(self) -> None:
+        # readers are kept by the image until it is released
+        self.close()
+
+
+class CompressedImage:
+    """Random access reads from a compressed disk image
+
+    Attributes:
+        path: path of the compressed image
+        compression: one of COMPRESSION_TYPES
+        size: uncompressed size in bytes
+    """
+
+    def __init__(
+        self, path: str, compression: Optional[str] = None, write_index: bool = False
+    ):
+        """Init CompressedImage, building the index if needed
+
+        Args:
+            path: path of the compressed image
+            compression: compression type, detected from the file if not set
+            write_index: keep the member index of gzip and bzip2 images in a sidecar
+                file when it has to be built
+        Raises:
+            CompressionError if the file is not a supported compressed image
+        """
+
+        self.path = path
+        detected = compression or detect(path)
+        if detected is None:
+            raise CompressionError(f"not a compressed image: {path}")
+        self.compression = detected
+        self._blocks: List[_XzBlock] = []
+        self._members: List[List[int]] = []
+        self._tail = b""
+        # readers left where the last reads stopped
+        self._readers: List[_Reader] = []
+        self._lock = threading.Lock()
+        if self.compression == "xz":
+            with open(path, "rb") as f:
+                self._blocks = _xz_blocks(f)
+            self._offsets = [b.uncompressed_offset for b in self._blocks]
+            last = self._blocks[-1] if self._blocks else None
+            self.size = last.uncompressed_offset + last.uncompressed_size if last else 0
+        else:
+            self._load_index(write_index)
+            self._offsets = [uncompressed for _, uncompressed in self._members]
+
+    def _load_index(self, write_index: bool) -> None:
+        stat = os.stat(self.path)
+        index_path = self.path + INDEX_SUFFIX
+        try:
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            if (
+                index["version"] == _INDEX_VERSION
+                and index["compressed_size"] == stat.st_size
+                and index["mtime_ns"] == stat.st_mtime_ns
+            ):
+                self._members = index["members"]
+                self.size = index["size"]
+                self._tail = base64.b64decode(index["tail"])
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with open(self.path, "rb") as f:
+            self._members, self.size, tail = _scan_members(f, self.compression)
+        # keep the tail when it cannot be reached quickly through a member boundary
+        if self.size - self._members[-1][1] > _TAIL_MEMBER_SIZE:
+            self._tail = tail
+        if not write_index:
+            return
+        index = {
+            "version": _INDEX_VERSION,
+            "compressed_size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": self.size,
+            "members": self._members,
+            "tail": base64.b64encode(self._tail).decode(),
+        }
+        try:
+            with open(index_path, "w") as f:
+                json.dump(index, f, separators=(",", ":"))
+        except OSError:
+            # the image may be on read-only storage, the index is rebuilt next time
+            pass
+
+    def pread(self, size: int, offset: int) -> bytes:
+        """Read uncompressed bytes
+
+        A read continues from where an earlier read stopped if it is in the same
+        member or block, further on; otherwise decompression starts again at the
+        member or block holding the offset.
+
+        Args:
+            size: number of bytes to read
+            offset: uncompressed offset to read from
+        Returns:
+            bytes read, shorter than size at the end of the image
+        """
+
+        size = max(0, min(size, self.size - offset))
+        if size == 0:
+            return b""
+        tail_start = self.size - len(self._tail)
+        if self._tail and offset >= tail_start:
+            return self._tail[offset - tail_start : offset - tail_start + size]
+        index = bisect.bisect_right(self._offsets, offset) - 1
+        reader = self._take_reader(index, offset)
+        try:
+            data = reader.read(size) if reader.skip(offset) else b""
+        except BaseException:
+            reader.close()
+            raise
+        with self._lock:
+            self._readers.append(reader)
+            if len(self._readers) > _READERS:
+                self._readers.pop(0).close()
+        return data
+
+    def _take_reader(self, index: int, offset: int) -> _Reader:
+        """Take the reader closest before an offset within its member or block"""
+
+        with self._lock:
+            found = None
+            for reader in self._readers:
+                if (
+                    reader.position <= offset
+                    and bisect.bisect_right(self._offsets, reader.position) - 1 == index
+                    and (found is None or reader.position > found.position)
+                ):
+                    found = reader
+            if found is not None:
+                self._readers.remove(found)
+                return found
+        return _Reader(self, index)
+
+    def close(self) -> None:
+        """Close the readers kept between reads"""
+
+        with self._lock:
+            readers, self._readers = self._readers, []
+        for reader in readers:
+            reader.close()
+
+
+class CompressedBackend(Backend):
+    """Read-only backend over a compressed disk image
+
+    Args:
+        path: path of the compressed image
+        compression: compression type, detected from the file if not set
+        write_index: keep the member index of gzip and bzip2 images in a sidecar file
+    Raises:
+        CompressionError if the file is not a supported compressed image
+    """
+
+    def __init__(
+        self, path: str, compression: Optional[str] = None, write_index: bool = False
+    ):
+        self.image = CompressedImage(str(path), compression, write_index)
+        super().__init__(str(path), BLOCK_SIZE)
+
+    def size(self) -> int:
+        return self.image.size
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return self.image.pread(size, offset)
+
+    def pwrite(self, data: bytes, offset: int) -> int:
+        raise BackendError(f"compressed images are read-only: {self.path}")
+
+    def truncate(self, size: int) -> None:
+        raise BackendError(f"compressed images are read-only: {self.path}")
+
+    def close(self) -> None:
+        self.image.close()
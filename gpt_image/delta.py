@@ -0,0 +1,288 @@
+"""
+Block level delta patches between two GPT disk images
+
+A patch holds the byte ranges of the new image that differ from the base image,
+together with the complete GPT metadata of the new image. Applying a patch to a
+copy of the base image produces the new image. The patch also holds the digest of
+the base image bytes it replaces, which is checked before the target is written.
+
+Patch format (little endian):
+    header: magic "GPTDELTA", version (u32), block size (u32), image size (u64),
+        range count (u64), SHA-256 digest of the base bytes of all ranges in order
+        (32 bytes)
+    ranges: offset (u64), length (u64), followed by length bytes of data
+
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import stat
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, TYPE_CHECKING, Callable, List, Optional, Tuple
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.backend import Backend
+    from gpt_image.disk import Disk
+
+from gpt_image import extents, hashing
+
+PATCH_MAGIC = b"GPTDELTA"
+PATCH_VERSION = 2
+_HEADER_FORMAT = struct.Struct("<8sIIQQ32s")
+_RANGE_FORMAT = struct.Struct("<QQ")
+# images are split into segments of this size for block level comparison
+_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class DeltaError(Exception):
+    """Error creating or applying a delta patch"""
+
+
+def _changed_blocks(
+    base_storage: Backend,
+    new_storage: Backend,
+    start: int,
+    end: int,
+    block_size: int,
+    algorithm: str,
+) -> List[extents.Extent]:
+    base_hashes = hashing.block_hashes(base_storage, start, end, block_size, algorithm)
+    new_hashes = hashing.block_hashes(new_storage, start, end, block_size, algorithm)
+    return extents.merge(
+        (start + i * block_size, min(end, start + (i + 1) * block_size))
+        for i, (old, new) in enumerate(zip(base_hashes, new_hashes))
+        if old != new
+    )
+
+
+def _segments(
+    mapped: List[extents.Extent], block_size: int
+) -> List[extents.Extent]:
+    """Split extents into segments whose blocks are aligned to the image
+
+    An extent that does not start on a block boundary has its first partial
+    block as a segment of its own.
+    """
+
+    segments = []
+    for start, end in mapped:
+        boundary = min(end, -(-start // block_size) * block_size)
+        if start < boundary:
+            segments.append((start, boundary))
+        for segment in range(boundary, end, _SEGMENT_SIZE):
+            segments.append((segment, min(end, segment + _SEGMENT_SIZE)))
+    return segments
+
+
+def _base_digest(
+    pread: Callable[[int, int], bytes], ranges: List[extents.Extent]
+) -> bytes:
+    """Hash the bytes of the ranges of an image, in order, in a single pass
+
+    Args:
+        pread: function reading (size, offset) bytes from the image
+        ranges: list of (start, end) byte ranges
+    Returns:
+        SHA-256 digest bytes
+    Raises:
+        DeltaError if the image ends before a range
+    """
+
+    digest = hashlib.sha256()
+    for start, end in ranges:
+        while start < end:
+            data = pread(min(end - start, hashing.CHUNK_SIZE), start)
+            if not data:
+                raise DeltaError(f"unexpected end of image at byte {start}")
+            digest.update(data)
+            start += len(data)
+    return digest.digest()
+
+
+def diff(
+    base: Disk,
+    new: Disk,
+    patch_path: str,
+    block_size: int = 4096,
+    workers: Optional[int] = None,
+    algorithm: str = "sha256",
+) -> List[extents.Extent]:
+    """Create a patch that turns the base image into the new image
+
+    Every data extent of either image, inside or outside of the partitions, is
+    compared block by block; ranges that are holes in both images are skipped. The
+    images are split into segments that are hashed in parallel, and each block is
+    read once from each image.
+
+    Args:
+        base: GPT Disk instance of the base image
+        new: GPT Disk instance of the new image
+        patch_path: path of the patch file to create
+        block_size: comparison block size in bytes
+        workers: number of hashing threads (default CPU count)
+        algorithm: hashlib algorithm name
+    Returns:
+        list of (start, end) byte ranges stored in the patch
+    Raises:
+        DeltaError if the images are not the same size
+    """
+
+    if base.size != new.size:
+        raise DeltaError(f"image sizes differ: {base.size} != {new.size}")
+    sector_size = new.sector_size
+    metadata = [
+        (0, new.geometry.first_usable_lba * sector_size),
+        (new.geometry.alternate_array_byte, new.size),
+    ]
+    with base.storage(writable=False) as base_storage, new.storage(
+        writable=False
+    ) as new_storage, ThreadPoolExecutor(
+        max_workers=workers or os.cpu_count()
+    ) as executor:
+        # the metadata is stored whole, so it is not compared
+        mapped = extents.subtract(
+            extents.align(
+                extents.merge(
+                    base_storage.data_extents(0, base.size)
+                    + new_storage.data_extents(0, new.size)
+                ),
+                block_size,
+                new.size,
+            ),
+            metadata,
+        )
+        changed = [
+            executor.submit(
+                _changed_blocks,
+                base_storage,
+                new_storage,
+                start,
+                end,
+                block_size,
+                algorithm,
+            )
+            for start, end in _segments(mapped, block_size)
+        ]
+        ranges = extents.merge(
+            metadata + [r for future in changed for r in future.result()]
+        )
+        base_digest = _base_digest(base_storage.pread, ranges)
+        with open(patch_path, "wb") as patch:
+            patch.write(
+                _HEADER_FORMAT.pack(
+                    PATCH_MAGIC,
+                    PATCH_VERSION,
+                    block_size,
+                    new.size,
+                    len(ranges),
+                    base_digest,
+                )
+            )
+            for start, end in ranges:
+                patch.write(_RANGE_FORMAT.pack(start, end - start))
+                offset = start
+                while offset < end:
+                    data = new_storage.pread(min(end - offset, hashing.CHUNK_SIZE), offset)
+                    if not data:
+                        raise DeltaError(f"unexpected end of image at byte {offset}")
+                    patch.write(data)
+                    offset += len(data)
+    return ranges
+
+
+def _read_exact(f: IO[bytes], size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise DeltaError("patch file is truncated")
+    return data
+
+
+def read_header(f: IO[bytes]) -> Tuple[int, int, int, bytes]:
+    """Read a patch header
+
+    Args:
+        f: patch file opened for reading
+    Returns:
+        tuple of the block size, image size, range count and base digest
+    Raises:
+        DeltaError if the header is invalid
+    """
+
+    magic, version, block_size, image_size, count, base_digest = _HEADER_FORMAT.unpack(
+        _read_exact(f, _HEADER_FORMAT.size)
+    )
+    if magic != PATCH_MAGIC:
+        raise DeltaError("invalid patch magic")
+    if version != PATCH_VERSION:
+        raise DeltaError(f"unsupported patch version: {version}")
+    return block_size, image_size, count, base_digest
+
+
+def _read_ranges(f: IO[bytes], count: int, image_size: int) -> List[Tuple[int, int, int]]:
+    """Read the range headers of a patch, skipping their data
+
+    Returns:
+        list of (offset, length, patch position of the data) ranges
+    Raises:
+        DeltaError if a range is outside the image or the patch is truncated
+    """
+
+    ranges = []
+    for _ in range(count):
+        offset, length = _RANGE_FORMAT.unpack(_read_exact(f, _RANGE_FORMAT.size))
+        if offset + length > image_size:
+            raise DeltaError(f"patch range {offset}+{length} is outside the image")
+        ranges.append((offset, length, f.tell()))
+        f.seek(length, os.SEEK_CUR)
+    if f.tell() > os.fstat(f.fileno()).st_size:
+        raise DeltaError("patch file is truncated")
+    return ranges
+
+
+def apply(patch_path: str, target: str) -> int:
+    """Write the ranges of a patch onto a device or image
+
+    The target bytes that the patch replaces are hashed first and compared with
+    the base digest of the patch; nothing is written if they do not match.
+
+    Args:
+        patch_path: path of a patch created with diff
+        target: path of the device or image holding the base image
+    Returns:
+        integer count of bytes written
+    Raises:
+        DeltaError if the patch is invalid, the target size does not match or the
+            target does not hold the base image of the patch
+    """
+
+    written = 0
+    with open(patch_path, "rb") as patch:
+        _, image_size, count, base_digest = read_header(patch)
+        ranges = _read_ranges(patch, count, image_size)
+        fd = os.open(target, os.O_RDWR)
+        try:
+            target_size = os.lseek(fd, 0, os.SEEK_END)
+            if target_size != image_size and (
+                stat.S_ISREG(os.fstat(fd).st_mode) or target_size < image_size
+            ):
+                raise DeltaError(f"target size {target_size} does not match {image_size}")
+            digest = _base_digest(
+                lambda size, offset: os.pread(fd, size, offset),
+                [(offset, offset + length) for offset, length, _ in ranges],
+            )
+            if digest != base_digest:
+                raise DeltaError(f"target does not hold the base image of the patch: {target}")
+            for offset, length, position in ranges:
+                patch.seek(position)
+                end = offset + length
+                while offset < end:
+                    data = _read_exact(patch, min(end - offset, hashing.CHUNK_SIZE))
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                written += length
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return written
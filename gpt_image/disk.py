@@ -1,10 +1,39 @@
+import contextlib
 import json
+import lzma
 import os
 import pathlib
+import struct
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
+from gpt_image import (
+    backend,
+    bmap,
+    compress,
+    delta,
+    extents,
+    flash,
+    hashing,
+    instrument,
+    journal,
+    move,
+    sparse,
+    transfer,
+    validate,
+    verify,
+)
+from gpt_image.cache import MetadataCache
+from gpt_image.flash import FlashResult
 from gpt_image.geometry import Geometry
-from gpt_image.partition import Partition, PartitionEntryArray, PartitionType
-from gpt_image.table import Header, Table
+from gpt_image.partition import (
+    AlignmentPolicy,
+    Partition,
+    PartitionEntryArray,
+    PartitionType,
+)
+from gpt_image.table import Header, HeaderReadError, Table
+from gpt_image.validate import Problem
+from gpt_image.verify import Mismatch, WriteLog
 
 
 class TableReadError(Exception):
@@ -15,6 +44,14 @@ class DiskReadError(Exception):
     """Error reading disk image"""
 
 
+class DiskWriteError(Exception):
+    """Error writing disk image"""
+
+
+class DiskResizeError(Exception):
+    """Error resizing disk image"""
+
+
 class Disk:
     """GPT disk
 
@@ -23,56 +60,146 @@ class Disk:
 
     Attributes:
         image_path: file image path (absolute or relative)
+        backend: Backend the image is read from and written to, None to open the
+            image path for each operation
+        progress: function called with the bytes done, total bytes and estimated
+            seconds left of bulk copies: data moves, partition writes, flashing
+            and exports
+        bandwidth_limit: most bytes per second copied by bulk copies, None for
+            no limit
+        write_log: WriteLog taking the digests of every write to the image, checked
+            with verify; None to not record writes
+        journal_dir: directory the commit journal is kept in, next to the image if
+            None; required to commit to a block device
+        pending_journal: True if the image was opened without recovery and holds
+            the journal of an interrupted commit; the image is then read-only
     """
 
-    def __init__(self, image_path: str, sector_size: int = 512) -> None:
+    def __init__(
+        self,
+        image_path: str,
+        sector_size: int = 512,
+        backend: Optional[backend.Backend] = None,
+    ) -> None:
         """Init Disk with a file path
 
         Args:
             image_path: path a new or existing disk image
             sector_size: disk sector size in bytes (default 512 Bytes)
+            backend: Backend of the image, such as an image built in memory or a
+                block device
         """
 
         self.image_path = pathlib.Path(image_path)
+        self.backend = backend
         self.name = self.image_path.name
         self.sector_size = sector_size
+        self.compression: Optional[str] = None
+        # GPT metadata regions as last read from or written to the image
+        self._metadata: Optional[Tuple[bytes, bytes]] = None
+        # statistics of the partition data moves of the last commit
+        self.move_stats = move.MoveStats()
+        self.progress: Optional[transfer.ProgressCallback] = None
+        self.bandwidth_limit: Optional[int] = None
+        self.write_log: Optional[WriteLog] = None
+        # backend of a compressed image, built once as it may have to be indexed
+        self._compressed: Optional[compress.CompressedBackend] = None
+        self.journal_dir: Optional[str] = None
+        self.pending_journal = False
+        # keep the member index of a compressed image in a sidecar file
+        self._write_index = False
 
     @staticmethod
-    def open(image_path: str) -> "Disk":
+    def open(
+        image_path: str,
+        cache: Optional[MetadataCache] = None,
+        backend: Optional[backend.Backend] = None,
+        journal_dir: Optional[str] = None,
+        recover: bool = True,
+    ) -> "Disk":
         """Read existing GPT disk table
 
+        Only the GPT metadata at the start and end of the image is read. A commit
+        that was interrupted is completed first, unless recover is not set; the
+        image is then opened without any writes and only flagged with
+        pending_journal. Images compressed with xz, gzip or bzip2 are opened
+        read-only, and the data is read through a CompressedBackend. xz images
+        are located with their block index, so only the compressed blocks that
+        hold the metadata are decompressed. gzip and bzip2 images are
+        decompressed once to index their members, unless the index sidecar file
+        next to the image is current; the index is written there, unless recover
+        is not set.
+
+        Args:
+            image_path: path of an existing disk image
+            cache: MetadataCache holding the metadata of unchanged images
+            backend: Backend of the image, the image path is opened if not set
+            journal_dir: directory the commit journal is kept in, next to the image
+                if not set
+            recover: complete an interrupted commit before reading the metadata,
+                and write the member index of a gzip or bzip2 image
         Raises:
             DiskReadError: if disk image cannot be found
             TableReadError if primary and backup tables do not match
         """
 
-        if not os.path.isfile(image_path):
+        if backend is None and not os.path.isfile(image_path):
             raise DiskReadError(f"unable to open disk: {image_path}")
-        disk = Disk(image_path)
-        disk_bytes = disk.image_path.read_bytes()
-        disk.size = disk.image_path.stat().st_size
+        disk = Disk(image_path, backend=backend)
+        disk.journal_dir = journal_dir
+        disk._write_index = recover
+        if backend is None:
+            disk.compression = compress.detect(image_path)
+            journal_image = None if disk.compression else str(image_path)
+        else:
+            journal_image = backend.path
+        if journal_image is not None and not recover:
+            disk.pending_journal = os.path.exists(
+                journal.journal_path(journal_image, journal_dir)
+            )
+        elif journal_image is not None:
+            # complete a commit that was interrupted
+            journal.recover(journal_image, backend, journal_dir)
+        if backend is not None:
+            cache = None
+        cached = cache.get_metadata(str(image_path)) if cache is not None else None
+        if cached is not None:
+            disk.size, head, tail = cached
+        else:
+            try:
+                with disk.storage(writable=False) as storage:
+                    disk.size = storage.size()
+                    head, tail = disk._read_metadata(storage.pread)
+            except (compress.CompressionError, lzma.LZMAError, OSError, EOFError) as e:
+                if disk.compression is None:
+                    raise
+                raise DiskReadError(f"unable to read compressed disk: {e}") from e
+        if cache is not None and cached is None:
+            cache.put_metadata(str(image_path), disk.size, head, tail)
+        disk._metadata = (head, tail)
         disk.geometry = Geometry(disk.size, disk.sector_size)
         disk.table = Table(disk.geometry)
+        # byte offsets are relative to the start of the head and tail reads
+        tail_offset = disk.geometry.alternate_array_byte
         # read the headers
-        primary_header_b = disk_bytes[
+        primary_header_b = head[
             disk.geometry.primary_header_byte : disk.geometry.primary_header_byte
             + disk.geometry.header_length
         ]
-        backup_header_b = disk_bytes[
-            disk.geometry.alternate_header_byte : disk.geometry.alternate_header_byte
+        backup_header_b = tail[
+            disk.geometry.alternate_header_byte
+            - tail_offset : disk.geometry.alternate_header_byte
+            - tail_offset
             + disk.geometry.header_length
         ]
         disk.table.primary_header = Header.unmarshal(primary_header_b, disk.geometry)
         disk.table.secondary_header = Header.unmarshal(backup_header_b, disk.geometry, is_backup=True)
         # read the partition tables
-        primary_part_table_b = disk_bytes[
+        primary_part_table_b = head[
             disk.geometry.primary_array_byte : disk.geometry.primary_array_byte
             + disk.geometry.array_max_length
         ]
-        backup_part_table_b = disk_bytes[
-            disk.geometry.alternate_array_byte : disk.geometry.alternate_array_byte
-            + disk.geometry.array_max_length
-        ]
+        backup_part_table_b = tail[: disk.geometry.array_max_length]
         if primary_part_table_b != backup_part_table_b:
             raise TableReadError("primary and backup table do not match")
         # unmarshal the partition bytes to objects and add the partition to the entry
@@ -87,19 +214,105 @@ class Disk:
                 disk.table.partitions.entries.append(new_part)
         return disk
 
+    def _read_metadata(
+        self, pread: Callable[[int, int], bytes]
+    ) -> Tuple[bytes, bytes]:
+        """Read the regions of the image that hold the GPT metadata
+
+        Args:
+            pread: function reading (size, offset) bytes from the image
+        Returns:
+            tuple of the bytes before the first usable LBA and the bytes from the
+                backup partition array to the end of the image
+        """
+
+        geometry = Geometry(self.size, self.sector_size)
+        head = pread(geometry.first_usable_lba * self.sector_size, 0)
+        tail = pread(
+            self.size - geometry.alternate_array_byte, geometry.alternate_array_byte
+        )
+        return head, tail
+
+    @contextlib.contextmanager
+    def storage(self, writable: bool = True) -> Iterator[backend.Backend]:
+        """Open the backend of the image
+
+        The backend of the disk is used as is; without one, the image path is
+        opened and closed again on exit. Compressed images are read through a
+        CompressedBackend. The I/O is counted into the instrument spans in
+        progress, and writes are recorded in the write log if set.
+
+        Args:
+            writable: open the image for writing
+        Returns:
+            context manager of the Backend
+        Raises:
+            DiskWriteError if the image is compressed or has a pending journal and
+                writable is set
+        """
+
+        if writable and self.pending_journal:
+            raise DiskWriteError(f"disk has an interrupted commit to recover: {self.name}")
+        if self.backend is not None:
+            yield self._wrap(self.backend)
+            return
+        if self.compression is not None:
+            if writable:
+                raise DiskWriteError(f"compressed disk images are read-only: {self.name}")
+            if self._compressed is None:
+                self._compressed = compress.CompressedBackend(
+                    str(self.image_path), self.compression, self._write_index
+                )
+            yield self._wrap(self._compressed)
+            return
+        with backend.open_backend(str(self.image_path), writable) as storage:
+            yield self._wrap(storage)
+
+    def _wrap(self, storage: backend.Backend) -> backend.Backend:
+        if self.write_log is not None:
+            storage = verify.RecordingBackend(storage, self.write_log)
+        return instrument.wrap(storage)
+
     def __repr__(self) -> str:
-        # objects will be in the form of JSON strings, convert them to dicts so that we
-        # can create a single JSON document
-        partition_list = [json.loads(str(p)) for p in self.table.partitions.entries]
-        disk_dict = {
+        return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the disk and its table to a dictionary of plain values
+
+        Values are strings, integers, booleans, lists and dictionaries only, so the
+        result can be passed straight to json, msgpack or similar encoders.
+
+        Returns:
+            dictionary of the image properties, both headers and the partitions
+        """
+
+        return {
             "path": str(self.image_path),
             "image_size": self.size,
             "sector_size": self.sector_size,
-            "primary_header": json.loads(str(self.table.primary_header)),
-            "backup_header": json.loads(str(self.table.secondary_header)),
-            "partitions": partition_list,
+            "compression": self.compression,
+            **self.table.to_dict(),
         }
-        return json.dumps(disk_dict, indent=2, ensure_ascii=False)
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "Disk":
+        """Create a Disk object from a dictionary made by to_dict
+
+        The image is not read. Committing the disk writes the table to an existing
+        image of the same size at the path.
+
+        Args:
+            data: dictionary of disk values
+        Returns:
+            an instance of the Disk class
+        """
+
+        disk = Disk(data["path"], data["sector_size"])
+        disk.compression = data.get("compression")
+        disk.size = data["image_size"]
+        disk.geometry = Geometry(disk.size, disk.sector_size)
+        disk.table = Table.from_dict(data, disk.geometry)
+        return disk
 
     def create(self, size: int) -> None:
         """Create the disk image on Disk
@@ -111,44 +324,443 @@ class Disk:
             size in bytes
         """
 
-        self.image_path.touch(exist_ok=False)
-        self.size = size
-        self.geometry = Geometry(self.size, self.sector_size)
-        self.table = Table(self.geometry)
-        # @TODO: move this into the write method
-        with open(self.image_path, "r+b") as f:
-            # zero entire disk
-            f.write(b"\x00" * self.size)
-        self.commit()
+        with instrument.span("disk.create"):
+            if self.backend is None:
+                self.image_path.touch(exist_ok=False)
+            self.size = size
+            self.geometry = Geometry(self.size, self.sector_size)
+            self.table = Table(self.geometry)
+            with self.storage() as storage:
+                # zero entire disk, the file is extended sparsely so that unused
+                # space does not have to be written or read back
+                storage.truncate(self.size)
+            geometry = Geometry(self.size, self.sector_size)
+            self._metadata = (
+                bytes(geometry.first_usable_lba * self.sector_size),
+                bytes(self.size - geometry.alternate_array_byte),
+            )
+            self.commit()
 
-    def commit(self) -> None:
+    def commit(self, workers: Optional[int] = None, chunk_size: int = move.CHUNK_SIZE) -> int:
         """Commit the GPT information to disk
 
         Writes the GPT header and partition tables to disk. Actions that happen before
         this are not written to disk.
+
+        Only the sectors of the protective MBR, headers and partition entry arrays
+        that differ from what is on disk are written, coalesced into as few writes
+        as possible. Partition data moves and metadata writes are journaled, see
+        PartitionEntryArray.commit. Statistics of the data moves are kept in
+        move_stats.
+
+        Args:
+            workers: number of threads moving partition data (default CPU count)
+            chunk_size: bytes copied by each thread at a time
+        Returns:
+            integer count of metadata bytes written
+        Raises:
+            DiskWriteError if the disk image is compressed or has a pending journal
+        """
+
+        if self.compression is not None:
+            raise DiskWriteError(f"compressed disk images are read-only: {self.name}")
+        if self.pending_journal:
+            raise DiskWriteError(f"disk has an interrupted commit to recover: {self.name}")
+
+        with instrument.span("disk.commit"):
+            writes, metadata = self._metadata_writes()
+            # if partitions have been moved or resized, then their data needs to be
+            # shifted within the disk; the moves and metadata writes are journaled
+            self.move_stats = move.MoveStats()
+            if writes or any(p.needs_commit() for p in self.table.partitions.entries):
+                self.move_stats = self.table.partitions.commit(
+                    self, writes, workers, chunk_size
+                )
+            self._metadata = metadata
+            return sum(len(data) for _, data in writes)
+
+    def _metadata_writes(self) -> Tuple[List[Tuple[int, bytes]], Tuple[bytes, bytes]]:
+        """Marshal the GPT metadata and find the sectors that need writing
+
+        The metadata is laid out in the same head and tail regions that are read by
+        open, and compared sector by sector with what was last read or written.
+        Adjacent dirty sectors are coalesced.
+
+        Returns:
+            tuple of the list of (offset, bytes) writes and the new head and tail
+        """
+
+        if self._metadata is None:
+            with self.storage(writable=False) as storage:
+                self._metadata = self._read_metadata(storage.pread)
+        old_head, old_tail = self._metadata
+        # the entry array is marshalled once for both checksums and both copies
+        partition_bytes = self.table.partitions.marshal()
+        self.table.update(partition_bytes)
+
+        geometry = Geometry(self.size, self.sector_size)
+        tail_offset = geometry.alternate_array_byte
+        head = bytearray(old_head.ljust(geometry.first_usable_lba * self.sector_size, b"\x00"))
+        tail = bytearray(old_tail.ljust(self.size - tail_offset, b"\x00"))
+        structures = [
+            (0, self.table.protective_mbr.marshal()),
+            (self.geometry.primary_header_byte, self.table.primary_header.marshal()),
+            (self.geometry.primary_array_byte, partition_bytes),
+            (self.geometry.alternate_header_byte, self.table.secondary_header.marshal()),
+            (self.geometry.alternate_array_byte, partition_bytes),
+        ]
+        for offset, data in structures:
+            if offset < tail_offset:
+                head[offset : offset + len(data)] = data
+            else:
+                tail[offset - tail_offset : offset - tail_offset + len(data)] = data
+
+        writes: List[Tuple[int, bytes]] = []
+        for base, before, after in ((0, old_head, head), (tail_offset, old_tail, tail)):
+            for i in range(0, len(after), self.sector_size):
+                sector = bytes(after[i : i + self.sector_size])
+                if sector == before[i : i + self.sector_size]:
+                    continue
+                if writes and writes[-1][0] + len(writes[-1][1]) == base + i:
+                    writes[-1] = (writes[-1][0], writes[-1][1] + sector)
+                else:
+                    writes.append((base + i, sector))
+        return writes, (bytes(head), bytes(tail))
+
+    def resize(self, size: int) -> None:
+        """Grow or shrink the disk image
+
+        The image file is extended sparsely or truncated, and only the protective
+        MBR, the primary header and the backup header and partition array are
+        rewritten; partition data is not touched. Pending partition changes are
+        committed first. The new size and the metadata writes are journaled
+        together, so an interrupted resize is completed the next time the disk is
+        opened.
+
+        Args:
+            size: new size in bytes, a multiple of the sector size
+        Raises:
+            DiskWriteError if the disk image is compressed
+            DiskResizeError if the size is not a multiple of the sector size or the
+                disk would be too small to hold the partitions
+        """
+
+        if self.compression is not None:
+            raise DiskWriteError(f"compressed disk images are read-only: {self.name}")
+        if size % self.sector_size:
+            raise DiskResizeError(f"size is not a multiple of {self.sector_size}: {size}")
+        geometry = Geometry(size, self.sector_size)
+        if geometry.last_usable_lba < self.geometry.first_usable_lba:
+            raise DiskResizeError(f"size is too small for a GPT disk: {size}")
+        for partition in self.table.partitions.entries:
+            if max(partition.last_lba, partition.last_lba_staged) > geometry.last_usable_lba:
+                raise DiskResizeError(
+                    f"partition {partition.partition_name} ends beyond the last usable "
+                    f"LBA {geometry.last_usable_lba} of a {size} byte disk"
+                )
+        self.commit()
+        old_tail = (self.geometry.alternate_array_byte, self.size)
+        if self._metadata is None:
+            raise DiskResizeError(f"GPT metadata of the disk was not committed: {self.name}")
+        head = self._metadata[0]
+        self.size = size
+        self.table.resize(geometry)
+        self.geometry = geometry
+        # the whole new backup region is written, as it may lie past the end of the
+        # image until the journal is carried out
+        self._metadata = (head, b"")
+        writes, metadata = self._metadata_writes()
+        if old_tail[1] < size:
+            # the old backup structures are now inside the usable space
+            end = min(old_tail[1], geometry.alternate_array_byte)
+            if end > old_tail[0]:
+                writes.append((old_tail[0], bytes(end - old_tail[0])))
+        with instrument.span("disk.resize"), self.storage() as storage:
+            journal.Journal(
+                storage.path,
+                [],
+                writes,
+                storage=storage,
+                directory=self.journal_dir,
+                resize=size,
+            ).run()
+        self._metadata = metadata
+
+    def minimize(self, padding: int = 0) -> int:
+        """Shrink the disk image to the end of its last partition
+
+        The image keeps the backup GPT after the last partition, so the trimmed
+        image can be grown again on the device it is flashed to.
+
+        Args:
+            padding: free bytes to keep after the last partition, rounded up to
+                whole sectors
+        Returns:
+            integer new size in bytes
+        """
+
+        last_lba = max(
+            [self.geometry.first_usable_lba - 1]
+            + [
+                max(partition.last_lba, partition.last_lba_staged)
+                for partition in self.table.partitions.entries
+            ]
+        )
+        padding_sectors = -(-padding // self.sector_size)
+        # the backup partition array and header take the last 33 sectors
+        size = (last_lba + 1 + padding_sectors + 33) * self.sector_size
+        if size != self.size:
+            self.resize(size)
+        return size
+
+    def validate(self, alignment: Optional[AlignmentPolicy] = None) -> List[Problem]:
+        """Check the staged partition table for overlaps, bounds and duplicate GUIDs
+
+        Args:
+            alignment: AlignmentPolicy to also check partition alignment against
+        Returns:
+            list of Problem, empty if the table is valid
+        """
+
+        return validate.validate_disk(self, alignment)
+
+    def verify(self, workers: Optional[int] = None) -> List[Mismatch]:
+        """Read back the blocks recorded in the write log and check their digests
+
+        Args:
+            workers: number of threads, one partition each (default CPU count)
+        Returns:
+            list of Mismatch LBA ranges in LBA order, empty if every block matches
+        Raises:
+            DiskReadError if the disk has no write log
+        """
+
+        if self.write_log is None:
+            raise DiskReadError(f"no writes recorded for disk: {self.name}")
+        return verify.verify_disk(self, self.write_log, workers)
+
+    def mapped_extents(self, partitions_only: bool = False) -> List[extents.Extent]:
+        """Find the byte extents of the image that hold data
+
+        The GPT metadata at the start and end of the disk are always mapped. Every
+        other extent that is not a hole in the image file is mapped, including data
+        outside of the partitions such as a bootloader in the gap after the
+        metadata.
+
+        Args:
+            partitions_only: only map the data extents within each partition, space
+                outside of the partitions is dropped
+        Returns:
+            sorted list of (start, end) byte extents
+        """
+
+        mapped = [
+            (0, self.geometry.first_usable_lba * self.sector_size),
+            (self.geometry.alternate_array_byte, self.size),
+        ]
+        with self.storage(writable=False) as storage:
+            if not partitions_only:
+                mapped.extend(storage.data_extents(0, self.size))
+                return extents.merge(mapped)
+            for part in self.table.partitions.entries:
+                mapped.extend(
+                    storage.data_extents(
+                        part.first_lba * self.sector_size,
+                        (part.last_lba + 1) * self.sector_size,
+                    )
+                )
+        return extents.merge(mapped)
+
+    def export_sparse(
+        self, dest: str, block_size: int = 4096, partitions_only: bool = False
+    ) -> int:
+        """Write the image in the Android sparse (simg) format
+
+        Args:
+            dest: path of the sparse image to create
+            block_size: sparse image block size in bytes
+            partitions_only: drop data outside of the partitions and GPT metadata
+        Returns:
+            integer count of chunks written
         """
 
-        # if partitions have been moved or resized,
-        # then their data needs to be shifted within the disk
-        self.table.partitions.commit(self)
-        self.table.update()
-        with open(self.image_path, "r+b") as f:
-            # write MBR
-            f.seek(0)
-            f.write(self.table.protective_mbr.marshal())
+        return sparse.export_sparse(
+            self,
+            dest,
+            block_size,
+            self.progress,
+            self.bandwidth_limit,
+            partitions_only,
+        )
+
+    def export(
+        self,
+        dest: str,
+        compression: str = "xz",
+        threads: Optional[int] = None,
+        block_size: int = compress.BLOCK_SIZE,
+        partitions_only: bool = False,
+    ) -> int:
+        """Write a compressed copy of the image
+
+        Blocks of the image are compressed in parallel as independent streams that
+        standard gzip, xz and bzip2 tools decompress as one file.
 
-            # write primary header
-            f.seek(self.geometry.primary_header_byte)
-            f.write(self.table.primary_header.marshal())
+        Args:
+            dest: path of the compressed image to create
+            compression: compression type, "xz", "gz" or "bz2"
+            threads: number of compression processes (default CPU count)
+            block_size: uncompressed size of each independently compressed block
+            partitions_only: write zeros for data outside of the partitions and GPT
+                metadata
+        Returns:
+            integer count of compressed bytes written
+        """
 
-            # write primary partition table
-            f.seek(self.geometry.primary_array_byte)
-            f.write(self.table.partitions.marshal())
+        return compress.export(
+            self,
+            dest,
+            compression,
+            threads,
+            block_size,
+            self.progress,
+            self.bandwidth_limit,
+            partitions_only,
+        )
 
-            # move to secondary header location and write
-            f.seek(self.geometry.alternate_header_byte)
-            f.write(self.table.secondary_header.marshal())
+    def write_bmap(
+        self, path: str, block_size: int = 4096, partitions_only: bool = False
+    ) -> int:
+        """Write a bmap file for flashing only the mapped blocks of the image
+
+        Args:
+            path: path of the bmap file to create
+            block_size: bmap block size in bytes
+            partitions_only: drop data outside of the partitions and GPT metadata
+        Returns:
+            integer count of mapped blocks
+        """
+
+        return bmap.write_bmap(self, path, block_size, partitions_only)
+
+    def flash(self, dest: str, bmap_path: str) -> int:
+        """Copy the ranges mapped by a bmap file to a device or file
+
+        Args:
+            dest: path of the destination device or file
+            bmap_path: path of a bmap file created with write_bmap
+        Returns:
+            integer count of bytes written
+        """
+
+        with self.storage(writable=False) as storage:
+            return bmap.flash(
+                str(self.image_path),
+                dest,
+                bmap_path,
+                self.progress,
+                self.bandwidth_limit,
+                storage,
+            )
+
+    def flash_many(
+        self, targets: List[str], verify: bool = True, partitions_only: bool = False
+    ) -> List[FlashResult]:
+        """Write the image to many devices or files at once
+
+        Each mapped chunk of the image is read once and written to every target
+        in parallel. Holes in the image file are skipped.
+
+        Args:
+            targets: paths of the target devices or files
+            verify: read every target back and compare it with the image
+            partitions_only: drop data outside of the partitions and GPT metadata
+        Returns:
+            list of FlashResult, in the order of the targets; a target that could
+                not be written or verified has an error
+        """
+
+        return flash.flash_many(
+            self,
+            targets,
+            verify,
+            progress=self.progress,
+            bandwidth_limit=self.bandwidth_limit,
+            partitions_only=partitions_only,
+        )
+
+    def hash_partitions(
+        self,
+        algorithm: str = "sha256",
+        workers: Optional[int] = None,
+        merkle: bool = False,
+        block_size: int = 4096,
+        cache: Optional[MetadataCache] = None,
+    ) -> List[hashing.PartitionDigest]:
+        """Hash the content of every partition
+
+        Partitions are streamed in chunks and hashed in parallel. With merkle set, a
+        dm-verity style hash tree is built for each partition, which allows corrupted
+        blocks to be located without rehashing the whole partition.
+
+        Args:
+            algorithm: hashlib algorithm name
+            workers: number of hashing threads (default CPU count)
+            merkle: also build a MerkleTree over the blocks of each partition
+            block_size: MerkleTree block size in bytes
+            cache: MetadataCache holding the digests of unchanged partitions
+        Returns:
+            list of PartitionDigest in partition entry order
+        """
+
+        return hashing.hash_partitions(
+            self, algorithm, workers, merkle, block_size, cache
+        )
+
+    def diff(
+        self, base: "Disk", patch_path: str, block_size: int = 4096
+    ) -> List[extents.Extent]:
+        """Write a delta patch that turns a base image into this image
+
+        Apply the patch to a copy of the base image with gpt_image.delta.apply,
+        which refuses targets that do not hold the base bytes the patch replaces.
+
+        Args:
+            base: GPT Disk instance of the base image
+            patch_path: path of the patch file to create
+            block_size: comparison block size in bytes
+        Returns:
+            list of (start, end) byte ranges stored in the patch
+        """
+
+        return delta.diff(base, self, patch_path, block_size)
+
+    @staticmethod
+    def import_sparse(src: str, image_path: str) -> "Disk":
+        """Expand an Android sparse (simg) image and open it
+
+        Sparse images hold whole blocks, so an image whose size is not a multiple of
+        the block size was padded with zeros; the padding is trimmed off after the
+        backup GPT header given by the primary header.
+
+        Args:
+            src: path of the sparse image
+            image_path: path of the raw image to create
+        Returns:
+            the opened Disk instance
+        """
 
-            # write secondary partition table
-            f.seek(self.geometry.alternate_array_byte)
-            f.write(self.table.partitions.marshal())
+        size = sparse.import_sparse(src, image_path)
+        geometry = Geometry(size)
+        with open(image_path, "r+b") as f:
+            f.seek(geometry.primary_header_byte)
+            try:
+                Header.unmarshal(f.read(geometry.header_length), geometry)
+            except (HeaderReadError, struct.error):
+                # not a GPT image, left for open to report
+                return Disk.open(image_path)
+            end = (geometry.alternate_lba + 1) * geometry.sector_size
+            f.seek(end)
+            if end < size and not f.read(size - end).strip(b"\x00"):
+                f.truncate(end)
+        return Disk.open(image_path)
@@ -0,0 +1,201 @@
+"""
+Helpers for working with byte extents of a disk image
+
+Extents are represented as half-open ``(start, end)`` byte tuples.
+"""
+import ctypes
+import errno
+import functools
+import os
+from typing import Any, Iterable, List, Optional, Tuple
+
+Extent = Tuple[int, int]
+
+# fallocate modes, from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+# zeros written at a time when a range cannot be deallocated
+ZERO_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def merge(extents: Iterable[Extent]) -> List[Extent]:
+    """Sort extents and merge the ones that overlap or touch
+
+    Args:
+        extents: iterable of (start, end) byte tuples
+    Returns:
+        sorted list of non-overlapping extents
+    """
+
+    merged: List[Extent] = []
+    for start, end in sorted(e for e in extents if e[1] > e[0]):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract(extents: Iterable[Extent], removed: Iterable[Extent]) -> List[Extent]:
+    """Remove extents from other extents
+
+    Args:
+        extents: iterable of (start, end) byte tuples
+        removed: iterable of (start, end) byte tuples to remove
+    Returns:
+        sorted list of the parts of extents not covered by removed
+    """
+
+    removed = merge(removed)
+    result: List[Extent] = []
+    for start, end in merge(extents):
+        for r_start, r_end in removed:
+            if r_end <= start or r_start >= end:
+                continue
+            if r_start > start:
+                result.append((start, r_start))
+            start = max(start, r_end)
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def align(extents: Iterable[Extent], block_size: int, limit: int) -> List[Extent]:
+    """Widen extents to block boundaries
+
+    Args:
+        extents: iterable of (start, end) byte tuples
+        block_size: block size in bytes
+        limit: the aligned end is clamped to this byte (typically the image size)
+    Returns:
+        sorted, merged list of block aligned extents
+    """
+
+    return merge(
+        (
+            start - start % block_size,
+            min(limit, -(-end // block_size) * block_size),
+        )
+        for start, end in extents
+    )
+
+
+def data_extents(fd: int, start: int, end: int) -> List[Extent]:
+    """Find the allocated (non-hole) extents of a file within a byte range
+
+    Uses SEEK_DATA and SEEK_HOLE where the platform and filesystem support them.
+    If they are not supported, the entire range is reported as data.
+
+    Args:
+        fd: open file descriptor
+        start: first byte of the range
+        end: byte after the last byte of the range
+    Returns:
+        list of (start, end) extents that contain data
+    """
+
+    if start >= end:
+        return []
+    if not hasattr(os, "SEEK_DATA"):
+        return [(start, end)]
+    extents: List[Extent] = []
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO means there is no data past the offset
+            if e.errno == errno.ENXIO:
+                break
+            return [(start, end)]
+        if data >= end:
+            break
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        extents.append((data, hole))
+        offset = hole
+    return extents
+
+
+@functools.lru_cache(maxsize=None)
+def _fallocate() -> Optional[Any]:
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (AttributeError, OSError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return fallocate
+
+
+def _allocate(fd: int, mode: int, start: int, end: int) -> bool:
+    fallocate = _fallocate()
+    if fallocate is None or start >= end:
+        return fallocate is not None
+    if fallocate(fd, mode, start, end - start) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL, errno.ENODEV):
+        return False
+    raise OSError(error, os.strerror(error))
+
+
+def punch_hole(fd: int, start: int, end: int) -> bool:
+    """Deallocate a byte range of a file, keeping its size
+
+    The range reads back as zeros.
+
+    Args:
+        fd: open file descriptor, writable
+        start: first byte of the range
+        end: byte after the last byte of the range
+    Returns:
+        True if the range was deallocated, False if the platform or filesystem
+            does not support it
+    """
+
+    return _allocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, start, end)
+
+
+def zero_range(fd: int, start: int, end: int) -> bool:
+    """Zero a byte range of a file without writing the zeros
+
+    Args:
+        fd: open file descriptor, writable
+        start: first byte of the range
+        end: byte after the last byte of the range
+    Returns:
+        True if the range was zeroed, False if the platform or filesystem does not
+            support it
+    """
+
+    return _allocate(fd, FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE, start, end)
+
+
+def deallocate(fd: int, start: int, end: int) -> bool:
+    """Zero a byte range of a file by punching a hole or zeroing the range
+
+    Args:
+        fd: open file descriptor, writable
+        start: first byte of the range
+        end: byte after the last byte of the range
+    Returns:
+        True if the range was zeroed, False if neither is supported
+    """
+
+    return punch_hole(fd, start, end) or zero_range(fd, start, end)
+
+
+def zero(fd: int, start: int, end: int) -> None:
+    """Zero a byte range of a file, writing zeros only if it cannot be deallocated
+
+    Args:
+        fd: open file descriptor, writable
+        start: first byte of the range
+        end: byte after the last byte of the range
+    """
+
+    if deallocate(fd, start, end):
+        return
+    zeros = memoryview(bytes(min(ZERO_CHUNK_SIZE, end - start)))
+    while start < end:
+        start += os.pwrite(fd, zeros[: end - start], start)
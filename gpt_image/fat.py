@@ -0,0 +1,549 @@
+"""
+FAT32 filesystem builder for EFI system partitions
+
+A directory tree is laid out as a FAT32 filesystem in memory first: the boot
+sectors, both FAT copies and every directory table are computed, and each file
+and directory is given a contiguous run of clusters. The filesystem is then
+written to the partition in one sequential pass, streaming the file contents
+from the source tree, without a temporary image or external tools. Only the
+clusters that are used are written; free clusters keep their old content.
+
+Names that are not valid upper case 8.3 names get long file name (LFN) entries
+and a generated short name with a numeric tail, such as "LONGFI~1.TXT".
+
+Format reference:
+Microsoft Extensible Firmware Initiative FAT32 File System Specification (fatgen103)
+
+"""
+from __future__ import annotations
+
+import array
+import os
+import stat
+import struct
+import sys
+import time
+import uuid
+from typing import TYPE_CHECKING, Iterator, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.disk import Disk
+    from gpt_image.partition import Partition
+
+from gpt_image import instrument, move, transfer
+
+
+class FatError(Exception):
+    """Error laying out or writing a FAT filesystem"""
+
+
+RESERVED_SECTORS = 32
+FAT_COUNT = 2
+# cluster counts that make a volume FAT32
+MIN_CLUSTERS = 65525
+MAX_CLUSTERS = 0x0FFFFFF5
+END_OF_CHAIN = 0x0FFFFFFF
+MEDIA = 0xF8
+ROOT_CLUSTER = 2
+MAX_DIRECTORY_ENTRIES = 65536
+NO_LABEL = "NO NAME"
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+
+_FSINFO_SECTOR = 1
+_BACKUP_BOOT_SECTOR = 6
+# largest volume for each default cluster size, from the specification
+_CLUSTER_SIZES = [
+    (260 * 1024 * 1024, 512),
+    (8 * 1024 * 1024 * 1024, 4096),
+    (16 * 1024 * 1024 * 1024, 8192),
+    (32 * 1024 * 1024 * 1024, 16384),
+]
+_MAX_CLUSTER_SIZE = 32768
+
+_BOOT_FORMAT = struct.Struct("<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s")
+_FSINFO_FORMAT = struct.Struct("<I480sIII12sI")
+_ENTRY_FORMAT = struct.Struct("<11sBBBHHHHHHHI")
+_LFN_FORMAT = struct.Struct("<B10sBBB12sH4s")
+_LFN_CHARS = 13
+
+# characters allowed in short names besides upper case letters and digits
+_SHORT_CHARS = set("$%'-_@~`!(){}^#&")
+_INVALID_CHARS = set('"*/:<>?\\|')
+
+
+def _dos_time(mtime: float) -> Tuple[int, int]:
+    """Convert a timestamp to the FAT time and date fields"""
+
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    if t.tm_year > 2107:
+        return (23 << 11) | (59 << 5) | 29, (127 << 9) | (12 << 5) | 31
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+def _checksum(short_name: bytes) -> int:
+    """Checksum of a short name, stored in its long name entries"""
+
+    total = 0
+    for c in short_name:
+        total = (((total & 1) << 7) + (total >> 1) + c) & 0xFF
+    return total
+
+
+def _short_char(c: str) -> bool:
+    return c.isascii() and (c.isupper() or c.isdigit() or c in _SHORT_CHARS)
+
+
+def _basis_name(name: str) -> Tuple[str, bool]:
+    """Form the short name of a long name
+
+    Returns:
+        tuple of the 11 character short name and whether it needs a numeric
+        tail because characters were dropped or replaced
+    """
+
+    upper = name.upper().replace(" ", "").lstrip(".")
+    base, dot, ext = upper.rpartition(".")
+    if not dot:
+        base, ext = ext, ""
+    lossy = upper != name.upper() or "." in base or len(base) > 8 or len(ext) > 3
+    base = base.replace(".", "")
+    if not all(_short_char(c) for c in base + ext):
+        lossy = True
+        base = "".join(c if _short_char(c) else "_" for c in base)
+        ext = "".join(c if _short_char(c) else "_" for c in ext)
+    return (base[:8] or "_").ljust(8) + ext[:3].ljust(3), lossy
+
+
+def _check_label(label: str) -> bytes:
+    if len(label) > 11 or not all(_short_char(c) or c == " " for c in label):
+        raise FatError(f"invalid volume label: {label!r}")
+    return label.ljust(11).encode("ascii")
+
+
+class _Node:
+    """File or directory of the source tree"""
+
+    def __init__(self, name: str, path: str, st: os.stat_result, children: Optional[List[_Node]]):
+        self.name = name
+        self.path = path
+        self.size = st.st_size if children is None else 0
+        self.mtime = st.st_mtime
+        self.children = children
+        self.parent: Optional[_Node] = None
+        self.short_name = b""
+        self.long_name = False
+        self.cluster = 0
+        self.clusters = 0
+
+    @property
+    def is_dir(self) -> bool:
+        return self.children is not None
+
+    def entries(self) -> int:
+        """Count the directory entries of the node in its parent"""
+
+        if not self.long_name:
+            return 1
+        return 1 + -(-len(self.name.encode("utf-16-le")) // (2 * _LFN_CHARS))
+
+
+def _scan(path: str) -> List[_Node]:
+    """Read a source directory, following symbolic links"""
+
+    nodes: List[_Node] = []
+    folded: Set[str] = set()
+    with os.scandir(path) as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            name = entry.name
+            if (
+                name.rstrip(" .") != name
+                or any(c in _INVALID_CHARS or ord(c) < 0x20 for c in name)
+                or len(name.encode("utf-16-le")) > 2 * 255
+            ):
+                raise FatError(f"invalid FAT file name: {entry.path}")
+            if name.upper() in folded:
+                raise FatError(f"file names differ only by case: {entry.path}")
+            folded.add(name.upper())
+            st = entry.stat()
+            if stat.S_ISDIR(st.st_mode):
+                nodes.append(_Node(name, entry.path, st, _scan(entry.path)))
+            elif stat.S_ISREG(st.st_mode):
+                if st.st_size > 0xFFFFFFFF:
+                    raise FatError(f"file too large for FAT32: {entry.path}")
+                nodes.append(_Node(name, entry.path, st, None))
+            else:
+                raise FatError(f"unsupported file type: {entry.path}")
+    _short_names(nodes)
+    return nodes
+
+
+def _short_names(nodes: List[_Node]) -> None:
+    """Give the nodes of one directory unique short names"""
+
+    used: Set[str] = set()
+    tailed: List[Tuple[_Node, str]] = []
+    for node in nodes:
+        short, lossy = _basis_name(node.name)
+        node.long_name = node.name != short[:8].rstrip() + (
+            "." + short[8:].rstrip() if short[8:].strip() else ""
+        )
+        if lossy:
+            tailed.append((node, short))
+        else:
+            node.short_name = short.encode("ascii")
+            used.add(short)
+    for node, short in tailed:
+        base = short[:8].rstrip()
+        for n in range(1, 1000000):
+            tail = f"~{n}"
+            candidate = (base[: 8 - len(tail)] + tail).ljust(8) + short[8:]
+            if candidate not in used:
+                break
+        else:
+            raise FatError(f"no short name left for: {node.path}")
+        node.short_name = candidate.encode("ascii")
+        used.add(candidate)
+
+
+def _entry(short_name: bytes, attr: int, cluster: int, size: int, mtime: float) -> bytes:
+    time_, date = _dos_time(mtime)
+    return _ENTRY_FORMAT.pack(
+        short_name, attr, 0, 0, time_, date, date, cluster >> 16, time_, date, cluster & 0xFFFF, size
+    )
+
+
+def _long_entries(name: str, short_name: bytes) -> bytes:
+    """Long name entries of a name, in the order they are stored"""
+
+    units = name.encode("utf-16-le")
+    if len(units) % (2 * _LFN_CHARS):
+        units += b"\0\0"
+    count = -(-len(units) // (2 * _LFN_CHARS))
+    units = units.ljust(count * 2 * _LFN_CHARS, b"\xff")
+    checksum = _checksum(short_name)
+    entries = []
+    for i in range(count):
+        part = units[i * 2 * _LFN_CHARS : (i + 1) * 2 * _LFN_CHARS]
+        order = (i + 1) | (0x40 if i == count - 1 else 0)
+        entries.append(
+            _LFN_FORMAT.pack(
+                order, part[:10], ATTR_LONG_NAME, 0, checksum, part[10:22], 0, part[22:]
+            )
+        )
+    return b"".join(reversed(entries))
+
+
+def _geometry(sectors: int, sector_size: int, cluster_size: int) -> Tuple[int, int]:
+    """Size the FATs of a volume
+
+    Returns:
+        tuple of the sectors of each FAT and the count of data clusters
+    """
+
+    per_cluster = cluster_size // sector_size
+    fat_sectors = 1
+    while True:
+        data_sectors = sectors - RESERVED_SECTORS - FAT_COUNT * fat_sectors
+        clusters = min(max(data_sectors // per_cluster, 0), MAX_CLUSTERS)
+        needed = -(-(clusters + 2) * 4 // sector_size)
+        if needed <= fat_sectors:
+            return fat_sectors, clusters
+        fat_sectors = needed
+
+
+class Layout:
+    """FAT32 layout of a directory tree
+
+    Attributes:
+        sector_size: integer bytes per sector
+        cluster_size: integer bytes per cluster
+        sectors: integer count of sectors of the volume
+        fat_sectors: integer count of sectors of each FAT
+        clusters: integer count of data clusters of the volume
+        used_clusters: integer count of clusters holding files and directories
+        size: integer count of bytes from the start of the volume to the end of
+            the last used cluster, the bytes written
+
+    Args:
+        source: path of the directory to copy into the filesystem
+        size: volume size in bytes
+        sector_size: bytes per sector
+        cluster_size: bytes per cluster, picked from the volume size if not set
+        label: volume label, up to 11 upper case characters
+        volume_id: 32 bit volume serial number
+        hidden_sectors: sectors before the volume, the first LBA of its partition
+    Raises:
+        FatError if the volume is too small for FAT32 or the files do not fit
+    """
+
+    def __init__(
+        self,
+        source: str,
+        size: int,
+        sector_size: int = 512,
+        cluster_size: Optional[int] = None,
+        label: str = NO_LABEL,
+        volume_id: int = 0,
+        hidden_sectors: int = 0,
+    ):
+        self.sector_size = sector_size
+        self.sectors = min(size // sector_size, 0xFFFFFFFF)
+        self.label = _check_label(label or NO_LABEL)
+        self.volume_id = volume_id & 0xFFFFFFFF
+        self.hidden_sectors = hidden_sectors & 0xFFFFFFFF
+
+        if cluster_size is None:
+            cluster_size = max(
+                next((c for limit, c in _CLUSTER_SIZES if size <= limit), _MAX_CLUSTER_SIZE),
+                sector_size,
+            )
+            # small volumes need small clusters to have enough of them for FAT32
+            while (
+                cluster_size > sector_size
+                and _geometry(self.sectors, sector_size, cluster_size)[1] < MIN_CLUSTERS
+            ):
+                cluster_size //= 2
+        if (
+            cluster_size < sector_size
+            or cluster_size > _MAX_CLUSTER_SIZE
+            or cluster_size % sector_size
+            or cluster_size & (cluster_size - 1)
+        ):
+            raise FatError(f"invalid cluster size: {cluster_size}")
+        self.cluster_size = cluster_size
+        self.fat_sectors, self.clusters = _geometry(self.sectors, sector_size, cluster_size)
+        if self.clusters < MIN_CLUSTERS:
+            raise FatError(f"volume too small for FAT32: {size} bytes")
+
+        st = os.stat(source)
+        if not stat.S_ISDIR(st.st_mode):
+            raise FatError(f"not a directory: {source}")
+        self._root = _Node("", source, st, _scan(source))
+        # files and directories in cluster order
+        self._order: List[_Node] = []
+        self._next_cluster = ROOT_CLUSTER
+        self._allocate(self._root)
+        self._walk(self._root)
+        self.used_clusters = sum(node.clusters for node in self._order)
+        if self.used_clusters > self.clusters:
+            raise FatError(
+                f"files do not fit: {self.used_clusters} clusters needed, "
+                f"{self.clusters} available"
+            )
+        self.size = (
+            RESERVED_SECTORS + FAT_COUNT * self.fat_sectors
+        ) * sector_size + self.used_clusters * cluster_size
+
+    def _allocate(self, node: _Node) -> None:
+        if node.is_dir:
+            assert node.children is not None
+            entries = sum(child.entries() for child in node.children)
+            # the root holds the volume label, other directories "." and ".."
+            entries += self._has_label if node is self._root else 2
+            if entries > MAX_DIRECTORY_ENTRIES:
+                raise FatError(f"too many files in directory: {node.path}")
+            node.clusters = max(1, -(-entries * _ENTRY_FORMAT.size // self.cluster_size))
+        else:
+            node.clusters = -(-node.size // self.cluster_size)
+        if node.clusters:
+            node.cluster = self._next_cluster
+            self._next_cluster += node.clusters
+            self._order.append(node)
+
+    def _walk(self, directory: _Node) -> None:
+        """Allocate the children of a directory, then its subdirectories"""
+
+        assert directory.children is not None
+        for child in directory.children:
+            child.parent = directory
+            self._allocate(child)
+        for child in directory.children:
+            if child.is_dir:
+                self._walk(child)
+
+    @property
+    def _has_label(self) -> bool:
+        return self.label != _check_label(NO_LABEL)
+
+    def _directory(self, node: _Node) -> bytes:
+        """Marshal the table of a directory, padded to its clusters"""
+
+        assert node.children is not None
+        table = bytearray()
+        parent = node.parent
+        if parent is None:
+            if self._has_label:
+                table += _entry(self.label, ATTR_VOLUME_ID, 0, 0, node.mtime)
+        else:
+            # ".." of a directory in the root points to cluster 0
+            up = 0 if parent is self._root else parent.cluster
+            table += _entry(b".".ljust(11), ATTR_DIRECTORY, node.cluster, 0, node.mtime)
+            table += _entry(b"..".ljust(11), ATTR_DIRECTORY, up, 0, parent.mtime)
+        for child in node.children:
+            if child.long_name:
+                table += _long_entries(child.name, child.short_name)
+            attr = ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE
+            table += _entry(child.short_name, attr, child.cluster, child.size, child.mtime)
+        return bytes(table.ljust(node.clusters * self.cluster_size, b"\0"))
+
+    def _file(self, node: _Node) -> Iterator[bytes]:
+        """Stream the content of a file, padded to its clusters"""
+
+        size = 0
+        with open(node.path, "rb") as f:
+            while size < node.size:
+                data = f.read(min(move.CHUNK_SIZE, node.size - size))
+                if not data:
+                    break
+                size += len(data)
+                yield data
+        if size != node.size:
+            raise FatError(f"file changed while writing: {node.path}")
+        padding = node.clusters * self.cluster_size - size
+        if padding:
+            yield bytes(padding)
+
+    def _reserved(self) -> bytes:
+        """Marshal the reserved sectors: boot sector, FSInfo and their backups"""
+
+        boot = bytearray(self.sector_size)
+        boot[: _BOOT_FORMAT.size] = _BOOT_FORMAT.pack(
+            b"\xeb\x58\x90",
+            b"MSWIN4.1",
+            self.sector_size,
+            self.cluster_size // self.sector_size,
+            RESERVED_SECTORS,
+            FAT_COUNT,
+            0,
+            0,
+            MEDIA,
+            0,
+            63,
+            255,
+            self.hidden_sectors,
+            self.sectors,
+            self.fat_sectors,
+            0,
+            0,
+            ROOT_CLUSTER,
+            _FSINFO_SECTOR,
+            _BACKUP_BOOT_SECTOR,
+            bytes(12),
+            0x80,
+            0,
+            0x29,
+            self.volume_id,
+            self.label,
+            b"FAT32   ",
+        )
+        boot[510:512] = b"\x55\xaa"
+        fsinfo = _FSINFO_FORMAT.pack(
+            0x41615252,
+            bytes(480),
+            0x61417272,
+            self.clusters - self.used_clusters,
+            ROOT_CLUSTER + self.used_clusters,
+            bytes(12),
+            0xAA550000,
+        ).ljust(self.sector_size, b"\0")
+        reserved = bytearray(RESERVED_SECTORS * self.sector_size)
+        for first in (0, _BACKUP_BOOT_SECTOR):
+            for sector, data in ((first, boot), (first + _FSINFO_SECTOR, fsinfo)):
+                reserved[sector * self.sector_size : (sector + 1) * self.sector_size] = data
+        return bytes(reserved)
+
+    def _fat(self) -> bytes:
+        """Marshal a FAT chaining the clusters of every file and directory"""
+
+        fat = array.array("I", bytes(self.fat_sectors * self.sector_size))
+        fat[0] = 0x0FFFFF00 | MEDIA
+        fat[1] = END_OF_CHAIN
+        for node in self._order:
+            end = node.cluster + node.clusters
+            fat[node.cluster : end - 1] = array.array("I", range(node.cluster + 1, end))
+            fat[end - 1] = END_OF_CHAIN
+        if sys.byteorder != "little":
+            fat.byteswap()
+        return fat.tobytes()
+
+    def chunks(self) -> Iterator[bytes]:
+        """Generate the bytes of the filesystem in order, up to the last used cluster"""
+
+        yield self._reserved()
+        fat = self._fat()
+        for _ in range(FAT_COUNT):
+            yield fat
+        for node in self._order:
+            if node.is_dir:
+                yield self._directory(node)
+            else:
+                yield from self._file(node)
+
+
+def format_partition(
+    disk: Disk,
+    partition: Partition,
+    source: str,
+    label: str = NO_LABEL,
+    cluster_size: Optional[int] = None,
+    volume_id: Optional[int] = None,
+) -> Layout:
+    """Format a partition as FAT32 and copy a directory tree into it
+
+    The layout is computed first, so nothing is written if the files do not fit.
+    The progress of the write is reported to disk.progress and limited to
+    disk.bandwidth_limit.
+
+    Args:
+        disk: GPT Disk instance
+        partition: Partition to format, such as an EFI system partition
+        source: path of the directory to copy into the filesystem
+        label: volume label, up to 11 upper case characters
+        cluster_size: bytes per cluster, picked from the partition size if not set
+        volume_id: 32 bit volume serial number, taken from the partition GUID if
+            not set so that builds are reproducible
+    Returns:
+        Layout of the filesystem written
+    Raises:
+        FatError if the partition is too small or the files cannot be copied
+    """
+
+    if volume_id is None:
+        volume_id = uuid.UUID(partition.partition_guid).int
+    layout = Layout(
+        str(source),
+        partition.size,
+        disk.sector_size,
+        cluster_size,
+        label,
+        volume_id,
+        partition.first_lba,
+    )
+    offset = partition.first_lba * disk.sector_size
+    progress = transfer.start(layout.size, disk.progress, disk.bandwidth_limit)
+    buffer = bytearray()
+    with instrument.span("partition.format_fat32"), disk.storage() as storage:
+        # small directory tables and files are coalesced into large writes
+        for data in layout.chunks():
+            buffer += data
+            if len(buffer) < move.CHUNK_SIZE:
+                continue
+            offset += storage.pwrite(bytes(buffer), offset)
+            if progress is not None:
+                progress.update(len(buffer))
+            buffer.clear()
+        if buffer:
+            storage.pwrite(bytes(buffer), offset)
+            if progress is not None:
+                progress.update(len(buffer))
+        storage.sync()
+    return layout
@@ -0,0 +1,188 @@
+"""
+Fan-out flashing of one image to many devices
+
+The mapped extents of the image are read once, chunk by chunk, and each chunk is
+handed to one writer thread per target through a bounded queue. The reader waits
+whenever the queue of the slowest target is full, so memory use is bounded by the
+queue depth whatever the number and speed of the targets. Holes and space that is
+not used by the GPT are neither read nor written.
+
+Digests of the data are taken as it is read. Once a target is written and synced,
+its writer reads the written ranges back and compares them with the digests, see
+the verify module. A target that fails is reported without stopping the others.
+
+"""
+from __future__ import annotations
+
+import os
+import queue
+import threading
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from gpt_image import backend, transfer, verify
+from gpt_image.verify import WriteLog
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.disk import Disk
+
+# bytes read from the image at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+# chunks queued for each target
+QUEUE_DEPTH = 8
+
+
+class FlashError(Exception):
+    """Error writing or verifying a flash target"""
+
+
+class FlashResult:
+    """Outcome of flashing one target
+
+    Attributes:
+        target: path of the target device or file
+        bytes_written: integer count of bytes written
+        error: string description of the failure, None if the target was written
+            and verified
+        mismatches: list of verify.Mismatch ranges that did not read back as
+            written
+    """
+
+    def __init__(self, target: str):
+        self.target = target
+        self.bytes_written = 0
+        self.error: Optional[str] = None
+        self.mismatches: List[verify.Mismatch] = []
+
+    def __repr__(self) -> str:
+        return (
+            f"FlashResult(target={self.target!r}, bytes_written={self.bytes_written}, "
+            f"error={self.error!r})"
+        )
+
+
+def _open_target(target: str, size: int) -> backend.Backend:
+    """Open a target, sizing regular files to the image"""
+
+    if not os.path.exists(target):
+        open(target, "wb").close()
+    storage = backend.open_backend(target)
+    try:
+        if isinstance(storage, backend.BlockDeviceBackend):
+            if storage.size() < size:
+                raise FlashError(f"device is smaller than the image: {storage.size()}")
+        else:
+            # unmapped ranges of a regular file read back as zeros
+            storage.truncate(0)
+            storage.truncate(size)
+    except BaseException:
+        storage.close()
+        raise
+    return storage
+
+
+class _Writer(threading.Thread):
+    """Thread writing the queued chunks to one target, then verifying them"""
+
+    def __init__(self, target: str, disk: Disk, log: Optional[verify.WriteLog]):
+        super().__init__(name=f"flash {target}", daemon=True)
+        self.result = FlashResult(target)
+        self.queue: "queue.Queue[Optional[Tuple[int, bytes]]]" = queue.Queue(QUEUE_DEPTH)
+        self._disk = disk
+        self._log = log
+
+    def run(self) -> None:
+        # any error is recorded in the result: the thread must keep draining the
+        # queue, or the reader would block on a full queue forever
+        storage: Optional[backend.Backend] = None
+        try:
+            storage = _open_target(self.result.target, self._disk.size)
+        except Exception as e:
+            self.result.error = f"unable to open target: {e}"
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if storage is None or self.result.error is not None:
+                # keep draining so the reader is never blocked by a failed target
+                continue
+            offset, data = item
+            try:
+                self.result.bytes_written += storage.pwrite(data, offset)
+            except Exception as e:
+                self.result.error = f"write failed at byte {offset}: {e}"
+        if storage is None:
+            return
+        try:
+            if self.result.error is None:
+                storage.sync()
+        except Exception as e:
+            self.result.error = f"sync failed: {e}"
+        try:
+            if self.result.error is None and self._log is not None:
+                self._check(storage, self._log)
+        except Exception as e:
+            self.result.error = f"verification failed: {e}"
+        finally:
+            storage.close()
+
+    def _check(self, storage: backend.Backend, log: verify.WriteLog) -> None:
+        self.result.mismatches = verify.verify_disk(self._disk, log, storage=storage)
+        if self.result.mismatches:
+            ranges = ", ".join(
+                f"{m.first_lba}-{m.last_lba}" for m in self.result.mismatches
+            )
+            self.result.error = f"verification failed for LBA {ranges}"
+
+
+def flash_many(
+    disk: Disk,
+    targets: List[str],
+    verify: bool = True,
+    chunk_size: int = CHUNK_SIZE,
+    progress: Optional[transfer.ProgressCallback] = None,
+    bandwidth_limit: Optional[int] = None,
+    partitions_only: bool = False,
+) -> List[FlashResult]:
+    """Write the mapped extents of an image to many targets at once
+
+    Args:
+        disk: GPT Disk instance
+        targets: paths of the target devices or files, files are created or
+            truncated to the image size
+        verify: read every target back and compare it with the image
+        chunk_size: bytes read from the image at a time
+        progress: function called with the image bytes read, total and estimated
+            seconds left
+        bandwidth_limit: most image bytes read per second
+        partitions_only: skip data outside of the partitions and GPT metadata
+    Returns:
+        list of FlashResult, in the order of the targets
+    """
+
+    mapped = disk.mapped_extents(partitions_only)
+    tracker = transfer.start(sum(e - s for s, e in mapped), progress, bandwidth_limit)
+    # the verify argument shadows the module here
+    log = WriteLog() if verify else None
+    writers = [_Writer(str(target), disk, log) for target in targets]
+    for writer in writers:
+        writer.start()
+    try:
+        with disk.storage(writable=False) as storage:
+            for start, end in mapped:
+                for offset in range(start, end, chunk_size):
+                    data = storage.pread(min(chunk_size, end - offset), offset)
+                    if not data:
+                        raise FlashError(f"unexpected end of image at byte {offset}")
+                    if log is not None:
+                        log.record(offset, data)
+                    for writer in writers:
+                        writer.queue.put((offset, data))
+                    if tracker is not None:
+                        tracker.update(len(data))
+    finally:
+        for writer in writers:
+            writer.queue.put(None)
+        for writer in writers:
+            writer.join()
+    return [writer.result for writer in writers]
+
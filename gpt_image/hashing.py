@@ -0,0 +1,317 @@
+"""
+Streaming content hashes of disk image ranges
+
+Ranges are read in chunks with positional reads, so any number of threads can hash
+ranges of the same storage backend at once.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.backend import Backend
+    from gpt_image.cache import MetadataCache
+    from gpt_image.disk import Disk
+    from gpt_image.partition import Partition
+
+# bytes read at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class HashError(Exception):
+    """Error hashing a disk image range"""
+
+
+def _read(storage: Backend, size: int, offset: int) -> bytes:
+    data = storage.pread(size, offset)
+    if not data:
+        raise HashError(f"unexpected end of image at byte {offset}")
+    return data
+
+
+def hash_range(
+    storage: Backend, start: int, end: int, algorithm: str = "sha256"
+) -> bytes:
+    """Hash a byte range of an image
+
+    Args:
+        storage: Backend of the image
+        start: first byte of the range
+        end: byte after the last byte of the range
+        algorithm: hashlib algorithm name
+    Returns:
+        digest bytes
+    Raises:
+        HashError if the image ends before the range
+    """
+
+    digest = hashlib.new(algorithm)
+    while start < end:
+        data = _read(storage, min(end - start, CHUNK_SIZE), start)
+        digest.update(data)
+        start += len(data)
+    return digest.digest()
+
+
+def _block_digests(
+    storage: Backend, start: int, end: int, block_size: int, algorithm: str, whole: Any
+) -> List[bytes]:
+    hashes: List[bytes] = []
+    chunk_size = max(block_size, CHUNK_SIZE - CHUNK_SIZE % block_size)
+    while start < end:
+        data = _read(storage, min(end - start, chunk_size), start)
+        if whole is not None:
+            whole.update(data)
+        view = memoryview(data)
+        for i in range(0, len(data), block_size):
+            hashes.append(hashlib.new(algorithm, view[i : i + block_size]).digest())
+        start += len(data)
+    return hashes
+
+
+def block_hashes(
+    storage: Backend, start: int, end: int, block_size: int, algorithm: str = "sha256"
+) -> List[bytes]:
+    """Hash each block of a byte range of an image
+
+    The last block is shorter if the range is not a multiple of the block size.
+
+    Args:
+        storage: Backend of the image
+        start: first byte of the range
+        end: byte after the last byte of the range
+        block_size: block size in bytes
+        algorithm: hashlib algorithm name
+    Returns:
+        list of digest bytes, one per block
+    Raises:
+        HashError if the image ends before the range
+    """
+
+    return _block_digests(storage, start, end, block_size, algorithm, None)
+
+
+def hash_blocks(
+    storage: Backend, start: int, end: int, block_size: int, algorithm: str = "sha256"
+) -> Tuple[bytes, List[bytes]]:
+    """Hash a byte range as a whole and block by block in a single pass
+
+    Args:
+        storage: Backend of the image
+        start: first byte of the range
+        end: byte after the last byte of the range
+        block_size: block size in bytes
+        algorithm: hashlib algorithm name
+    Returns:
+        tuple of the digest of the whole range and the list of block digests
+    Raises:
+        HashError if the image ends before the range
+    """
+
+    whole = hashlib.new(algorithm)
+    hashes = _block_digests(storage, start, end, block_size, algorithm, whole)
+    return whole.digest(), hashes
+
+
+class MerkleTree:
+    """Hash tree over the blocks of a byte range
+
+    The tree is laid out like a dm-verity hash tree. The leaves are the digests of
+    the data blocks. Each level above is built by packing the digests of the level
+    below into blocks of block_size bytes, zero padded, and hashing each block. The
+    root is the digest of the single block at the top level.
+
+    Attributes:
+        block_size: data and hash block size in bytes
+        algorithm: hashlib algorithm name
+        levels: list of digest lists, leaves first
+    """
+
+    def __init__(self, leaves: List[bytes], block_size: int, algorithm: str = "sha256"):
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.levels: List[List[bytes]] = [leaves]
+        while len(self.levels[-1]) > 1 or len(self.levels) == 1:
+            self.levels.append(self._parents(self.levels[-1]))
+
+    @property
+    def fanout(self) -> int:
+        """Number of child digests hashed into each node"""
+
+        return max(1, self.block_size // hashlib.new(self.algorithm).digest_size)
+
+    @property
+    def root(self) -> bytes:
+        return self.levels[-1][0]
+
+    def _parents(self, children: List[bytes]) -> List[bytes]:
+        fanout = self.fanout
+        return [
+            hashlib.new(
+                self.algorithm,
+                b"".join(children[i : i + fanout]).ljust(self.block_size, b"\x00"),
+            ).digest()
+            for i in range(0, max(1, len(children)), fanout)
+        ]
+
+    def diff(self, other: "MerkleTree") -> List[int]:
+        """Find the data blocks whose digests differ from another tree
+
+        Only the subtrees whose digests differ are descended into.
+
+        Args:
+            other: MerkleTree over a range of the same size and block size
+        Returns:
+            sorted list of differing block indexes
+        Raises:
+            HashError if the trees do not have the same shape
+        """
+
+        if [len(level) for level in self.levels] != [len(level) for level in other.levels]:
+            raise HashError("hash trees do not have the same shape")
+        fanout = self.fanout
+        nodes = [0]
+        for depth in range(len(self.levels) - 1, -1, -1):
+            mine, theirs = self.levels[depth], other.levels[depth]
+            nodes = [n for n in nodes if n < len(mine) and mine[n] != theirs[n]]
+            if depth:
+                nodes = [c for n in nodes for c in range(n * fanout, (n + 1) * fanout)]
+        return nodes
+
+    def verify_block(self, storage: Backend, start: int, end: int, index: int) -> bool:
+        """Verify a single data block against the tree
+
+        Only the block itself is read. Its digest is checked against the leaf, and
+        the path from the leaf to the root is checked against the stored levels.
+
+        Args:
+            storage: Backend of the image
+            start: first byte of the hashed range
+            end: byte after the last byte of the hashed range
+            index: data block index
+        Returns:
+            True if the block and its path to the root match
+        """
+
+        offset = start + index * self.block_size
+        data = storage.pread(min(self.block_size, end - offset), offset)
+        if hashlib.new(self.algorithm, data).digest() != self.levels[0][index]:
+            return False
+        fanout = self.fanout
+        for depth in range(1, len(self.levels)):
+            group = index - index % fanout
+            children = self.levels[depth - 1][group : group + fanout]
+            index //= fanout
+            parent = hashlib.new(
+                self.algorithm, b"".join(children).ljust(self.block_size, b"\x00")
+            ).digest()
+            if parent != self.levels[depth][index]:
+                return False
+        return True
+
+
+class PartitionDigest:
+    """Content digest of a partition
+
+    Attributes:
+        partition_name: string partition name
+        partition_guid: string UUID partition GUID
+        first_lba: integer LBA of partition start
+        last_lba: integer LBA of partition end
+        algorithm: hashlib algorithm name
+        digest: hex digest of the partition content
+        tree: MerkleTree over the partition blocks, or None
+    """
+
+    def __init__(
+        self,
+        partition: Partition,
+        algorithm: str,
+        digest: str,
+        tree: Optional[MerkleTree] = None,
+    ):
+        self.partition_name = partition.partition_name
+        self.partition_guid = partition.partition_guid
+        self.first_lba = partition.first_lba
+        self.last_lba = partition.last_lba
+        self.algorithm = algorithm
+        self.digest = digest
+        self.tree = tree
+
+
+def hash_partition(
+    disk: Disk,
+    partition: Partition,
+    algorithm: str = "sha256",
+    merkle: bool = False,
+    block_size: int = 4096,
+) -> PartitionDigest:
+    """Hash the content of a partition in a single streaming pass
+
+    Args:
+        disk: GPT Disk instance
+        partition: the partition to hash
+        algorithm: hashlib algorithm name
+        merkle: also build a MerkleTree over the partition blocks
+        block_size: MerkleTree block size in bytes
+    Returns:
+        PartitionDigest of the partition
+    """
+
+    start = partition.first_lba * disk.sector_size
+    end = (partition.last_lba + 1) * disk.sector_size
+    with disk.storage(writable=False) as storage:
+        if not merkle:
+            digest = hash_range(storage, start, end, algorithm)
+            return PartitionDigest(partition, algorithm, digest.hex())
+        digest, leaves = hash_blocks(storage, start, end, block_size, algorithm)
+    tree = MerkleTree(leaves, block_size, algorithm)
+    return PartitionDigest(partition, algorithm, digest.hex(), tree)
+
+
+def hash_partitions(
+    disk: Disk,
+    algorithm: str = "sha256",
+    workers: Optional[int] = None,
+    merkle: bool = False,
+    block_size: int = 4096,
+    cache: Optional[MetadataCache] = None,
+) -> List[PartitionDigest]:
+    """Hash the content of every partition of a disk in parallel
+
+    Args:
+        disk: GPT Disk instance
+        algorithm: hashlib algorithm name
+        workers: number of hashing threads (default CPU count)
+        merkle: also build a MerkleTree over the blocks of each partition
+        block_size: MerkleTree block size in bytes
+        cache: MetadataCache to read digests from and store new digests in
+    Returns:
+        list of PartitionDigest in partition entry order
+    """
+
+    image_path = str(disk.image_path)
+    if disk.backend is not None and disk.backend.path is None:
+        # an image held in memory has no file to key the cache on
+        cache = None
+    digests: List[Optional[PartitionDigest]] = [
+        cache.get_digest(image_path, part, algorithm, merkle, block_size)
+        if cache is not None
+        else None
+        for part in disk.table.partitions.entries
+    ]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {
+            i: executor.submit(hash_partition, disk, part, algorithm, merkle, block_size)
+            for i, part in enumerate(disk.table.partitions.entries)
+            if digests[i] is None
+        }
+        for i, future in futures.items():
+            digest = future.result()
+            if cache is not None:
+                cache.put_digest(image_path, digest, block_size)
+            digests[i] = digest
+    return [digest for digest in digests if digest is not None]
@@ -0,0 +1,244 @@
+"""
+Timing and I/O instrumentation of disk and partition operations
+
+Operations report a Span to every registered listener when they finish: the
+operation name, its duration, the bytes read and written, the number of I/O calls
+made to the storage backend and the number of partitions moved. Spans nest, and
+the I/O and moves of an operation are also counted in every operation enclosing
+it.
+
+Nothing is measured while no listener is registered: operations then only check
+whether the listener list is empty, and storage backends are not wrapped.
+
+Example:
+    exporter = instrument.PrometheusExporter()
+    instrument.add_listener(exporter)
+    disk.commit()
+    print(exporter.render())
+
+"""
+import contextlib
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from gpt_image import extents
+from gpt_image.backend import Backend
+
+Listener = Callable[["Span"], None]
+
+_listeners: List[Listener] = []
+# spans of the operations in progress, outermost first
+_active: ContextVar[Tuple["Span", ...]] = ContextVar("active_spans", default=())
+
+
+class Span:
+    """Measurements of one operation
+
+    Attributes:
+        operation: string operation name, such as "disk.commit"
+        seconds: wall time of the operation
+        bytes_read: integer count of bytes read from the storage backend
+        bytes_written: integer count of bytes written to the storage backend
+        syscalls: integer count of I/O calls made to the storage backend
+        partitions_moved: integer count of partitions whose data was moved
+        error: string exception of a failed operation, None if it succeeded
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.syscalls = 0
+        self.partitions_moved = 0
+        self.error: Optional[str] = None
+        # I/O is counted from the threads of the move engine
+        self._lock = threading.Lock()
+
+    def count(self, read: int = 0, written: int = 0) -> None:
+        """Count one I/O call"""
+
+        with self._lock:
+            self.bytes_read += read
+            self.bytes_written += written
+            self.syscalls += 1
+
+    def __repr__(self) -> str:
+        return (
+            f"Span(operation={self.operation!r}, seconds={self.seconds:.6f}, "
+            f"bytes_read={self.bytes_read}, bytes_written={self.bytes_written}, "
+            f"syscalls={self.syscalls}, partitions_moved={self.partitions_moved})"
+        )
+
+
+def add_listener(listener: Listener) -> None:
+    """Register a function called with the Span of every finished operation"""
+
+    _listeners.append(listener)
+
+
+def remove_listener(listener: Listener) -> None:
+    """Unregister a listener added with add_listener"""
+
+    _listeners.remove(listener)
+
+
+@contextlib.contextmanager
+def _measure(operation: str) -> Iterator[Span]:
+    span = Span(operation)
+    token = _active.set(_active.get() + (span,))
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.seconds = time.perf_counter() - started
+        _active.reset(token)
+        for listener in list(_listeners):
+            listener(span)
+
+
+def span(operation: str) -> ContextManager[Optional[Span]]:
+    """Measure an operation
+
+    Args:
+        operation: string operation name
+    Returns:
+        context manager of the Span of the operation, or of None if no listener
+            is registered
+    """
+
+    if not _listeners:
+        return contextlib.nullcontext()
+    return _measure(operation)
+
+
+def count_moves(count: int) -> None:
+    """Count partitions moved into the spans of the operations in progress"""
+
+    for span in _active.get():
+        with span._lock:
+            span.partitions_moved += count
+
+
+class CountingBackend(Backend):
+    """Backend counting the I/O of another backend into spans
+
+    Args:
+        storage: Backend to count the I/O of
+        spans: tuple of Span that each I/O call is counted in
+    """
+
+    def __init__(self, storage: Backend, spans: Tuple[Span, ...]):
+        super().__init__(storage.path, storage.preferred_io_size)
+        self.storage = storage
+        self.spans = spans
+
+    def _count(self, read: int = 0, written: int = 0) -> None:
+        for span in self.spans:
+            span.count(read, written)
+
+    def size(self) -> int:
+        return self.storage.size()
+
+    def pread(self, size: int, offset: int) -> bytes:
+        data = self.storage.pread(size, offset)
+        self._count(read=len(data))
+        return data
+
+    def pwrite(self, data: bytes, offset: int) -> int:
+        count = self.storage.pwrite(data, offset)
+        self._count(written=count)
+        return count
+
+    def truncate(self, size: int) -> None:
+        self.storage.truncate(size)
+        self._count()
+
+    def data_extents(self, start: int, end: int) -> List[extents.Extent]:
+        return self.storage.data_extents(start, end)
+
+    def deallocate(self, start: int, end: int) -> bool:
+        self._count()
+        return self.storage.deallocate(start, end)
+
+    def sync(self) -> None:
+        self.storage.sync()
+        self._count()
+
+    def close(self) -> None:
+        self.storage.close()
+
+
+def wrap(storage: Backend) -> Backend:
+    """Count the I/O of a backend into the spans of the operations in progress
+
+    Args:
+        storage: Backend of an image
+    Returns:
+        CountingBackend, or the backend itself if no operation is measured
+    """
+
+    spans = _active.get()
+    if not spans:
+        return storage
+    return CountingBackend(storage, spans)
+
+
+class PrometheusExporter:
+    """Listener aggregating spans into Prometheus counters
+
+    Register an instance with add_listener and serve the output of render on a
+    metrics endpoint, or write it to a file for the node exporter textfile
+    collector.
+    """
+
+    # metric name, help text and the span attribute summed into it
+    _METRICS = [
+        ("operations_total", "Operations finished", None),
+        ("operation_errors_total", "Operations failed", "error"),
+        ("operation_seconds_total", "Wall time spent in operations", "seconds"),
+        ("read_bytes_total", "Bytes read by operations", "bytes_read"),
+        ("written_bytes_total", "Bytes written by operations", "bytes_written"),
+        ("syscalls_total", "I/O calls made by operations", "syscalls"),
+        ("partitions_moved_total", "Partitions moved by operations", "partitions_moved"),
+    ]
+
+    def __init__(self, prefix: str = "gpt_image_"):
+        self.prefix = prefix
+        self._totals: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, span: Span) -> None:
+        with self._lock:
+            totals = self._totals.setdefault(
+                span.operation, {name: 0 for name, _, _ in self._METRICS}
+            )
+            for name, _, attribute in self._METRICS:
+                if attribute is None:
+                    totals[name] += 1
+                elif attribute == "error":
+                    totals[name] += span.error is not None
+                else:
+                    totals[name] += getattr(span, attribute)
+
+    def render(self) -> str:
+        """Render the counters in the Prometheus text exposition format"""
+
+        lines: List[str] = []
+        with self._lock:
+            for name, text, _ in self._METRICS:
+                metric = self.prefix + name
+                lines.append(f"# HELP {metric} {text}")
+                lines.append(f"# TYPE {metric} counter")
+                for operation, totals in sorted(self._totals.items()):
+                    lines.append(f'{metric}{{operation="{operation}"}} {_number(totals[name])}')
+        return "\n".join(lines) + "\n"
+
+
+def _number(value: Any) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
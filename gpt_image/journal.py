@@ -0,0 +1,504 @@
+"""
+Write-ahead journal for crash-safe commits
+
+A commit is planned before the image is touched: the partition data moves and the
+metadata writes are recorded in a journal file next to the image and synced. The
+plan is then carried out, with progress records appended as moves complete. If the
+process is interrupted, replaying the journal rolls the commit forward. A journal
+whose plan was never completely written is discarded, leaving the image as it was
+before the commit.
+
+Journal format: the first line is the plan, a JSON document with the image size,
+the new image size if the commit resizes the image, the list of [source,
+destination, length] byte moves, the list of [start, end] byte ranges freed by the
+commit and the list of [offset, hex data] metadata writes.
+Each following line is a progress record [move index, bytes done], or a save record
+{"save": [move index, bytes done, start, size]} followed by the size bytes of the
+image at start and a newline. The journal is removed once the commit is complete.
+
+Moves are copied in windows of up to CHECKPOINT_SIZE bytes, with a progress record
+after each. When a move is shorter than its distance, a window overwrites part of
+its own source; those bytes are saved in the journal first, so that an interrupted
+window can be restored and copied again. Once the window is done, the journal is
+replaced by one holding only the plan and the new progress, so saved bytes do not
+pile up.
+
+Images held in memory have no journal file; their commits are carried out directly.
+Block devices must be given a journal directory, as the journal cannot be kept next
+to the device node.
+
+"""
+import json
+import os
+import stat
+from typing import IO, List, Optional, Tuple
+
+from gpt_image import backend, extents, move, transfer
+
+# source, destination and length in bytes
+Move = Tuple[int, int, int]
+# offset and data
+Write = Tuple[int, bytes]
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_VERSION = 2
+# journal versions that can be replayed, version 1 has no save records
+_VERSIONS = (1, 2)
+# most bytes of a move copied between progress records
+CHECKPOINT_SIZE = 256 * 1024 * 1024
+# bytes saved to or restored from the journal at a time
+_SAVE_CHUNK_SIZE = 4 * 1024 * 1024
+# suffix of the journal written to replace the current one
+_REWRITE_SUFFIX = ".new"
+
+
+class JournalError(Exception):
+    """Error writing or replaying a journal"""
+
+
+def journal_path(image_path: str, directory: Optional[str] = None) -> str:
+    """Path of the journal of an image
+
+    Args:
+        image_path: path of the disk image
+        directory: directory the journal is kept in, next to the image if not set
+    Returns:
+        string path of the journal file
+    """
+
+    if directory is None:
+        return str(image_path) + JOURNAL_SUFFIX
+    return os.path.join(directory, os.path.basename(image_path) + JOURNAL_SUFFIX)
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def order_moves(moves: List[Move]) -> List[Move]:
+    """Order moves so that no move overwrites the source of a later one
+
+    Moves towards the end of the image are run from the last to the first, then
+    moves towards the start of the image from the first to the last. This is safe
+    for any set of moves between non-overlapping layouts that keep the order of the
+    moved ranges.
+
+    Args:
+        moves: list of (source, destination, length) byte moves
+    Returns:
+        ordered list of moves, without empty moves
+    """
+
+    moves = [m for m in moves if m[0] != m[1] and m[2] > 0]
+    up = sorted((m for m in moves if m[1] > m[0]), reverse=True)
+    down = sorted(m for m in moves if m[1] < m[0])
+    return up + down
+
+
+class Journal:
+    """Planned commit of an image
+
+    Attributes:
+        image_path: path of the disk image, None for an image held in memory
+        path: path of the journal file, None for an image held in memory
+        moves: ordered list of (source, destination, length) byte moves
+        writes: list of (offset, data) metadata writes, made after the moves
+        frees: list of (start, end) byte ranges deallocated after the moves
+        size: image file size in bytes, checked before the journal is replayed
+        resize: new image file size in bytes, None to keep the size. A larger image
+            is extended before the moves, a smaller one is truncated after the
+            metadata writes.
+        workers: number of threads copying each move (default CPU count)
+        chunk_size: bytes copied by each thread at a time
+        storage: Backend of the image, opened from the image path if not set
+        progress: Progress updated as the moves are copied
+        directory: directory the journal is kept in, next to the image if not set;
+            required for block devices
+    """
+
+    def __init__(
+        self,
+        image_path: Optional[str],
+        moves: List[Move],
+        writes: List[Write],
+        size: Optional[int] = None,
+        workers: Optional[int] = None,
+        chunk_size: int = move.CHUNK_SIZE,
+        frees: Optional[List[extents.Extent]] = None,
+        storage: Optional[backend.Backend] = None,
+        progress: Optional[transfer.Progress] = None,
+        directory: Optional[str] = None,
+        resize: Optional[int] = None,
+    ):
+        self.image_path = None if image_path is None else str(image_path)
+        self.directory = directory
+        self.path = (
+            None if self.image_path is None else journal_path(self.image_path, directory)
+        )
+        self.moves = moves
+        self.writes = writes
+        self.frees = frees or []
+        self.size = size
+        self.resize = resize
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.storage = storage
+        self.progress = progress
+        # index of the current move and the bytes of it already done
+        self._progress = (0, 0)
+        self._journal_fd: Optional[int] = None
+        # plan line, kept to replace the journal without its saved bytes
+        self._plan = b""
+        # move index, bytes done, image offset, journal offset and size of the
+        # bytes saved for the window that was being copied
+        self._pending: Optional[Tuple[int, int, int, int, int]] = None
+        # a save record was written since the journal was last replaced
+        self._saved = False
+        # length of the journal up to its last complete record
+        self._valid = 0
+
+    def run(self) -> move.MoveStats:
+        """Write the plan, carry it out and remove the journal
+
+        Returns:
+            MoveStats of the partition data moves
+        Raises:
+            JournalError if a journal for the image already exists, or the image is
+                a block device and no journal directory is set
+        """
+
+        if self.path is None:
+            return self._replay()
+        if self.directory is None and stat.S_ISBLK(os.stat(str(self.image_path)).st_mode):
+            raise JournalError(f"block devices need a journal directory: {self.image_path}")
+        if os.path.exists(self.path):
+            raise JournalError(f"an interrupted commit must be recovered first: {self.path}")
+        if self.size is None and self.storage is not None:
+            self.size = self.storage.size()
+        elif self.size is None:
+            with backend.open_backend(str(self.image_path), writable=False) as storage:
+                self.size = storage.size()
+        plan = {
+            "version": JOURNAL_VERSION,
+            "size": self.size,
+            "resize": self.resize,
+            "moves": self.moves,
+            "frees": self.frees,
+            "writes": [[offset, data.hex()] for offset, data in self.writes],
+        }
+        self._plan = json.dumps(plan).encode() + b"\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+        self._journal_fd = fd
+        try:
+            _write_all(fd, self._plan)
+            os.fsync(fd)
+            _fsync_dir(self.path)
+            stats = self._replay()
+        finally:
+            self._close()
+        self._remove()
+        return stats
+
+    @staticmethod
+    def load(image_path: str, directory: Optional[str] = None) -> Optional["Journal"]:
+        """Load the journal of an interrupted commit
+
+        A journal with an incomplete plan is removed, because the image is not
+        touched before the plan is synced.
+
+        Args:
+            image_path: path of the disk image
+            directory: directory the journal is kept in, next to the image if not set
+        Returns:
+            Journal with its progress, or None if there is nothing to replay
+        Raises:
+            JournalError if the plan is not a supported journal
+        """
+
+        path = journal_path(image_path, directory)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            line = f.readline()
+            # the plan is only complete if it is followed by a newline
+            try:
+                plan = json.loads(line) if line.endswith(b"\n") else None
+            except ValueError:
+                plan = None
+            if plan is None:
+                os.unlink(path)
+                _fsync_dir(path)
+                return None
+            if not isinstance(plan, dict) or plan.get("version") not in _VERSIONS:
+                raise JournalError(f"unsupported journal: {path}")
+            journal = Journal(
+                image_path,
+                [(src, dst, length) for src, dst, length in plan["moves"]],
+                [(offset, bytes.fromhex(data)) for offset, data in plan["writes"]],
+                plan["size"],
+                frees=[(start, end) for start, end in plan.get("frees", [])],
+                directory=directory,
+                resize=plan.get("resize"),
+            )
+            journal._plan = line
+            journal._valid = len(line)
+            journal._read_records(f)
+        return journal
+
+    def _read_records(self, f: IO[bytes]) -> None:
+        """Read the progress and save records that follow the plan
+
+        Reading stops at the first incomplete record, which was being written when
+        the commit was interrupted.
+        """
+
+        while True:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            if isinstance(record, dict):
+                index, done, start, size = record["save"]
+                offset = f.tell()
+                f.seek(size, os.SEEK_CUR)
+                if f.read(1) != b"\n":
+                    return
+                self._pending = (index, done, start, offset, size)
+                self._saved = True
+            else:
+                index, done = record
+                self._progress = (index, done)
+                self._pending = None
+            self._valid = f.tell()
+
+    def replay(self) -> move.MoveStats:
+        """Roll an interrupted commit forward and remove the journal
+
+        Returns:
+            MoveStats of the partition data moves
+        """
+
+        assert self.path is not None
+        # a record torn by the interruption is dropped before new ones are added
+        os.truncate(self.path, self._valid)
+        self._journal_fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            stats = self._replay()
+        finally:
+            self._close()
+        self._remove()
+        return stats
+
+    def _close(self) -> None:
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+
+    def _remove(self) -> None:
+        assert self.path is not None
+        os.unlink(self.path)
+        if os.path.exists(self.path + _REWRITE_SUFFIX):
+            os.unlink(self.path + _REWRITE_SUFFIX)
+        _fsync_dir(self.path)
+
+    def _record(self, index: int, done: int) -> None:
+        """Record progress once all the data written before it is synced
+
+        A journal holding saved bytes is replaced by the plan and the progress
+        record, so that the saved bytes are dropped in the same step.
+        """
+
+        if self._journal_fd is None:
+            # images held in memory are not journaled
+            self._progress = (index, done)
+            return
+        record = json.dumps([index, done]).encode() + b"\n"
+        if self._saved:
+            self._rewrite(record)
+        else:
+            _write_all(self._journal_fd, record)
+            os.fsync(self._journal_fd)
+        self._progress = (index, done)
+        self._pending = None
+
+    def _rewrite(self, record: bytes) -> None:
+        """Atomically replace the journal with the plan and a progress record"""
+
+        assert self.path is not None
+        new_path = self.path + _REWRITE_SUFFIX
+        fd = os.open(new_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        try:
+            _write_all(fd, self._plan + record)
+            os.fsync(fd)
+            os.replace(new_path, self.path)
+            _fsync_dir(self.path)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._close()
+        self._journal_fd = fd
+        self._saved = False
+
+    def _save(
+        self, storage: backend.Backend, index: int, done: int, start: int, size: int
+    ) -> None:
+        """Save the bytes of the image that the next window of a move overwrites
+
+        Args:
+            storage: Backend of the image
+            index: move index
+            done: bytes of the move done before the window
+            start: first byte of the image to save
+            size: number of bytes to save
+        Raises:
+            JournalError if the image ends before the saved range
+        """
+
+        if self._journal_fd is None:
+            # images held in memory are not journaled
+            return
+        fd = self._journal_fd
+        _write_all(fd, json.dumps({"save": [index, done, start, size]}).encode() + b"\n")
+        offset, end = start, start + size
+        while offset < end:
+            data = storage.pread(min(_SAVE_CHUNK_SIZE, end - offset), offset)
+            if not data:
+                raise JournalError(f"unexpected end of image at byte {offset}")
+            _write_all(fd, data)
+            offset += len(data)
+        _write_all(fd, b"\n")
+        os.fsync(fd)
+        self._saved = True
+
+    def _restore(self, storage: backend.Backend) -> None:
+        """Write back the bytes saved for the window that was interrupted"""
+
+        if self._pending is None or self._pending[:2] != self._progress:
+            return
+        assert self.path is not None
+        _, _, start, offset, size = self._pending
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while size:
+                data = f.read(min(_SAVE_CHUNK_SIZE, size))
+                if not data:
+                    raise JournalError(f"journal is truncated: {self.path}")
+                storage.pwrite(data, start)
+                start += len(data)
+                size -= len(data)
+        storage.sync()
+        self._pending = None
+
+    def _replay(self) -> move.MoveStats:
+        if self.storage is not None:
+            return self._carry_out(self.storage)
+        assert self.image_path is not None
+        with backend.open_backend(self.image_path) as storage:
+            return self._carry_out(storage)
+
+    def _carry_out(self, storage: backend.Backend) -> move.MoveStats:
+        stats = move.MoveStats()
+        # an interrupted resize may have changed the size already
+        if self.size is not None and storage.size() not in (self.size, self.resize):
+            raise JournalError(f"image size does not match the journal: {self.image_path}")
+        if self.resize is not None and self.size is not None and self.resize > self.size:
+            storage.truncate(self.resize)
+        self._restore(storage)
+        index, done = self._progress
+        for i in range(index, len(self.moves)):
+            stats.add(self._move(storage, i, done if i == index else 0))
+            storage.sync()
+            self._record(i + 1, 0)
+        for start, end in self.frees:
+            # stale data is left in place where it cannot be deallocated
+            storage.deallocate(start, end)
+        for offset, data in self.writes:
+            storage.pwrite(data, offset)
+        if self.resize is not None and storage.size() > self.resize:
+            storage.truncate(self.resize)
+        storage.sync()
+        return stats
+
+    def _move(self, storage: backend.Backend, index: int, done: int) -> move.MoveStats:
+        """Copy the remaining bytes of a move
+
+        The move is copied in windows of CHECKPOINT_SIZE bytes, front to back for
+        moves towards the start of the image and back to front for moves towards
+        the end, and progress is recorded after each window. A window only
+        overwrites the source of the bytes copied before it, and, when it is longer
+        than the move distance, part of its own source. That part is saved in the
+        journal before the window is copied, so replaying from the last record is
+        safe. Each window is copied in parallel by the move engine.
+
+        Args:
+            storage: Backend of the image
+            index: move index
+            done: bytes of the move already copied
+        Returns:
+            MoveStats of the copied windows
+        """
+
+        src, dst, length = self.moves[index]
+        stats = move.MoveStats()
+        distance = abs(dst - src)
+        if distance == 0:
+            return stats
+        while done < length:
+            size = min(CHECKPOINT_SIZE, length - done)
+            # offset of the window within the move
+            offset = done if dst < src else length - done - size
+            if distance < size:
+                # the destination of the window overlaps its source
+                self._save(storage, index, done, max(src, dst) + offset, size - distance)
+            stats.add(
+                move.move(
+                    storage,
+                    src + offset,
+                    dst + offset,
+                    size,
+                    self.workers,
+                    self.chunk_size,
+                    self.progress,
+                )
+            )
+            done += size
+            if done < length:
+                storage.sync()
+                self._record(index, done)
+        return stats
+
+
+def recover(
+    image_path: str,
+    storage: Optional[backend.Backend] = None,
+    directory: Optional[str] = None,
+) -> bool:
+    """Complete an interrupted commit of an image
+
+    Args:
+        image_path: path of the disk image
+        storage: Backend of the image, opened from the image path if not set
+        directory: directory the journal is kept in, next to the image if not set
+    Returns:
+        True if a commit was rolled forward
+    """
+
+    journal = Journal.load(image_path, directory)
+    if journal is None:
+        return False
+    journal.storage = storage
+    journal.replay()
+    return True
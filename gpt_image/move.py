@@ -0,0 +1,160 @@
+"""
+Multi-threaded relocation of byte ranges within an image
+
+A move is split into chunks that are copied by a thread pool with positional reads
+and writes. When the source and destination of a move overlap, a chunk is only
+written once every chunk whose source it overwrites has been read.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from gpt_image import transfer
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.backend import Backend
+
+# bytes copied by each task
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class MoveError(Exception):
+    """Error moving a byte range"""
+
+
+class MoveStats:
+    """Statistics of one or more moves
+
+    Attributes:
+        bytes_moved: integer count of bytes copied
+        seconds: time spent copying
+        chunks: integer count of chunks copied
+    """
+
+    def __init__(self) -> None:
+        self.bytes_moved = 0
+        self.seconds = 0.0
+        self.chunks = 0
+
+    @property
+    def throughput(self) -> float:
+        """Bytes copied per second"""
+
+        if self.seconds == 0:
+            return 0.0
+        return self.bytes_moved / self.seconds
+
+    def add(self, other: "MoveStats") -> None:
+        self.bytes_moved += other.bytes_moved
+        self.seconds += other.seconds
+        self.chunks += other.chunks
+
+    def __repr__(self) -> str:
+        return (
+            f"MoveStats(bytes_moved={self.bytes_moved}, seconds={self.seconds:.3f}, "
+            f"throughput={self.throughput:.0f})"
+        )
+
+
+def _dependencies(
+    offsets: List[int], src: int, dst: int, chunk_size: int
+) -> Dict[int, List[int]]:
+    """Find the chunks whose source each chunk overwrites
+
+    Chunks are listed in copy order: front to back when moving towards the start of
+    the image and back to front when moving towards the end, so a chunk only ever
+    overwrites the source of chunks before it.
+    """
+
+    index = {offset: i for i, offset in enumerate(offsets)}
+    dependencies: Dict[int, List[int]] = {}
+    for i, offset in enumerate(offsets):
+        # chunk offsets within the move whose source overlaps this destination
+        first = offset + dst - src
+        last = first + chunk_size - 1
+        overlapped = [
+            index[o]
+            for o in range(first - first % chunk_size, last + 1, chunk_size)
+            if o in index and index[o] < i
+        ]
+        if overlapped:
+            dependencies[i] = overlapped
+    return dependencies
+
+
+def move(
+    storage: Backend,
+    src: int,
+    dst: int,
+    length: int,
+    workers: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+    progress: Optional[transfer.Progress] = None,
+) -> MoveStats:
+    """Copy a byte range of an image to another offset of the same image
+
+    The source and destination may overlap. A chunk size larger than the preferred
+    I/O size of the backend is rounded down to a multiple of it.
+
+    Args:
+        storage: Backend of the image, readable and writable
+        src: first byte of the source
+        dst: first byte of the destination
+        length: number of bytes to copy
+        workers: number of copying threads (default CPU count)
+        chunk_size: bytes copied by each task
+        progress: Progress updated as chunks are copied
+    Returns:
+        MoveStats of the move
+    Raises:
+        MoveError if the file ends before the source range
+    """
+
+    stats = MoveStats()
+    if src == dst or length <= 0:
+        return stats
+    started = time.monotonic()
+    if chunk_size > storage.preferred_io_size:
+        chunk_size -= chunk_size % storage.preferred_io_size
+    offsets = list(range(0, length, chunk_size))
+    if dst > src:
+        offsets.reverse()
+    dependencies: Dict[int, List[int]] = {}
+    if abs(dst - src) < length:
+        dependencies = _dependencies(offsets, src, dst, chunk_size)
+    read = [threading.Event() for _ in offsets]
+    failed = threading.Event()
+
+    def copy(i: int) -> int:
+        offset = offsets[i]
+        size = min(chunk_size, length - offset)
+        try:
+            data = storage.pread(size, src + offset)
+            if len(data) != size:
+                raise MoveError(f"unexpected end of image at byte {src + offset}")
+        except BaseException:
+            # chunks waiting on this one must not overwrite its source
+            failed.set()
+            raise
+        finally:
+            read[i].set()
+        for j in dependencies.get(i, []):
+            read[j].wait()
+        if failed.is_set():
+            raise MoveError("move aborted")
+        count = storage.pwrite(data, dst + offset)
+        if progress is not None:
+            progress.update(count)
+        return count
+
+    # tasks are queued in copy order, so a task only waits on tasks already running
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for future in [executor.submit(copy, i) for i in range(len(offsets))]:
+            stats.bytes_moved += future.result()
+            stats.chunks += 1
+    stats.seconds = time.monotonic() - started
+    return stats
@@ -1,18 +1,17 @@
 from __future__ import annotations
 
 import json
-import shutil
 import struct
-import tempfile
 import uuid
 from enum import Enum, IntEnum
-from math import ceil
-from typing import List, Optional, Any, IO
+from math import ceil, gcd
+from typing import List, Optional, Any, Dict, Iterable, Tuple
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:  # a bit of a hack to allow typing to work
     from gpt_image.disk import Disk
 
+from gpt_image import extents, fat, instrument, journal, move, transfer
 from gpt_image.geometry import Geometry
 
 
@@ -155,9 +154,51 @@ class Partition:
         self._size.value = size
 
     def __repr__(self) -> str:
-        partitionvalue = {k: v for k, v in vars(self).items() if not k.startswith("_")}
-        partitionvalue["attribute_flags"] = self.attribute_flags
-        return json.dumps(partitionvalue, indent=2, ensure_ascii=False)
+        return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the committed partition to a dictionary of plain values
+
+        Returns:
+            dictionary of strings, integers and lists, serializable as is
+        """
+
+        return {
+            "type_guid": self.type_guid,
+            "partition_name": self.partition_name,
+            "partition_guid": self.partition_guid,
+            "first_lba": self.first_lba,
+            "last_lba": self.last_lba,
+            "alignment": self.alignment,
+            "size": self.size,
+            "attribute_flags": self.attribute_flags,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "Partition":
+        """Create a Partition object from a dictionary made by to_dict
+
+        Args:
+            data: dictionary of partition values
+        Returns:
+            an instance of the Partition class
+        """
+
+        attributes = 0
+        for flag in data.get("attribute_flags", []):
+            attributes |= 1 << flag
+        part = Partition(
+            data["partition_name"],
+            data["size"],
+            data["type_guid"],
+            data["partition_guid"],
+            data.get("alignment", 8),
+            attributes,
+        )
+        part.first_lba = data["first_lba"]
+        part.last_lba = data["last_lba"]
+        part._commit_attrs()
+        return part
 
     @property
     def first_lba(self) -> int:
@@ -262,36 +303,85 @@ class Partition:
             return False
         return True
 
-    def commit(self, disk: Disk, tmpfile: Optional[IO[bytes]] = None, chunk_size: Optional[int] = None) -> None:
-        max_size = min(self.size, self.size_staged)
-        start = disk.sector_size * self.first_lba_staged
-        count = 0
-        if chunk_size is None or chunk_size > max_size:
-            chunk_size = max_size
-        if tmpfile is None:
-            f: IO[bytes] = open(disk.image_path, 'r+b')
-        else:
-            f = tmpfile
-        try:
-            while count < max_size:
-                data = self.read(disk, max_size=chunk_size, offset=count)
-                if not data:
-                    break
-                self._write_data(f, start + count, bytes(data))
-                count += len(data)
-        finally:
-            if tmpfile is None:
-                f.close()
-        self._commit_attrs()
-
-    def _write_data(self, image: IO[bytes], start_offset: int, data: bytes) -> int:
-        image.seek(start_offset)
-        image.write(data)
-        return len(data)
+    def relocation(self, sector_size: int) -> Optional[journal.Move]:
+        """Find the data move needed to commit staged LBA/size modifications
+
+        Args:
+            sector_size: disk sector size in bytes
+        Returns:
+            tuple of the source, destination and length in bytes, or None if the
+                data does not need to move
+        """
+
+        length = min(self.size, self.size_staged)
+        src = sector_size * self.first_lba
+        dst = sector_size * self.first_lba_staged
+        if length == 0 or src == dst:
+            return None
+        return src, dst, length
+
+    def commit(
+        self,
+        disk: Disk,
+        workers: Optional[int] = None,
+        chunk_size: int = move.CHUNK_SIZE,
+    ) -> move.MoveStats:
+        """Shift the partition data based on any staged LBA/size modifications,
+        then commit the staged modifications.
+
+        The move is journaled, see PartitionEntryArray.commit.
+
+        Args:
+            disk: GPT Disk instance
+            workers: number of threads copying the data (default CPU count)
+            chunk_size: bytes copied by each thread at a time
+        Returns:
+            MoveStats of the data move
+        """
+
+        relocation = self.relocation(disk.sector_size)
+        stats = move.MoveStats()
+        with instrument.span("partition.commit"):
+            if relocation is not None:
+                instrument.count_moves(1)
+                with disk.storage() as storage:
+                    stats = journal.Journal(
+                        storage.path,
+                        [relocation],
+                        [],
+                        workers=workers,
+                        chunk_size=chunk_size,
+                        storage=storage,
+                        progress=transfer.start(
+                            relocation[2], disk.progress, disk.bandwidth_limit
+                        ),
+                        directory=disk.journal_dir,
+                    ).run()
+            self._commit_attrs()
+        return stats
+
+    def wipe(self, disk: Disk) -> None:
+        """Zero the partition
+
+        The partition is deallocated in the image where the filesystem supports it,
+        and zeros are written otherwise.
+
+        Args:
+            disk: GPT Disk instance
+        """
+
+        start = disk.sector_size * self.first_lba
+        end = disk.sector_size * (self.last_lba + 1)
+        with disk.storage() as storage:
+            storage.zero(start, end)
+            storage.sync()
 
     def write_data(self, disk: Disk, data: bytes, offset: int = 0) -> int:
         """Write bytes to partition
 
+        The progress of the write is reported to disk.progress and limited to
+        disk.bandwidth_limit.
+
         Args:
             disk: GPT Disk instance
             data: data in bytes
@@ -305,8 +395,35 @@ class Partition:
         if len(data) + offset > self.size:
             raise ValueError(f"data too large for partition: {len(data)} + {offset} > {self.size}")
         start = disk.sector_size * self.first_lba + offset
-        with open(disk.image_path, 'r+b') as image:
-            return self._write_data(image, start, data)
+        progress = transfer.start(len(data), disk.progress, disk.bandwidth_limit)
+        with instrument.span("partition.write_data"), disk.storage() as storage:
+            if progress is None:
+                return storage.pwrite(data, start)
+            # written in chunks to report progress and keep to the bandwidth limit
+            written = 0
+            for i in range(0, len(data), move.CHUNK_SIZE):
+                count = storage.pwrite(data[i : i + move.CHUNK_SIZE], start + i)
+                progress.update(count)
+                written += count
+            return written
+
+    def format_fat32(self, disk: Disk, source: str, label: str = fat.NO_LABEL) -> fat.Layout:
+        """Format the partition as FAT32 and copy a directory tree into it
+
+        The filesystem is laid out in memory and written in one sequential pass,
+        see gpt_image.fat.format_partition for more options.
+
+        Args:
+            disk: GPT Disk instance
+            source: path of the directory to copy, such as the EFI directory tree
+            label: volume label, up to 11 upper case characters
+        Returns:
+            fat.Layout of the filesystem written
+        Raises:
+            fat.FatError if the partition is too small or the files cannot be copied
+        """
+
+        return fat.format_partition(disk, self, source, label)
 
     def read(self, disk: Disk, max_size: Optional[int] = None, offset: int = 0) -> bytearray:
         """Read bytes from a given partition
@@ -319,14 +436,12 @@ class Partition:
             bytearray of partition data
         """
 
-        with open(str(disk.image_path), "rb") as b:
-            start = disk.sector_size * self.first_lba + offset
-            size = self.size - offset
-            if max_size is not None:
-                size = min(size, max_size)
-            b.seek(start)
-            buffer = b.read(size)
-        return bytearray(buffer)
+        start = disk.sector_size * self.first_lba + offset
+        size = self.size - offset
+        if max_size is not None:
+            size = min(size, max_size)
+        with instrument.span("partition.read"), disk.storage(writable=False) as storage:
+            return bytearray(storage.pread(size, start))
 
     def matches_name_or_guid(self, name_or_guid: str) -> bool:
         """Checks whether this partition matches the provided string. This can match
@@ -378,15 +493,103 @@ class Partition:
         return part
 
 
+def _lcm(a: int, b: int) -> int:
+    return a * b // gcd(a, b)
+
+
+class AlignmentPolicy:
+    """Table-wide partition alignment
+
+    Partition starts are aligned to the start alignment, in addition to the
+    alignment of each partition, and partition sizes are rounded up to the size
+    alignment. Flash media such as eMMC and SD cards write fastest when partitions
+    start and end on erase block boundaries.
+
+    Attributes:
+        start: partition start alignment in bytes
+        size: partition size alignment in bytes, 0 to keep sizes unchanged
+    """
+
+    def __init__(self, start: int = 4096, size: int = 0):
+        self.start = start
+        self.size = size
+
+    @staticmethod
+    def for_device(erase_block_size: int = 0, optimal_io_size: int = 0) -> "AlignmentPolicy":
+        """Create a policy aligning starts and sizes to the blocks of a device
+
+        Args:
+            erase_block_size: flash erase block size in bytes, 0 if unknown
+            optimal_io_size: optimal I/O size in bytes, 0 if unknown
+        Returns:
+            AlignmentPolicy aligned to both sizes, or to 1 MiB if neither is known
+        """
+
+        block = _lcm(erase_block_size or 1, optimal_io_size or 1)
+        if block == 1:
+            block = 1024 * 1024
+        return AlignmentPolicy(block, block)
+
+    def _sectors(self, value: int, sector_size: int) -> int:
+        if value % sector_size:
+            raise PartitionEntryError(
+                f"alignment {value} is not a multiple of the sector size {sector_size}"
+            )
+        return max(1, value // sector_size)
+
+    def start_sectors(self, sector_size: int) -> int:
+        """Start alignment in sectors"""
+
+        return self._sectors(self.start, sector_size)
+
+    def size_sectors(self, sector_size: int) -> int:
+        """Size alignment in sectors"""
+
+        return self._sectors(self.size, sector_size) if self.size else 1
+
+
+class CompactionPlan:
+    """Planned partition moves of a layout compaction
+
+    Attributes:
+        sector_size: disk sector size in bytes
+        moves: list of (partition, first LBA, new first LBA) moves
+        bytes_moved: bytes of partition data copied when the compaction is committed
+    """
+
+    def __init__(self, sector_size: int):
+        self.sector_size = sector_size
+        self.moves: List[Tuple[Partition, int, int]] = []
+        self.bytes_moved = 0
+
+    def __repr__(self) -> str:
+        moves = [
+            {"partition": partition.partition_name, "first_lba": old, "new_first_lba": new}
+            for partition, old, new in self.moves
+        ]
+        return json.dumps(
+            {"bytes_moved": self.bytes_moved, "moves": moves}, indent=2, ensure_ascii=False
+        )
+
+
 class PartitionEntryArray:
-    """Stores the Partition objects for a Table"""
+    """Stores the Partition objects for a Table
+
+    Attributes:
+        entries: list of Partition instances
+        alignment: AlignmentPolicy applied by add, resize, remove and compact, or
+            None to only use the alignment of each partition
+    """
 
     EntryCount = 128
     EntryLength = 128
 
-    def __init__(self, geometry: Geometry):
+    def __init__(self, geometry: Geometry, alignment: Optional[AlignmentPolicy] = None):
         self.entries: List[Partition] = []
         self._geometry: Geometry = geometry
+        self.alignment = alignment
+        # removed partitions whose space is freed on commit
+        self._removed: List[Partition] = []
 
     def add(self, partition: Partition) -> None:
         """Add a partition to the entries
@@ -442,11 +645,13 @@ class PartitionEntryArray:
         self.entries = entries
         return matched_partition
 
-    def remove(self, partition_name_or_guid: str) -> Partition:
+    def remove(self, partition_name_or_guid: str, shift: bool = True) -> Partition:
         """Remove a partition from the list of entries
 
         Args:
             partition_name_or_guid: string name of partition to remove
+            shift: shift the following partitions to close the gap, otherwise the
+                gap is left for compact to close
         Returns:
             the partition instance
         Raises:
@@ -459,29 +664,201 @@ class PartitionEntryArray:
             if partition.matches_name_or_guid(partition_name_or_guid):
                 matched_partition = partition
                 continue
-            if matched_partition is not None:
+            if matched_partition is not None and shift:
                 partition.first_lba = self._get_first_lba(partition, entries)
                 partition.last_lba = self._get_last_lba(partition)
             entries.append(partition)
         if matched_partition is None:
             raise NameError(partition_name_or_guid)
         self.entries = entries
+        self._removed.append(matched_partition)
         return matched_partition
 
-    def commit(self, disk: Disk) -> None:
+    def compact(self, pinned: Iterable[str] = (), dry_run: bool = False) -> CompactionPlan:
+        """Close the gaps between partitions, moving as few bytes as possible
+
+        Pinned partitions stay where they are and split the disk into segments. The
+        partitions of a segment keep their order and are packed together, so the
+        free space of the segment ends up in a single gap. The gap is placed where
+        the fewest bytes of partition data have to move; in the segment after the
+        last pinned partition it is always at the end of the disk. Partition data
+        is moved by commit.
+
+        Args:
+            pinned: names or GUIDs of partitions that must not move
+            dry_run: only plan the moves, without staging them
+        Returns:
+            the CompactionPlan
+        Raises:
+            NameError if a pinned partition was not found
+            PartitionEntryError if a segment cannot hold its partitions
+        """
+
+        fixed = set()
+        for name_or_guid in pinned:
+            partition = self.find(name_or_guid)
+            if partition is None:
+                raise NameError(name_or_guid)
+            fixed.add(id(partition))
+        placements: List[Tuple[Partition, int]] = []
+        segment: List[Partition] = []
+        start = self._geometry.first_usable_lba
+        for partition in sorted(self.entries, key=lambda p: p.first_lba_staged):
+            if id(partition) not in fixed:
+                segment.append(partition)
+                continue
+            placements += self._pack(segment, start, partition.first_lba_staged - 1, True)
+            start = partition.last_lba_staged + 1
+            segment = []
+        placements += self._pack(segment, start, self._geometry.last_usable_lba, False)
+
+        plan = CompactionPlan(self._geometry.sector_size)
+        for partition, first_lba in placements:
+            if first_lba == partition.first_lba_staged:
+                continue
+            plan.moves.append((partition, partition.first_lba_staged, first_lba))
+            if partition.size > 0 and partition.first_lba != first_lba:
+                plan.bytes_moved += min(partition.size, partition.size_staged)
+            if not dry_run:
+                sectors = partition.last_lba_staged - partition.first_lba_staged
+                partition.first_lba = first_lba
+                partition.last_lba = first_lba + sectors
+        return plan
+
+    def _pack(
+        self, segment: List[Partition], start: int, end: int, split: bool
+    ) -> List[Tuple[Partition, int]]:
+        """Place the partitions of a segment with a single gap
+
+        The partitions before the gap are packed towards the start of the segment
+        and the ones after it towards the end. Every gap position is tried when
+        split is set, otherwise the gap is at the end.
+
+        Args:
+            segment: partitions of the segment, in LBA order
+            start: first LBA of the segment
+            end: last LBA of the segment
+            split: whether the gap may be anywhere in the segment
+        Returns:
+            list of (partition, first LBA) placements
+        """
+
+        count = len(segment)
+        sectors = [p.last_lba_staged - p.first_lba_staged + 1 for p in segment]
+        left: List[int] = []
+        lba = start
+        for partition, length in zip(segment, sectors):
+            alignment = self._start_alignment(partition)
+            lba = -(-lba // alignment) * alignment
+            left.append(lba)
+            lba += length
+        right: List[int] = [0] * count
+        lba = end + 1
+        for i in range(count - 1, -1, -1):
+            lba -= sectors[i]
+            lba -= lba % self._start_alignment(segment[i])
+            right[i] = lba
+
+        def cost(partition: Partition, first_lba: int) -> int:
+            # bytes that move when the partition is committed at this LBA
+            if partition.size == 0 or partition.first_lba == first_lba:
+                return 0
+            return min(partition.size, partition.size_staged)
+
+        # cost of packing the first i partitions left and the rest right
+        left_cost = [0]
+        for partition, lba in zip(segment, left):
+            left_cost.append(left_cost[-1] + cost(partition, lba))
+        right_cost = [0]
+        for partition, lba in zip(reversed(segment), reversed(right)):
+            right_cost.append(right_cost[-1] + cost(partition, lba))
+
+        best: Optional[Tuple[int, int]] = None
+        for i in range(count, -1, -1) if split else [count]:
+            left_end = left[i - 1] + sectors[i - 1] - 1 if i else start - 1
+            right_start = right[i] if i < count else end + 1
+            if left_end >= right_start or (i < count and right[i] < start):
+                continue
+            total = left_cost[i] + right_cost[count - i]
+            if best is None or total < best[1]:
+                best = (i, total)
+        if best is None:
+            raise PartitionEntryError(
+                f"partitions do not fit between LBA {start} and {end}"
+            )
+        split_at = best[0]
+        return [
+            (partition, left[i] if i < split_at else right[i])
+            for i, partition in enumerate(segment)
+        ]
+
+    def commit(
+        self,
+        disk: Disk,
+        writes: Optional[List[journal.Write]] = None,
+        workers: Optional[int] = None,
+        chunk_size: int = move.CHUNK_SIZE,
+    ) -> move.MoveStats:
         """Shift partition data within the disk based on any staged LBA/size modifications,
         then commit all staged LBA/size modifications.
 
+        The data moves and the metadata writes are recorded in a journal before the
+        image is modified, so an interrupted commit is completed the next time the
+        disk is opened. Data is moved in place: only the moved bytes are copied,
+        in parallel by a pool of threads. Space freed by removed, shrunk or moved
+        partitions is deallocated where the filesystem supports it, so that stale
+        data is not exported or copied later.
+        The progress of the moves is reported to disk.progress and limited to
+        disk.bandwidth_limit.
+
         Args:
             disk: GPT Disk instance
+            writes: list of (offset, bytes) metadata writes to make after the moves
+            workers: number of threads copying the data (default CPU count)
+            chunk_size: bytes copied by each thread at a time
+        Returns:
+            MoveStats of the data moves
         """
 
-        if not any([partition.needs_commit() for partition in self.entries]):
-            return
-        with tempfile.NamedTemporaryFile() as tmpfile:
-            for partition in self.entries:
-                partition.commit(disk, tmpfile)
-            shutil.copy(tmpfile.name, disk.image_path)
+        moves = [partition.relocation(disk.sector_size) for partition in self.entries]
+        planned = journal.order_moves([m for m in moves if m is not None])
+        sector_size = disk.sector_size
+        frees = extents.subtract(
+            [
+                (p.first_lba * sector_size, (p.last_lba + 1) * sector_size)
+                for p in self.entries + self._removed
+                if p.size > 0
+            ],
+            [
+                (p.first_lba_staged * sector_size, (p.last_lba_staged + 1) * sector_size)
+                for p in self.entries
+            ],
+        )
+        stats = move.MoveStats()
+        with instrument.span("partition_entry_array.commit"):
+            instrument.count_moves(len(planned))
+            if planned or writes or frees:
+                progress = transfer.start(
+                    sum(length for _, _, length in planned),
+                    disk.progress,
+                    disk.bandwidth_limit,
+                )
+                with disk.storage() as storage:
+                    stats = journal.Journal(
+                        storage.path,
+                        planned,
+                        writes or [],
+                        workers=workers,
+                        chunk_size=chunk_size,
+                        frees=frees,
+                        storage=storage,
+                        progress=progress,
+                        directory=disk.journal_dir,
+                    ).run()
+        for partition in self.entries:
+            partition._commit_attrs()
+        self._removed = []
+        return stats
 
     def _get_first_lba(self, partition: Partition, entries: List[Partition]) -> int:
         """Calculate the first LBA of a new partition
@@ -490,7 +867,8 @@ class PartitionEntryArray:
         LBA of the partition being created.  If it is 0, all partitions are empty
         and the last lba is considered 33.
 
-        The start sector (LBA) will take the alignment into account.
+        The start sector (LBA) will take the alignment and the table alignment policy
+        into account.
 
         Args:
             partition: instance of the Partition class to calculate LBA for
@@ -509,12 +887,23 @@ class PartitionEntryArray:
             if int(lba) > int(largest_lba):
                 largest_lba = lba
         last_lba = 33 if largest_lba == 0 else largest_lba
-        return next_lba(int(last_lba), partition.alignment)
+        return next_lba(int(last_lba), self._start_alignment(partition))
+
+    def _start_alignment(self, partition: Partition) -> int:
+        """Start alignment of a partition in sectors, including the table policy"""
+
+        if self.alignment is None:
+            return partition.alignment
+        return _lcm(
+            partition.alignment, self.alignment.start_sectors(self._geometry.sector_size)
+        )
 
     def _get_last_lba(self, partition: Partition) -> int:
         """Calculate the last LBA of a new partition
 
-        The last LBA will always be the -1 from the total partition LBA
+        The last LBA will always be the -1 from the total partition LBA. The
+        partition LBA count is rounded up to the size alignment of the table
+        alignment policy.
 
         Args:
             partition: instance of the Partition class to calculate LBA for
@@ -529,6 +918,9 @@ class PartitionEntryArray:
 
         # round the LBA up to ensure our LBA will hold the partition
         lba = int(ceil(partition.size_staged / self._geometry.sector_size))
+        if self.alignment is not None:
+            size_alignment = self.alignment.size_sectors(self._geometry.sector_size)
+            lba = -(-lba // size_alignment) * size_alignment
         f_lba = int(partition.first_lba_staged)
         return (f_lba + lba) - 1
 
@@ -548,6 +940,39 @@ class PartitionEntryArray:
         )
         return padded
 
+    def misaligned(
+        self, policy: Optional[AlignmentPolicy] = None
+    ) -> List[Tuple[Partition, str]]:
+        """Find the partitions that do not follow an alignment policy
+
+        Args:
+            policy: AlignmentPolicy to check, the table policy or 4 KiB starts if None
+        Returns:
+            list of (partition, problem description) tuples
+        """
+
+        if policy is None:
+            policy = self.alignment or AlignmentPolicy()
+        sector_size = self._geometry.sector_size
+        start_alignment = policy.start_sectors(sector_size)
+        size_alignment = policy.size_sectors(sector_size)
+        problems: List[Tuple[Partition, str]] = []
+        for partition in self.entries:
+            first_lba = partition.first_lba_staged
+            sectors = partition.last_lba_staged - first_lba + 1
+            if first_lba % start_alignment:
+                problems.append(
+                    (partition, f"first LBA {first_lba} is not aligned to {policy.start} bytes")
+                )
+            if sectors % size_alignment:
+                problems.append(
+                    (
+                        partition,
+                        f"size of {sectors} sectors is not a multiple of {policy.size} bytes",
+                    )
+                )
+        return problems
+
     def find(self, partition_name_or_guid: str) -> Optional[Partition]:
         """Find a Partition by name or GUID
 
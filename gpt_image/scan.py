@@ -0,0 +1,144 @@
+"""
+Inventory scanner for many disk images
+
+Walks files and directories, reads only the GPT metadata of each image and decodes
+the tables in a process pool. One compact JSON document is written per line for
+each image as soon as it is decoded. An image that cannot be read is reported on
+its own line with an error, and the scan carries on. Images are never written to:
+an interrupted commit is not recovered, the image is flagged with pending_journal.
+
+Usage:
+    gpt-image-scan [--workers N] [--output FILE] [--pattern GLOB] PATH [PATH ...]
+
+"""
+import argparse
+import fnmatch
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from gpt_image import compress, journal
+from gpt_image.disk import Disk
+
+# images decoded ahead of the output, per worker
+_QUEUE_DEPTH = 4
+# sidecar files written next to images
+_SIDECAR_SUFFIXES = (compress.INDEX_SUFFIX, journal.JOURNAL_SUFFIX)
+
+
+def find_images(paths: Iterable[str], pattern: str = "*") -> Iterator[str]:
+    """Walk files and directories for image files
+
+    Index and journal sidecar files found in directories are skipped.
+
+    Args:
+        paths: paths of image files and directories to walk recursively
+        pattern: glob pattern that the names of files found in directories match
+    Returns:
+        iterator of image file paths
+    """
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if fnmatch.fnmatch(name, pattern) and not name.endswith(_SIDECAR_SUFFIXES):
+                    yield os.path.join(root, name)
+
+
+def scan_image(image_path: str) -> Dict[str, Any]:
+    """Decode the GPT metadata of an image
+
+    Args:
+        image_path: path of the disk image
+    Returns:
+        dictionary of the image path and table, or of the image path and an error
+            if the image could not be read; pending_journal is set if the image
+            holds the journal of an interrupted commit
+    """
+
+    try:
+        disk = Disk.open(image_path, recover=False)
+        record = {**disk.to_dict(), "path": image_path}
+    except Exception as e:
+        return {"path": image_path, "error": f"{type(e).__name__}: {e}"}
+    if disk.pending_journal:
+        record["pending_journal"] = True
+    return record
+
+
+def _scan_line(image_path: str) -> Tuple[bool, str]:
+    # the JSON is encoded in the worker process, in a single pass
+    record = scan_image(image_path)
+    return "error" not in record, json.dumps(
+        record, separators=(",", ":"), ensure_ascii=False
+    )
+
+
+def scan(
+    paths: Iterable[str],
+    output: Any,
+    workers: Optional[int] = None,
+    pattern: str = "*",
+) -> int:
+    """Scan images and write one JSON line per image
+
+    Lines are written in the order the images are decoded.
+
+    Args:
+        paths: paths of image files and directories to walk recursively
+        output: text file the JSON lines are written to
+        workers: number of decoding processes (default CPU count)
+        pattern: glob pattern that the names of files found in directories match
+    Returns:
+        integer count of images that could not be read
+    """
+
+    errors = 0
+    depth = _QUEUE_DEPTH * (workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: Set["Future[Tuple[bool, str]]"] = set()
+
+        def drain(futures: Set["Future[Tuple[bool, str]]"]) -> None:
+            nonlocal errors
+            for future in futures:
+                ok, line = future.result()
+                errors += not ok
+                output.write(line + "\n")
+
+        for image_path in find_images(paths, pattern):
+            if len(pending) >= depth:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                drain(done)
+            pending.add(executor.submit(_scan_line, image_path))
+        drain(wait(pending).done)
+    output.flush()
+    return errors
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Write the GPT tables of disk images as JSON lines"
+    )
+    parser.add_argument("paths", nargs="+", help="image files and directories")
+    parser.add_argument("-w", "--workers", type=int, help="decoding processes")
+    parser.add_argument("-o", "--output", help="output file (default stdout)")
+    parser.add_argument(
+        "-p", "--pattern", default="*", help="file name pattern in directories"
+    )
+    args = parser.parse_args(argv)
+    if args.output:
+        with open(args.output, "w") as output:
+            errors = scan(args.paths, output, args.workers, args.pattern)
+    else:
+        errors = scan(args.paths, sys.stdout, args.workers, args.pattern)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
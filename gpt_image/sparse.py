@@ -0,0 +1,252 @@
+"""
+Android sparse image (simg) format
+
+Format reference:
+https://android.googlesource.com/platform/system/core/+/master/libsparse/sparse_format.h
+
+"""
+from __future__ import annotations
+
+import os
+import struct
+from typing import IO, TYPE_CHECKING, List, Optional, Tuple
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.disk import Disk
+
+from gpt_image import extents, transfer
+
+
+class SparseImageError(Exception):
+    """Error reading or writing a sparse image"""
+
+
+SPARSE_MAGIC = 0xED26FF3A
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+_HEADER_FORMAT = struct.Struct("<IHHHHIIII")
+_CHUNK_FORMAT = struct.Struct("<HHII")
+# number of blocks read from the image at a time
+_READ_BLOCKS = 1024
+
+
+class _ChunkWriter:
+    """Merges consecutive blocks of the same kind into sparse chunks"""
+
+    def __init__(self, f: IO[bytes]):
+        self._f = f
+        self._type = 0
+        self._blocks = 0
+        self._data: List[bytes] = []
+        self.chunks = 0
+        self.total_blocks = 0
+
+    def add(self, chunk_type: int, blocks: int, data: bytes = b"") -> None:
+        if chunk_type != self._type:
+            self.flush()
+            self._type = chunk_type
+        self._blocks += blocks
+        if chunk_type == CHUNK_TYPE_RAW:
+            self._data.append(data)
+            # bound the memory held for a single raw chunk
+            if self._blocks >= _READ_BLOCKS:
+                self.flush()
+
+    def flush(self) -> None:
+        if not self._blocks:
+            return
+        if self._type == CHUNK_TYPE_RAW:
+            payload = b"".join(self._data)
+        elif self._type == CHUNK_TYPE_FILL:
+            payload = b"\x00" * 4
+        else:
+            payload = b""
+        self._f.write(
+            _CHUNK_FORMAT.pack(
+                self._type,
+                0,
+                self._blocks,
+                _CHUNK_FORMAT.size + len(payload),
+            )
+        )
+        self._f.write(payload)
+        self.chunks += 1
+        self.total_blocks += self._blocks
+        self._blocks = 0
+        self._data = []
+
+
+def export_sparse(
+    disk: Disk,
+    dest: str,
+    block_size: int = 4096,
+    progress: Optional[transfer.ProgressCallback] = None,
+    bandwidth_limit: Optional[int] = None,
+    partitions_only: bool = False,
+) -> int:
+    """Write a disk image in the Android sparse format
+
+    Holes in the image file are written as DONT_CARE chunks without being read. Zeroed blocks within
+    the mapped extents are written as FILL chunks. A disk size that is not a
+    multiple of the block size has its last block padded with zeros, as img2simg
+    does.
+
+    Args:
+        disk: GPT Disk instance
+        dest: path of the sparse image to create
+        block_size: sparse block size in bytes, must be a multiple of 4
+        progress: function called with the mapped bytes done, total and
+            estimated seconds left
+        bandwidth_limit: most mapped bytes read per second
+        partitions_only: also skip data outside of the partitions and GPT metadata
+    Returns:
+        integer count of chunks written
+    Raises:
+        SparseImageError if the block size is not a multiple of 4 or the chunks do
+            not cover the disk
+    """
+
+    if block_size % 4:
+        raise SparseImageError(f"block size {block_size} is not a multiple of 4")
+    total_blocks = -(-disk.size // block_size)
+    padded_size = total_blocks * block_size
+    zero_block = b"\x00" * block_size
+    mapped = extents.align(disk.mapped_extents(partitions_only), block_size, padded_size)
+    tracker = transfer.start(sum(e - s for s, e in mapped), progress, bandwidth_limit)
+    with disk.storage(writable=False) as image, open(dest, "wb") as f:
+        # the header is rewritten once the chunk count is known
+        f.write(b"\x00" * _HEADER_FORMAT.size)
+        writer = _ChunkWriter(f)
+        position = 0
+        for start, end in mapped:
+            if start > position:
+                writer.add(CHUNK_TYPE_DONT_CARE, (start - position) // block_size)
+            while start < end:
+                size = min(end - start, _READ_BLOCKS * block_size)
+                data = image.pread(min(size, disk.size - start), start)
+                if start + len(data) == disk.size:
+                    # the zero padding of the last block
+                    data += bytes(size - len(data))
+                if not data:
+                    raise SparseImageError(f"unexpected end of image at byte {start}")
+                if tracker is not None:
+                    tracker.update(len(data))
+                for i in range(0, len(data), block_size):
+                    block = data[i : i + block_size]
+                    if block == zero_block:
+                        writer.add(CHUNK_TYPE_FILL, 1)
+                    else:
+                        writer.add(CHUNK_TYPE_RAW, 1, block)
+                start += len(data)
+            position = end
+        if position < padded_size:
+            writer.add(CHUNK_TYPE_DONT_CARE, (padded_size - position) // block_size)
+        writer.flush()
+        if writer.total_blocks != total_blocks:
+            raise SparseImageError(
+                f"chunks cover {writer.total_blocks} blocks, expected {total_blocks}"
+            )
+        f.seek(0)
+        f.write(
+            _HEADER_FORMAT.pack(
+                SPARSE_MAGIC,
+                1,
+                0,
+                _HEADER_FORMAT.size,
+                _CHUNK_FORMAT.size,
+                block_size,
+                total_blocks,
+                writer.chunks,
+                0,
+            )
+        )
+    return writer.chunks
+
+
+def _read_header(f: IO[bytes]) -> Tuple[int, int, int, int]:
+    header = f.read(_HEADER_FORMAT.size)
+    if len(header) != _HEADER_FORMAT.size:
+        raise SparseImageError("sparse header is truncated")
+    (
+        magic,
+        major_version,
+        _,
+        file_header_size,
+        chunk_header_size,
+        block_size,
+        total_blocks,
+        total_chunks,
+        _,
+    ) = _HEADER_FORMAT.unpack(header)
+    if magic != SPARSE_MAGIC:
+        raise SparseImageError("invalid sparse image magic")
+    if major_version != 1:
+        raise SparseImageError(f"unsupported sparse image version: {major_version}")
+    # skip any header extension
+    f.seek(file_header_size)
+    return chunk_header_size, block_size, total_blocks, total_chunks
+
+
+def import_sparse(src: str, dest: str) -> int:
+    """Expand an Android sparse image into a sparse raw image
+
+    DONT_CARE chunks and zero FILL chunks are left as holes in the raw image.
+
+    Args:
+        src: path of the sparse image
+        dest: path of the raw image to create
+    Returns:
+        integer size of the raw image in bytes
+    Raises:
+        SparseImageError if the sparse image is invalid
+    """
+
+    with open(src, "rb") as f, open(dest, "wb") as out:
+        chunk_header_size, block_size, total_blocks, total_chunks = _read_header(f)
+        block = 0
+        for _ in range(total_chunks):
+            header = f.read(chunk_header_size)
+            if len(header) != chunk_header_size:
+                raise SparseImageError("sparse chunk header is truncated")
+            chunk_type, _, chunk_blocks, total_size = _CHUNK_FORMAT.unpack(
+                header[: _CHUNK_FORMAT.size]
+            )
+            data_size = total_size - chunk_header_size
+            length = chunk_blocks * block_size
+            offset = block * block_size
+            if chunk_type == CHUNK_TYPE_RAW:
+                if data_size != length:
+                    raise SparseImageError(f"invalid raw chunk size: {data_size}")
+                remaining = length
+                while remaining:
+                    data = f.read(min(remaining, _READ_BLOCKS * block_size))
+                    if not data:
+                        raise SparseImageError("raw chunk is truncated")
+                    os.pwrite(out.fileno(), data, offset)
+                    offset += len(data)
+                    remaining -= len(data)
+            elif chunk_type == CHUNK_TYPE_FILL:
+                pattern = f.read(data_size)
+                if len(pattern) != 4:
+                    raise SparseImageError("invalid fill chunk")
+                if pattern != b"\x00" * 4:
+                    fill = pattern * (min(chunk_blocks, _READ_BLOCKS) * block_size // 4)
+                    while length:
+                        count = os.pwrite(out.fileno(), fill[:length], offset)
+                        offset += count
+                        length -= count
+            elif chunk_type in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+                f.seek(data_size, os.SEEK_CUR)
+            else:
+                raise SparseImageError(f"unknown chunk type: {chunk_type:#x}")
+            block += chunk_blocks
+        if block != total_blocks:
+            raise SparseImageError(
+                f"sparse image has {block} blocks, header declares {total_blocks}"
+            )
+        size = total_blocks * block_size
+        out.truncate(size)
+    return size
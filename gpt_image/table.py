@@ -6,9 +6,10 @@ import binascii
 import json
 import struct
 import uuid
+from typing import Any, Dict, Optional
 
 from gpt_image.geometry import Geometry
-from gpt_image.partition import PartitionEntryArray
+from gpt_image.partition import AlignmentPolicy, Partition, PartitionEntryArray
 
 
 class HeaderReadError(Exception):
@@ -38,9 +39,9 @@ class ProtectiveMBR:
         self.partition_type = partition_type  # GPT partition type
         self.end_chs = b"\x00"  # ignore the end CHS
         self.start_sector = self._geometry.my_lba
-        # size, minus the protective MBR sector. This only works if the
-        # disk is under 2 TB
-        self.partition_size = int(self._geometry.total_sectors - 1)
+        # size, minus the protective MBR sector. Disks of 2 TB and more are
+        # covered by the largest size the field can hold
+        self.partition_size = min(int(self._geometry.total_sectors - 1), 0xFFFFFFFF)
         self._end_padding = b"\x00"  # padding before signature
         self.signature = signature
 
@@ -128,13 +129,61 @@ class Header:
             self.partition_entry_lba = self._geometry.alternate_array_lba
 
     def __repr__(self) -> str:
-        filtered_values = {k: v for k, v in vars(self).items() if not k.startswith("_")}
-        # convert dictionary values that are bytes to strings
-        converted_values = {
-            k: v.decode() for k, v in filtered_values.items() if isinstance(v, bytes)
+        return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the header to a dictionary of plain values
+
+        Returns:
+            dictionary of strings, integers and booleans, serializable as is
+        """
+
+        return {
+            "backup": self.backup,
+            "signature": self.signature.decode(),
+            "revision": self.revision.decode(),
+            "header_size": self.header_size,
+            "header_crc32": self.header_crc32,
+            "reserved": self.reserved,
+            "my_lba": self.my_lba,
+            "alternate_lba": self.alternate_lba,
+            "first_usable_lba": self.first_usable_lba,
+            "last_usable_lba": self.last_usable_lba,
+            "disk_guid": self.disk_guid,
+            "partition_entry_lba": self.partition_entry_lba,
+            "number_of_partition_entries": self.number_of_partition_entries,
+            "size_of_partition_entries": self.size_of_partition_entries,
+            "partition_entry_array_crc32": self.partition_entry_array_crc32,
         }
-        filtered_values.update(converted_values)
-        return json.dumps(filtered_values, indent=2, ensure_ascii=False)
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any], geometry: Geometry) -> "Header":
+        """Create a Header object from a dictionary made by to_dict
+
+        Args:
+            data: dictionary of header values
+            geometry: Geometry of the disk, updated with the header LBAs
+        Returns:
+            an instance of the Header class
+        """
+
+        is_backup = bool(data["backup"])
+        my_lba, alternate_lba = data["my_lba"], data["alternate_lba"]
+        if is_backup:
+            my_lba, alternate_lba = alternate_lba, my_lba
+        geometry.my_lba = my_lba
+        geometry.alternate_lba = alternate_lba
+        geometry.first_usable_lba = data["first_usable_lba"]
+        geometry.last_usable_lba = data["last_usable_lba"]
+        if not is_backup:
+            geometry.partition_entry_lba = data["partition_entry_lba"]
+        return Header(
+            geometry,
+            data["header_crc32"],
+            data["partition_entry_array_crc32"],
+            data["disk_guid"],
+            is_backup=is_backup,
+        )
 
     def marshal(self) -> bytes:
         header_bytes = self._HEADER_FORMAT.pack(
@@ -193,7 +242,7 @@ class Header:
         geometry.last_usable_lba = last_usable_lba
         geometry.partition_entry_lba = partition_entry_lba
 
-        disk_guid = str(uuid.UUID(bytes=disk_guid))
+        disk_guid = str(uuid.UUID(bytes_le=disk_guid))
         return Header(
             geometry,
             header_crc32,
@@ -207,35 +256,103 @@ class Table:
     """GPT Partition Table Object
 
     The entire GPT table structure including the protective MBR,
-    GPT headers and partition tables
+    GPT headers and partition tables. An AlignmentPolicy applies to all
+    partitions added to the table.
     """
 
-    def __init__(self, geometry: Geometry):
+    def __init__(self, geometry: Geometry, alignment: Optional[AlignmentPolicy] = None):
         self._geometry = geometry
         self.protective_mbr: ProtectiveMBR = ProtectiveMBR(self._geometry)
         self.primary_header: Header = Header(self._geometry)
         self.secondary_header: Header = Header(
             self._geometry, guid=self.primary_header.disk_guid, is_backup=True
         )
-        self.partitions: PartitionEntryArray = PartitionEntryArray(self._geometry)
+        self.partitions: PartitionEntryArray = PartitionEntryArray(self._geometry, alignment)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the table to a dictionary of plain values
+
+        Returns:
+            dictionary of both headers and the list of partitions
+        """
+
+        return {
+            "primary_header": self.primary_header.to_dict(),
+            "backup_header": self.secondary_header.to_dict(),
+            "partitions": [p.to_dict() for p in self.partitions.entries],
+        }
+
+    @staticmethod
+    def from_dict(
+        data: Dict[str, Any], geometry: Geometry, alignment: Optional[AlignmentPolicy] = None
+    ) -> "Table":
+        """Create a Table object from a dictionary made by to_dict
+
+        Args:
+            data: dictionary of table values
+            geometry: Geometry of the disk, updated with the header LBAs
+            alignment: AlignmentPolicy applied to partitions added to the table
+        Returns:
+            an instance of the Table class
+        """
+
+        table = Table(geometry, alignment)
+        table.primary_header = Header.from_dict(data["primary_header"], geometry)
+        table.secondary_header = Header.from_dict(data["backup_header"], geometry)
+        table.partitions.entries = [Partition.from_dict(p) for p in data["partitions"]]
+        return table
+
+    def resize(self, geometry: Geometry) -> None:
+        """Move the table to the geometry of a resized disk
+
+        The protective MBR and both headers are rebuilt for the new geometry, keeping
+        the disk GUID. Partitions are not changed.
+
+        Args:
+            geometry: Geometry of the resized disk
+        """
+        geometry.first_usable_lba = self._geometry.first_usable_lba
+        geometry.partition_entry_lba = self._geometry.partition_entry_lba
+        geometry.primary_array_byte = self._geometry.primary_array_byte
+        self._geometry = geometry
+        self.protective_mbr = ProtectiveMBR(
+            geometry, self.protective_mbr.partition_type, self.protective_mbr.signature
+        )
+        guid = self.primary_header.disk_guid
+        self.primary_header = Header(geometry, guid=guid)
+        self.secondary_header = Header(geometry, guid=guid, is_backup=True)
+        self.partitions._geometry = geometry
+
+    def update(self, partition_bytes: Optional[bytes] = None) -> None:
+        """Update the partition and header checksums of both headers
 
-    def update(self) -> None:
+        Args:
+            partition_bytes: marshalled partition entry array, marshalled from the
+                partitions if not set
+        """
+        if partition_bytes is None:
+            partition_bytes = self.partitions.marshal()
         # calculate partition checksum and write to header
-        self.checksum_partitions(self.primary_header)
-        self.checksum_partitions(self.secondary_header)
+        self.checksum_partitions(self.primary_header, partition_bytes)
+        self.checksum_partitions(self.secondary_header, partition_bytes)
 
         # calculate header checksum and write to header
         self.checksum_header(self.primary_header)
         self.checksum_header(self.secondary_header)
 
-    def checksum_partitions(self, header: Header) -> None:
+    def checksum_partitions(
+        self, header: Header, partition_bytes: Optional[bytes] = None
+    ) -> None:
         """Checksum the partition entries
 
         Args:
             header: initialized GPT header object
+            partition_bytes: marshalled partition entry array, marshalled from the
+                partitions if not set
         """
-        part_entry_bytes = self.partitions.marshal()
-        header.partition_entry_array_crc32 = binascii.crc32(part_entry_bytes)
+        if partition_bytes is None:
+            partition_bytes = self.partitions.marshal()
+        header.partition_entry_array_crc32 = binascii.crc32(partition_bytes)
 
     def checksum_header(self, header: Header) -> None:
         """Checksum the table header
@@ -0,0 +1,142 @@
+"""
+Progress reporting and bandwidth limiting of bulk copies
+
+Long copies, such as partition data moves, large partition writes, flashing and
+exports, report their progress to a callback and can be limited to a bandwidth so
+that they share a disk with other workloads. The limit is a token bucket: bytes
+may be copied in bursts of up to one second of bandwidth, and copies wait once
+the bucket is empty.
+
+A progress callback is called with the bytes done, the total bytes and the
+estimated seconds left, None until the first bytes are done.
+
+"""
+import threading
+import time
+from typing import Callable, Optional
+
+ProgressCallback = Callable[[int, int, Optional[float]], None]
+
+# least seconds between progress reports, the last report is always made
+REPORT_INTERVAL = 0.5
+
+
+class TokenBucket:
+    """Token bucket limiting a rate of bytes
+
+    Args:
+        rate: bytes per second
+        burst: bytes that can be taken at once without waiting (default rate)
+    Raises:
+        ValueError if the rate is not positive
+    """
+
+    def __init__(self, rate: int, burst: Optional[int] = None):
+        if rate <= 0:
+            raise ValueError(f"bandwidth limit must be positive: {rate}")
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count: int) -> None:
+        """Take bytes from the bucket, waiting until they are available
+
+        Taking more bytes than the bucket holds leaves it in debt, which later
+        takes wait for as well, so the rate holds across threads.
+
+        Args:
+            count: number of bytes
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.burst), self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= count
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Progress:
+    """Progress of a bulk copy
+
+    Copies call update as bytes are done, from any thread.
+
+    Attributes:
+        total: integer count of bytes to copy
+        done: integer count of bytes copied
+        callback: function called with the bytes done, total and estimated
+            seconds left
+        limit: TokenBucket the copied bytes are taken from
+    """
+
+    def __init__(
+        self,
+        total: int,
+        callback: Optional[ProgressCallback] = None,
+        limit: Optional[TokenBucket] = None,
+    ):
+        self.total = total
+        self.done = 0
+        self.callback = callback
+        self.limit = limit
+        self._started = time.monotonic()
+        self._reported = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Estimated seconds left, None until bytes are done"""
+
+        if self.done == 0:
+            return None
+        elapsed = time.monotonic() - self._started
+        return elapsed * max(self.total - self.done, 0) / self.done
+
+    def update(self, count: int) -> None:
+        """Count copied bytes, waiting for the bandwidth limit
+
+        Args:
+            count: number of bytes copied
+        """
+
+        if self.limit is not None:
+            self.limit.consume(count)
+        if self.callback is None:
+            with self._lock:
+                self.done += count
+            return
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self._reported < REPORT_INTERVAL and self.done < self.total:
+                return
+            self._reported = now
+            report = (self.done, self.total, self.eta)
+        self.callback(*report)
+
+
+def start(
+    total: int,
+    callback: Optional[ProgressCallback] = None,
+    bandwidth_limit: Optional[int] = None,
+) -> Optional[Progress]:
+    """Start tracking a bulk copy
+
+    Args:
+        total: integer count of bytes to copy
+        callback: function called with the progress of the copy
+        bandwidth_limit: most bytes copied per second
+    Returns:
+        Progress of the copy, or None if there is neither a callback nor a limit
+    """
+
+    if callback is None and bandwidth_limit is None:
+        return None
+    limit = TokenBucket(bandwidth_limit) if bandwidth_limit is not None else None
+    return Progress(total, callback, limit)
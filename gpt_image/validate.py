@@ -0,0 +1,175 @@
+"""
+Structural validation of partition tables
+
+The partition extents are sorted once and swept in order, keeping the set of
+extents that are still open, so validating a table is O(n log n + k) for n
+partitions and k overlapping pairs. Staged LBAs are validated, so a layout
+can be checked before it is committed.
+"""
+from __future__ import annotations
+
+import heapq
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.disk import Disk
+    from gpt_image.partition import AlignmentPolicy, Partition
+    from gpt_image.table import Table
+
+# problem codes
+OVERLAP = "overlap"
+OUT_OF_BOUNDS = "out_of_bounds"
+INVALID_EXTENT = "invalid_extent"
+DUPLICATE_GUID = "duplicate_guid"
+MISALIGNED = "misaligned"
+UNREADABLE = "unreadable"
+PENDING_JOURNAL = "pending_journal"
+
+
+class Problem:
+    """A problem found in a partition table
+
+    Attributes:
+        code: string problem code, one of the module problem code constants
+        message: string description of the problem
+        partitions: list of the names of the partitions involved
+    """
+
+    def __init__(self, code: str, message: str, partitions: Optional[List[str]] = None):
+        self.code = code
+        self.message = message
+        self.partitions = partitions or []
+
+    def __repr__(self) -> str:
+        return json.dumps(vars(self), ensure_ascii=False)
+
+
+def validate_table(table: Table, alignment: Optional[AlignmentPolicy] = None) -> List[Problem]:
+    """Find every overlap, bounds and duplicate GUID problem of a partition table
+
+    Args:
+        table: GPT Table instance
+        alignment: AlignmentPolicy to also check partition alignment against
+    Returns:
+        list of Problem, empty if the table is valid
+    """
+
+    first_usable = table.primary_header.first_usable_lba
+    last_usable = table.primary_header.last_usable_lba
+    problems: List[Problem] = []
+    entries = table.partitions.entries
+
+    guids: Dict[str, List[str]] = {}
+    for partition in entries:
+        name = partition.partition_name
+        guids.setdefault(partition.partition_guid.lower(), []).append(name)
+        first_lba, last_lba = partition.first_lba_staged, partition.last_lba_staged
+        if last_lba < first_lba:
+            problems.append(
+                Problem(
+                    INVALID_EXTENT,
+                    f"partition {name} ends at LBA {last_lba} before it starts at {first_lba}",
+                    [name],
+                )
+            )
+        elif first_lba < first_usable or last_lba > last_usable:
+            problems.append(
+                Problem(
+                    OUT_OF_BOUNDS,
+                    f"partition {name} LBA {first_lba}-{last_lba} is outside the usable "
+                    f"LBA {first_usable}-{last_usable}",
+                    [name],
+                )
+            )
+    for guid, names in guids.items():
+        if len(names) > 1:
+            problems.append(
+                Problem(DUPLICATE_GUID, f"partitions {', '.join(names)} share GUID {guid}", names)
+            )
+
+    # sweep the extents in start order against every extent still open, which are
+    # kept in a heap by their last LBA
+    ordered = sorted(
+        (p for p in entries if p.last_lba_staged >= p.first_lba_staged),
+        key=lambda p: p.first_lba_staged,
+    )
+    active: List[Tuple[int, int, Partition]] = []
+    for i, partition in enumerate(ordered):
+        first_lba = partition.first_lba_staged
+        while active and active[0][0] < first_lba:
+            heapq.heappop(active)
+        for last_lba, _, other in sorted(active, key=lambda a: a[:2]):
+            names = [other.partition_name, partition.partition_name]
+            problems.append(
+                Problem(
+                    OVERLAP,
+                    f"partition {names[1]} starting at LBA {first_lba} "
+                    f"overlaps partition {names[0]} ending at LBA {last_lba}",
+                    names,
+                )
+            )
+        heapq.heappush(active, (partition.last_lba_staged, i, partition))
+
+    if alignment is not None:
+        for partition, message in table.partitions.misaligned(alignment):
+            name = partition.partition_name
+            problems.append(Problem(MISALIGNED, f"partition {name} {message}", [name]))
+    return problems
+
+
+def validate_disk(disk: Disk, alignment: Optional[AlignmentPolicy] = None) -> List[Problem]:
+    """Validate the partition table of a disk
+
+    Args:
+        disk: GPT Disk instance
+        alignment: AlignmentPolicy to also check partition alignment against
+    Returns:
+        list of Problem, empty if the table is valid
+    """
+
+    return validate_table(disk.table, alignment)
+
+
+def validate_images(
+    image_paths: Iterable[str],
+    alignment: Optional[AlignmentPolicy] = None,
+    workers: Optional[int] = None,
+) -> Dict[str, List[Problem]]:
+    """Validate the partition tables of many images in parallel
+
+    Only the GPT metadata of each image is read, and nothing is written: an
+    interrupted commit is not recovered but reported as a PENDING_JOURNAL problem.
+    An image that cannot be opened is reported with a single UNREADABLE problem.
+
+    Args:
+        image_paths: paths of the disk images
+        alignment: AlignmentPolicy to also check partition alignment against
+        workers: number of threads (default CPU count)
+    Returns:
+        dictionary of image path to its list of Problem
+    """
+
+    from gpt_image.disk import Disk
+
+    def validate_image(image_path: str) -> List[Problem]:
+        try:
+            disk = Disk.open(image_path, recover=False)
+        except Exception as e:
+            return [Problem(UNREADABLE, f"unable to read {image_path}: {e}")]
+        problems = validate_disk(disk, alignment)
+        if disk.pending_journal:
+            problems.insert(
+                0,
+                Problem(
+                    PENDING_JOURNAL,
+                    f"{image_path} has an interrupted commit; open it to recover",
+                ),
+            )
+        return problems
+
+    paths = [str(path) for path in image_paths]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        return dict(zip(paths, executor.map(validate_image, paths)))
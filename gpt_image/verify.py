@@ -0,0 +1,318 @@
+"""
+Verification of written data against digests taken while writing
+
+A WriteLog takes a digest of every block of data as it is written, so checking a
+target later only needs one read of the written ranges, without the source. The
+ranges of a disk are checked in parallel, one thread per partition. A block that
+does not match is compared sector by sector with the source image, where it still
+holds the data as written, so that mismatches are reported as exact LBA ranges;
+otherwise the whole block is reported.
+
+A range written again replaces the digests of the earlier writes it overlaps;
+the parts of the earlier blocks outside of the range are read again and kept.
+
+"""
+from __future__ import annotations
+
+import bisect
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
+
+from gpt_image import extents
+from gpt_image.backend import Backend
+
+if TYPE_CHECKING:  # a bit of a hack to allow typing to work
+    from gpt_image.disk import Disk
+
+# bytes covered by each digest
+BLOCK_SIZE = 1024 * 1024
+
+# start, end and digest of a written block
+Entry = Tuple[int, int, bytes]
+
+
+def _digest(data: Union[bytes, memoryview]) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _split(start: int, end: int, size: int) -> List[int]:
+    """Boundaries of a byte range split at the multiples of a size
+
+    Returns:
+        list of the start, every multiple of size within the range, and the end
+    """
+
+    return [start, *range(start - start % size + size, end, size), end]
+
+
+class Mismatch:
+    """A written range that does not read back as written
+
+    Attributes:
+        first_lba: integer first LBA of the range
+        last_lba: integer last LBA of the range
+        partition: string name of the partition holding the range, None for the
+            GPT metadata
+    """
+
+    def __init__(self, first_lba: int, last_lba: int, partition: Optional[str] = None):
+        self.first_lba = first_lba
+        self.last_lba = last_lba
+        self.partition = partition
+
+    def __repr__(self) -> str:
+        return json.dumps(vars(self), ensure_ascii=False)
+
+
+class WriteLog:
+    """Digests of the blocks written to an image
+
+    Writes are split into blocks at the multiples of the block size.
+
+    Args:
+        block_size: bytes covered by each digest
+    """
+
+    def __init__(self, block_size: int = BLOCK_SIZE):
+        self.block_size = block_size
+        # sorted block starts, and the end and digest of each block
+        self._starts: List[int] = []
+        self._blocks: Dict[int, Tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def record(
+        self,
+        offset: int,
+        data: bytes,
+        pread: Optional[Callable[[int, int], bytes]] = None,
+    ) -> None:
+        """Take the digests of written data
+
+        Args:
+            offset: byte offset the data was written at
+            data: bytes written
+            pread: function reading (size, offset) bytes from the image, to take
+                the digests of the parts of earlier blocks that the write leaves;
+                those parts are no longer checked if not set
+        """
+
+        view = memoryview(data)
+        if not view:
+            return
+        end = offset + len(view)
+        bounds = _split(offset, end, self.block_size)
+        blocks = [
+            (start, block_end, _digest(view[start - offset : block_end - offset]))
+            for start, block_end in zip(bounds, bounds[1:])
+        ]
+        self._replace(offset, end, blocks, pread)
+
+    def discard(
+        self,
+        start: int,
+        end: int,
+        pread: Optional[Callable[[int, int], bytes]] = None,
+    ) -> None:
+        """Forget the digests of a byte range, such as a truncated tail
+
+        Args:
+            start: first byte of the range
+            end: byte after the range
+            pread: function reading (size, offset) bytes from the image, see record
+        """
+
+        if start < end:
+            self._replace(start, end, [], pread)
+
+    def _replace(
+        self,
+        offset: int,
+        end: int,
+        blocks: List[Entry],
+        pread: Optional[Callable[[int, int], bytes]],
+    ) -> None:
+        with self._lock:
+            first = bisect.bisect_left(self._starts, offset)
+            # a block starting before the range may reach into it
+            if first and self._blocks[self._starts[first - 1]][0] > offset:
+                first -= 1
+            last = bisect.bisect_left(self._starts, end, first)
+            kept: List[Entry] = []
+            for start in self._starts[first:last]:
+                block_end, _ = self._blocks.pop(start)
+                # the parts of the block before and after the range
+                parts = ((start, min(block_end, offset)), (max(start, end), block_end))
+                for part_start, part_end in parts:
+                    if part_start >= part_end or pread is None:
+                        continue
+                    data = pread(part_end - part_start, part_start)
+                    if len(data) == part_end - part_start:
+                        kept.append((part_start, part_end, _digest(data)))
+            entries = sorted(kept + blocks, key=lambda entry: entry[0])
+            self._starts[first:last] = [start for start, _, _ in entries]
+            for start, block_end, digest in entries:
+                self._blocks[start] = (block_end, digest)
+
+    def entries(self) -> List[Entry]:
+        """List the written blocks in offset order"""
+
+        with self._lock:
+            return [(start, *self._blocks[start]) for start in self._starts]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._starts = []
+            self._blocks = {}
+
+
+class RecordingBackend(Backend):
+    """Backend taking the digests of the writes to another backend
+
+    Args:
+        storage: Backend written to
+        log: WriteLog the digests are recorded in
+    """
+
+    def __init__(self, storage: Backend, log: WriteLog):
+        super().__init__(storage.path, storage.preferred_io_size)
+        self.storage = storage
+        self.log = log
+
+    def size(self) -> int:
+        return self.storage.size()
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return self.storage.pread(size, offset)
+
+    def pwrite(self, data: bytes, offset: int) -> int:
+        count = self.storage.pwrite(data, offset)
+        self.log.record(
+            offset, data if count == len(data) else data[:count], self.storage.pread
+        )
+        return count
+
+    def truncate(self, size: int) -> None:
+        self.storage.truncate(size)
+        self.log.discard(size, sys.maxsize, self.storage.pread)
+
+    def data_extents(self, start: int, end: int) -> List[extents.Extent]:
+        return self.storage.data_extents(start, end)
+
+    def deallocate(self, start: int, end: int) -> bool:
+        if not self.storage.deallocate(start, end):
+            return False
+        # the range reads back as zeros, which replace the earlier digests
+        zeros = bytes(min(self.log.block_size, end - start))
+        for offset in range(start, end, len(zeros)):
+            self.log.record(offset, zeros[: end - offset], self.storage.pread)
+        return True
+
+    def sync(self) -> None:
+        self.storage.sync()
+
+    def close(self) -> None:
+        self.storage.close()
+
+
+def check(
+    storage: Backend,
+    entries: List[Entry],
+    source: Optional[Backend] = None,
+    sector_size: int = 512,
+) -> List[extents.Extent]:
+    """Read written blocks back and compare them with their digests
+
+    A block that does not match is compared sector by sector with the source, if
+    the source still matches the digest; otherwise the whole block is reported.
+
+    Args:
+        storage: Backend of the written image
+        entries: list of (start, end, digest) written blocks
+        source: Backend of the image the blocks were written from
+        sector_size: bytes of each sector compared with the source
+    Returns:
+        sorted list of merged (start, end) byte ranges that do not match
+    """
+
+    mismatches = []
+    for start, end, digest in entries:
+        data = storage.pread(end - start, start)
+        if _digest(data) == digest:
+            continue
+        expected = source.pread(end - start, start) if source is not None else b""
+        if _digest(expected) != digest:
+            mismatches.append((start, end))
+            continue
+        bounds = _split(start, end, sector_size)
+        mismatches.extend(
+            (a, b)
+            for a, b in zip(bounds, bounds[1:])
+            if data[a - start : b - start] != expected[a - start : b - start]
+        )
+    return extents.merge(mismatches)
+
+
+def verify_disk(
+    disk: Disk,
+    log: WriteLog,
+    workers: Optional[int] = None,
+    storage: Optional[Backend] = None,
+) -> List[Mismatch]:
+    """Check the blocks written to a disk
+
+    The blocks of each partition, and those of the GPT metadata, are read back by
+    their own thread. When checking another storage, mismatching blocks are
+    compared with the disk image to find the sectors that differ.
+
+    Args:
+        disk: GPT Disk instance
+        log: WriteLog of the writes to the disk
+        workers: number of threads (default CPU count)
+        storage: Backend to check instead of the disk image, such as a device the
+            image was flashed to
+    Returns:
+        list of Mismatch in LBA order, empty if every block matches
+    """
+
+    sector_size = disk.sector_size
+    partitions = sorted(disk.table.partitions.entries, key=lambda p: p.first_lba)
+    starts = [p.first_lba * sector_size for p in partitions]
+    groups: Dict[Optional[str], List[Entry]] = {}
+    for entry in log.entries():
+        i = bisect.bisect_right(starts, entry[0]) - 1
+        inside = i >= 0 and entry[0] < (partitions[i].last_lba + 1) * sector_size
+        groups.setdefault(partitions[i].partition_name if inside else None, []).append(entry)
+
+    with disk.storage(writable=False) as image:
+        if storage is None:
+            return _verify_groups(image, None, groups, sector_size, workers)
+        return _verify_groups(storage, image, groups, sector_size, workers)
+
+
+def _verify_groups(
+    storage: Backend,
+    source: Optional[Backend],
+    groups: Dict[Optional[str], List[Entry]],
+    sector_size: int,
+    workers: Optional[int],
+) -> List[Mismatch]:
+    mismatches: List[Mismatch] = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = {
+            name: executor.submit(check, storage, entries, source, sector_size)
+            for name, entries in groups.items()
+        }
+        for name, future in results.items():
+            mismatches.extend(
+                Mismatch(start // sector_size, (end - 1) // sector_size, name)
+                for start, end in future.result()
+            )
+    return sorted(mismatches, key=lambda m: m.first_lba)
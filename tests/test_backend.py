@@ -0,0 +1,88 @@
+import hashlib
+
+import pytest
+
+from gpt_image import backend
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 4 * 1024 * 1024  # 4 MB
+PART_SIZE = 512 * 1024
+DATA = bytes(range(256)) * (PART_SIZE // 256)
+
+
+def _create(disk):
+    disk.create(DISK_SIZE)
+    for i in range(2):
+        disk.table.partitions.add(
+            Partition(f"partition{i}", PART_SIZE, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+    disk.commit()
+    disk.table.partitions.entries[1].write_data(disk, DATA)
+
+
+def test_memory_backend(tmp_path):
+    image = tmp_path / "test.img"
+    disk = Disk(image, backend=backend.MemoryBackend())
+    _create(disk)
+    assert not image.exists()
+    disk.table.partitions.remove("partition0")
+    disk.commit()
+    assert disk.table.partitions.entries[0].read(disk) == DATA
+
+    disk.backend.write_to(image)
+    reopened = Disk.open(image)
+    assert reopened.size == DISK_SIZE
+    assert reopened.table.partitions.find("partition1").read(reopened) == DATA
+    assert reopened.table.partitions.entries[0].first_lba == (
+        disk.table.partitions.entries[0].first_lba
+    )
+
+
+def test_memory_backend_exports(tmp_path):
+    image = tmp_path / "test.img"
+    disk = Disk(image, backend=backend.MemoryBackend())
+    _create(disk)
+    digests = disk.hash_partitions()
+    assert digests[1].digest == hashlib.sha256(DATA).hexdigest()
+    disk.export_sparse(tmp_path / "test.simg")
+    assert not image.exists()
+
+    expanded = Disk.import_sparse(tmp_path / "test.simg", tmp_path / "expanded.img")
+    assert expanded.table.partitions.find("partition1").read(expanded) == DATA
+
+
+def test_mmap_backend(tmp_path):
+    image = tmp_path / "test.img"
+    _create(Disk(image))
+    with backend.MmapBackend(image) as storage:
+        disk = Disk.open(image, backend=storage)
+        disk.table.partitions.resize("partition0", PART_SIZE * 2)
+        disk.commit()
+        assert disk.table.partitions.find("partition1").read(disk) == DATA
+    reopened = Disk.open(image)
+    assert reopened.table.partitions.find("partition1").read(reopened) == DATA
+
+
+def test_block_device_backend_unaligned(tmp_path):
+    image = tmp_path / "test.img"
+    image.write_bytes(bytes(64 * 1024))
+    try:
+        storage = backend.BlockDeviceBackend(image)
+    except OSError:
+        pytest.skip("direct I/O is not supported here")
+    with storage:
+        assert storage.pwrite(DATA[:1000], 100) == 1000
+        assert storage.pread(1000, 100) == DATA[:1000]
+        assert storage.pread(2000, 0)[:100] == bytes(100)
+        with pytest.raises(backend.BackendError):
+            storage.truncate(128 * 1024)
+
+
+def test_backend_abstract():
+    class Incomplete(backend.Backend):
+        def size(self):
+            return 0
+
+    with pytest.raises(TypeError):
+        Incomplete(None, 4096)
@@ -0,0 +1,61 @@
+import pytest
+
+from gpt_image.bmap import BmapError, read_bmap
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+BYTE_DATA = b"\x01\x02\x03\x04" * 1024
+
+
+@pytest.fixture
+def new_image(tmp_path):
+    image_name = tmp_path / "test.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    part1 = Partition("partition1", 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    part2 = Partition("partition2", 2 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    disk.table.partitions.add(part1)
+    disk.table.partitions.add(part2)
+    disk.commit()
+    part2.write_data(disk, BYTE_DATA, 64 * 1024)
+    return image_name
+
+
+def test_write_bmap(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    bmap_path = tmp_path / "test.bmap"
+    mapped = disk.write_bmap(bmap_path)
+    image_size, ranges = read_bmap(bmap_path)
+    assert image_size == DISK_SIZE
+    assert sum(end - start for start, end, _ in ranges) == mapped * 4096
+    # GPT metadata at both ends of the disk is always mapped
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == DISK_SIZE
+    assert mapped < DISK_SIZE // 4096
+
+
+def test_flash(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    bmap_path = tmp_path / "test.bmap"
+    disk.write_bmap(bmap_path)
+    dest = tmp_path / "dest.img"
+    dest.write_bytes(b"\xff" * 1024)
+    written = disk.flash(dest, bmap_path)
+    assert written < DISK_SIZE
+    assert dest.read_bytes() == new_image.read_bytes()
+
+
+def test_flash_checksum_mismatch(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    bmap_path = tmp_path / "test.bmap"
+    disk.write_bmap(bmap_path)
+    part = disk.table.partitions.find("partition2")
+    part.write_data(disk, b"\xff" * 4, 64 * 1024)
+    with pytest.raises(BmapError):
+        disk.flash(tmp_path / "dest.img", bmap_path)
+
+    # a modified bmap file is rejected
+    bmap_path.write_text(bmap_path.read_text().replace("<BlockSize> 4096", "<BlockSize> 512"))
+    with pytest.raises(BmapError):
+        read_bmap(bmap_path)
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+from gpt_image import hashing
+from gpt_image.cache import MetadataCache
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+BYTE_DATA = b"\x01\x02\x03\x04" * 1024
+
+
+@pytest.fixture
+def new_image(tmp_path):
+    image_name = tmp_path / "test.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    part1 = Partition("partition1", 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    part2 = Partition("partition2", 2 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    disk.table.partitions.add(part1)
+    disk.table.partitions.add(part2)
+    disk.commit()
+    part1.write_data(disk, BYTE_DATA)
+    return image_name
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with MetadataCache(str(tmp_path / "cache.db")) as cache:
+        yield cache
+
+
+def test_cached_open(new_image, cache):
+    assert cache.get_metadata(str(new_image)) is None
+    disk = Disk.open(new_image, cache=cache)
+    size, head, tail = cache.get_metadata(str(new_image))
+    assert size == DISK_SIZE
+    assert len(head) == 34 * 512
+    cached = Disk.open(new_image, cache=cache)
+    assert str(cached) == str(disk)
+
+    # any change to the image invalidates the entry
+    cached.table.partitions.find("partition2").partition_name = "renamed"
+    cached.commit()
+    assert cache.get_metadata(str(new_image)) is None
+    assert Disk.open(new_image, cache=cache).table.partitions.find("renamed")
+
+
+def test_cached_digests(new_image, cache, monkeypatch):
+    disk = Disk.open(new_image)
+    digests = disk.hash_partitions(merkle=True, cache=cache)
+
+    def fail(*args):
+        raise AssertionError("partition was rehashed")
+
+    monkeypatch.setattr(hashing, "hash_partition", fail)
+    cached = disk.hash_partitions(merkle=True, cache=cache)
+    assert [d.digest for d in cached] == [d.digest for d in digests]
+    assert cached[0].tree.root == digests[0].tree.root
+    # digests without a tree are served from the same entries
+    assert disk.hash_partitions(cache=cache)[1].digest == digests[1].digest
+    monkeypatch.undo()
+
+    disk.table.partitions.find("partition1").write_data(disk, b"\xff")
+    assert disk.hash_partitions(cache=cache)[0].digest != digests[0].digest
+
+
+def test_cache_eviction(new_image, tmp_path):
+    path = str(tmp_path / "cache.db")
+    with MetadataCache(path) as cache:
+        Disk.open(new_image, cache=cache)
+    with MetadataCache(path, max_entries=1) as cache:
+        assert cache.get_metadata(str(new_image)) is not None
+        other = tmp_path / "other.img"
+        Disk(other).create(DISK_SIZE)
+        Disk.open(other, cache=cache)
+        assert cache.get_metadata(str(new_image)) is None
+    time.sleep(0.01)
+    with MetadataCache(path, max_age=0.001) as cache:
+        assert cache.get_metadata(str(other)) is None
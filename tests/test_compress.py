@@ -0,0 +1,220 @@
+import bz2
+import gzip
+import lzma
+import shutil
+import subprocess
+
+import pytest
+
+from gpt_image import compress
+from gpt_image.compress import CompressionError
+from gpt_image.disk import Disk, DiskReadError, DiskWriteError
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+BYTE_DATA = b"\x01\x02\x03\x04" * 1024
+BLOCK_SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def new_image(tmp_path):
+    image_name = tmp_path / "test.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    part1 = Partition("partition1", 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    part2 = Partition("partition2", 2 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    disk.table.partitions.add(part1)
+    disk.table.partitions.add(part2)
+    disk.commit()
+    part2.write_data(disk, BYTE_DATA, 64 * 1024)
+    return image_name
+
+
+@pytest.mark.parametrize(
+    "compression,decompress",
+    [("gz", gzip.decompress), ("xz", lzma.decompress), ("bz2", bz2.decompress)],
+)
+def test_export(new_image, tmp_path, compression, decompress):
+    disk = Disk.open(new_image)
+    dest = tmp_path / f"test.img.{compression}"
+    written = disk.export(dest, compression, threads=2, block_size=BLOCK_SIZE)
+    assert written == dest.stat().st_size
+    assert decompress(dest.read_bytes()) == new_image.read_bytes()
+
+
+def test_export_single_thread(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    dest = tmp_path / "test.img.gz"
+    disk.export(dest, "gz", threads=1)
+    assert gzip.decompress(dest.read_bytes()) == new_image.read_bytes()
+    with pytest.raises(CompressionError):
+        disk.export(dest, "zip")
+
+
+def test_export_progress(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    reports = []
+    disk.progress = lambda *report: reports.append(report)
+    disk.export(tmp_path / "test.img.gz", "gz", threads=1, block_size=BLOCK_SIZE)
+    # only the mapped bytes that are read count, the holes of the image do not
+    mapped = sum(end - start for start, end in disk.mapped_extents())
+    assert mapped < DISK_SIZE
+    assert reports[-1][:2] == (mapped, mapped)
+
+
+def test_export_data_outside_partitions(new_image, tmp_path):
+    # a bootloader written in the gap after the primary GPT
+    with open(new_image, "r+b") as f:
+        f.seek(34 * 512)
+        f.write(BYTE_DATA)
+    disk = Disk.open(new_image)
+    dest = tmp_path / "test.img.gz"
+    disk.export(dest, "gz", threads=1)
+    assert gzip.decompress(dest.read_bytes()) == new_image.read_bytes()
+    disk.export(dest, "gz", threads=1, partitions_only=True)
+    assert BYTE_DATA not in gzip.decompress(dest.read_bytes())[: 1024 * 1024]
+
+
+@pytest.mark.parametrize(
+    "compression,compress_image",
+    [("gz", gzip.compress), ("xz", lzma.compress), ("bz2", bz2.compress)],
+)
+def test_read_compressed_in_order(new_image, tmp_path, monkeypatch, compression, compress_image):
+    raw = new_image.read_bytes()
+    dest = tmp_path / f"test.img.{compression}"
+    # a single member or block, so every read starts from the same decompressor
+    dest.write_bytes(compress_image(raw))
+    decompressed = []
+    read = compress._Reader.read
+
+    def counted(self, size):
+        data = read(self, size)
+        decompressed.append(len(data))
+        return data
+
+    monkeypatch.setattr(compress._Reader, "read", counted)
+    image = compress.CompressedImage(str(dest))
+    chunk = 64 * 1024
+    data = b"".join(image.pread(chunk, offset) for offset in range(0, DISK_SIZE, chunk))
+    assert data == raw
+    assert sum(decompressed) == DISK_SIZE
+    # reading backwards starts again from the start of the member or block
+    assert image.pread(512, 4096) == raw[4096:4608]
+    assert sum(decompressed) == DISK_SIZE + 4608
+    image.close()
+
+
+@pytest.mark.skipif(shutil.which("xz") is None, reason="requires xz utility")
+def test_export_xz_tool(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    dest = tmp_path / "test.img.xz"
+    disk.export(dest, "xz", block_size=BLOCK_SIZE)
+    result = subprocess.run(["xz", "-dc", dest], capture_output=True)
+    assert result.returncode == 0
+    assert result.stdout == new_image.read_bytes()
+
+
+def assert_same_table(disk, other):
+    assert other.size == disk.size
+    assert other.table.primary_header.disk_guid == disk.table.primary_header.disk_guid
+    assert [p.partition_name for p in other.table.partitions.entries] == [
+        p.partition_name for p in disk.table.partitions.entries
+    ]
+
+
+@pytest.mark.parametrize("compression", ["gz", "xz", "bz2"])
+def test_open_compressed(new_image, tmp_path, compression):
+    disk = Disk.open(new_image)
+    dest = tmp_path / f"test.img.{compression}"
+    disk.export(dest, compression, threads=1, block_size=BLOCK_SIZE)
+    compressed = Disk.open(dest)
+    assert compressed.compression == compression
+    assert_same_table(disk, compressed)
+    # the index is reused on the next open
+    compressed = Disk.open(dest)
+    assert_same_table(disk, compressed)
+    with pytest.raises(DiskWriteError):
+        compressed.commit()
+
+
+@pytest.mark.parametrize("compression", ["gz", "xz"])
+def test_read_compressed_data(new_image, tmp_path, compression):
+    disk = Disk.open(new_image)
+    dest = tmp_path / f"test.img.{compression}"
+    disk.export(dest, compression, threads=1, block_size=BLOCK_SIZE)
+    compressed = Disk.open(dest)
+    part = compressed.table.partitions.find("partition2")
+    assert part.read(compressed) == disk.table.partitions.find("partition2").read(disk)
+    assert [d.digest for d in compressed.hash_partitions()] == [
+        d.digest for d in disk.hash_partitions()
+    ]
+    compressed.export_sparse(tmp_path / "test.simg")
+    expanded = Disk.import_sparse(tmp_path / "test.simg", tmp_path / "expanded.img")
+    assert (tmp_path / "expanded.img").read_bytes() == new_image.read_bytes()
+    assert expanded.size == DISK_SIZE
+    with pytest.raises(DiskWriteError):
+        part.write_data(compressed, BYTE_DATA)
+
+
+def test_open_compressed_single_member(new_image, tmp_path, monkeypatch):
+    disk = Disk.open(new_image)
+    dest = tmp_path / "test.img.gz"
+    dest.write_bytes(gzip.compress(new_image.read_bytes()))
+    # force the uncompressed tail to be kept in the index
+    monkeypatch.setattr(compress, "_TAIL_MEMBER_SIZE", 0)
+    # read-only opens do not write the index
+    assert_same_table(disk, Disk.open(dest, recover=False))
+    assert not (tmp_path / "test.img.gz.gptidx").exists()
+    compress.CompressedImage(str(dest), write_index=False)
+    assert not (tmp_path / "test.img.gz.gptidx").exists()
+    assert_same_table(disk, Disk.open(dest))
+    assert (tmp_path / "test.img.gz.gptidx").exists()
+    # later opens read the index instead of scanning the image again
+    with monkeypatch.context() as m:
+        m.setattr(compress, "_scan_members", None)
+        assert_same_table(disk, Disk.open(dest))
+        assert_same_table(disk, Disk.open(dest, recover=False))
+
+    dest.write_bytes(gzip.compress(new_image.read_bytes())[:-1024])
+    with pytest.raises(DiskReadError):
+        Disk.open(dest)
+
+
+@pytest.mark.parametrize(
+    "compression,compress_image",
+    [("gz", gzip.compress), ("xz", lzma.compress), ("bz2", bz2.compress)],
+)
+def test_read_compressed_in_order(new_image, tmp_path, monkeypatch, compression, compress_image):
+    raw = new_image.read_bytes()
+    dest = tmp_path / f"test.img.{compression}"
+    # a single member or block, so every read starts from the same decompressor
+    dest.write_bytes(compress_image(raw))
+    decompressed = []
+    read = compress._Reader.read
+
+    def counted(self, size):
+        data = read(self, size)
+        decompressed.append(len(data))
+        return data
+
+    monkeypatch.setattr(compress._Reader, "read", counted)
+    image = compress.CompressedImage(str(dest))
+    chunk = 64 * 1024
+    data = b"".join(image.pread(chunk, offset) for offset in range(0, DISK_SIZE, chunk))
+    assert data == raw
+    assert sum(decompressed) == DISK_SIZE
+    # reading backwards starts again from the start of the member or block
+    assert image.pread(512, 4096) == raw[4096:4608]
+    assert sum(decompressed) == DISK_SIZE + 4608
+    image.close()
+
+
+@pytest.mark.skipif(shutil.which("xz") is None, reason="requires xz utility")
+def test_open_xz_tool_blocks(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    dest = tmp_path / "test.img.xz"
+    subprocess.run(["xz", "-k", "-T2", "--block-size=1MiB", new_image], check=True)
+    image = compress.CompressedImage(str(dest))
+    assert len(image._blocks) == DISK_SIZE // BLOCK_SIZE
+    assert image.pread(16, DISK_SIZE - 512) == new_image.read_bytes()[-512:-496]
+    assert_same_table(disk, Disk.open(dest))
@@ -0,0 +1,104 @@
+import shutil
+
+import pytest
+
+from gpt_image import delta
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+BYTE_DATA = b"\x01\x02\x03\x04" * 1024
+
+
+@pytest.fixture
+def base_image(tmp_path):
+    image_name = tmp_path / "base.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    part1 = Partition("partition1", 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    part2 = Partition("partition2", 2 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    disk.table.partitions.add(part1)
+    disk.table.partitions.add(part2)
+    disk.commit()
+    part1.write_data(disk, BYTE_DATA)
+    part2.write_data(disk, BYTE_DATA)
+    return image_name
+
+
+def test_diff_apply(base_image, tmp_path):
+    new_image = tmp_path / "new.img"
+    shutil.copy(base_image, new_image)
+    new = Disk.open(new_image)
+    part2 = new.table.partitions.find("partition2")
+    part2.write_data(new, b"\xff" * 10, 256 * 1024)
+    new.table.partitions.add(
+        Partition("partition3", 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    )
+    new.commit()
+
+    patch_path = tmp_path / "update.patch"
+    ranges = new.diff(Disk.open(base_image), patch_path)
+    changed = [r for r in ranges if 0 < r[0] < new.geometry.alternate_array_byte]
+    # only the modified block of partition2 is stored besides the GPT metadata
+    assert changed == [
+        (part2.first_lba * 512 + 256 * 1024, part2.first_lba * 512 + 260 * 1024)
+    ]
+    assert patch_path.stat().st_size < 64 * 1024
+
+    target = tmp_path / "target.img"
+    shutil.copy(base_image, target)
+    written = delta.apply(patch_path, target)
+    assert written == sum(end - start for start, end in ranges)
+    assert target.read_bytes() == new_image.read_bytes()
+    assert Disk.open(target).table.partitions.find("partition3") is not None
+
+
+def test_diff_invalid(base_image, tmp_path):
+    other = tmp_path / "other.img"
+    disk = Disk(other)
+    disk.create(DISK_SIZE * 2)
+    with pytest.raises(delta.DeltaError):
+        disk.diff(Disk.open(base_image), tmp_path / "update.patch")
+
+    patch_path = tmp_path / "update.patch"
+    Disk.open(base_image).diff(Disk.open(base_image), patch_path)
+    with pytest.raises(delta.DeltaError):
+        delta.apply(patch_path, other)
+    with pytest.raises(delta.DeltaError):
+        delta.apply(base_image, other)
+
+
+def test_diff_outside_partitions(base_image, tmp_path):
+    new_image = tmp_path / "new.img"
+    shutil.copy(base_image, new_image)
+    # a bootloader written in the free space after the partitions
+    with open(new_image, "r+b") as f:
+        f.seek(6 * 1024 * 1024)
+        f.write(BYTE_DATA)
+    patch_path = tmp_path / "update.patch"
+    ranges = Disk.open(new_image).diff(Disk.open(base_image), patch_path)
+    assert (6 * 1024 * 1024, 6 * 1024 * 1024 + len(BYTE_DATA)) in ranges
+
+    target = tmp_path / "target.img"
+    shutil.copy(base_image, target)
+    delta.apply(patch_path, target)
+    assert target.read_bytes() == new_image.read_bytes()
+
+
+def test_apply_wrong_base(base_image, tmp_path):
+    new_image = tmp_path / "new.img"
+    shutil.copy(base_image, new_image)
+    new = Disk.open(new_image)
+    new.table.partitions.find("partition2").write_data(new, b"\xff" * 10)
+    patch_path = tmp_path / "update.patch"
+    new.diff(Disk.open(base_image), patch_path)
+
+    # the target differs from the base in a block the patch replaces
+    target = tmp_path / "target.img"
+    shutil.copy(base_image, target)
+    target_disk = Disk.open(target)
+    target_disk.table.partitions.find("partition2").write_data(target_disk, b"\xee")
+    before = target.read_bytes()
+    with pytest.raises(delta.DeltaError):
+        delta.apply(patch_path, target)
+    assert target.read_bytes() == before
@@ -2,8 +2,9 @@ import json
 
 import pytest
 
-from gpt_image.disk import Disk
-from gpt_image.partition import Partition, PartitionType
+from gpt_image import backend
+from gpt_image.disk import Disk, DiskResizeError
+from gpt_image.partition import AlignmentPolicy, Partition, PartitionType
 
 BYTE_DATA = b"\x01\x02\x03\x04"
 DISK_SIZE = 4 * 1024 * 1024  # 4 MB
@@ -76,3 +77,128 @@ def test_read_partition(new_image):
     part.write_data(disk, BYTE_DATA)
     read_data = part.read(disk)
     assert read_data[:len(BYTE_DATA)] == BYTE_DATA
+
+
+def test_commit_dirty_sectors(new_image):
+    disk = Disk.open(new_image)
+    # nothing changed, nothing is written
+    assert disk.commit() == 0
+    # renaming the first partition dirties one sector of each entry array and
+    # both headers
+    disk.table.partitions.find("partition1").partition_name = "renamed"
+    assert disk.commit() == 4 * disk.sector_size
+    assert disk.commit() == 0
+    reopened = Disk.open(new_image)
+    assert reopened.table.partitions.entries[0].partition_name == "renamed"
+    assert str(reopened) == str(disk)
+
+
+def test_create_commit_size(tmp_path):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    # create already wrote the metadata, so there is nothing left to write
+    assert disk.commit() == 0
+    disk.table.partitions.add(
+        Partition("partition1", 2 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    )
+    assert disk.commit() == 4 * disk.sector_size
+
+
+def test_resize_grow(new_image):
+    disk = Disk.open(new_image)
+    part = disk.table.partitions.find("partition2")
+    part.write_data(disk, BYTE_DATA)
+    old_backup = disk.geometry.alternate_array_byte
+    disk.resize(2 * DISK_SIZE)
+    assert new_image.stat().st_size == 2 * DISK_SIZE
+
+    reopened = Disk.open(new_image)
+    total_lba = 2 * DISK_SIZE // disk.sector_size
+    assert reopened.size == 2 * DISK_SIZE
+    assert reopened.table.primary_header.alternate_lba == total_lba - 1
+    assert reopened.table.primary_header.last_usable_lba == total_lba - 34
+    assert reopened.table.secondary_header.partition_entry_lba == total_lba - 33
+    assert reopened.table.protective_mbr.partition_size == total_lba - 1
+    assert reopened.table.primary_header.disk_guid == disk.table.primary_header.disk_guid
+    part = reopened.table.partitions.find("partition2")
+    assert part.read(reopened)[: len(BYTE_DATA)] == BYTE_DATA
+    with open(new_image, "rb") as f:
+        f.seek(old_backup)
+        assert f.read(DISK_SIZE - old_backup) == bytes(DISK_SIZE - old_backup)
+
+
+def test_resize_grow_interrupted(new_image, monkeypatch):
+    disk = Disk.open(new_image)
+    part = disk.table.partitions.find("partition2")
+    part.write_data(disk, BYTE_DATA)
+
+    # interrupt the resize right after the image has been extended
+    truncate = backend.FileBackend.truncate
+
+    def interrupt(self, size):
+        truncate(self, size)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(backend.FileBackend, "truncate", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        disk.resize(2 * DISK_SIZE)
+    assert new_image.stat().st_size == 2 * DISK_SIZE
+    monkeypatch.undo()
+
+    reopened = Disk.open(new_image)
+    assert reopened.size == 2 * DISK_SIZE
+    assert reopened.table.secondary_header.partition_entry_lba == 2 * DISK_SIZE // 512 - 33
+    part = reopened.table.partitions.find("partition2")
+    assert part.read(reopened)[: len(BYTE_DATA)] == BYTE_DATA
+
+
+def test_resize_shrink(new_image):
+    disk = Disk.open(new_image)
+    disk.resize(DISK_SIZE // 4)
+    assert new_image.stat().st_size == DISK_SIZE // 4
+    reopened = Disk.open(new_image)
+    assert reopened.size == DISK_SIZE // 4
+    assert len(reopened.table.partitions.entries) == 2
+
+    last_lba = reopened.table.partitions.entries[-1].last_lba
+    with pytest.raises(DiskResizeError):
+        reopened.resize((last_lba + 33) * reopened.sector_size)
+    with pytest.raises(DiskResizeError):
+        reopened.resize(DISK_SIZE + 1)
+    assert new_image.stat().st_size == DISK_SIZE // 4
+
+
+def test_minimize(new_image):
+    disk = Disk.open(new_image)
+    last_lba = disk.table.partitions.entries[-1].last_lba
+    size = disk.minimize()
+    assert size == (last_lba + 34) * disk.sector_size
+    assert new_image.stat().st_size == size
+    reopened = Disk.open(new_image)
+    assert reopened.table.primary_header.last_usable_lba == last_lba
+    assert reopened.minimize() == size
+
+    padded = reopened.minimize(padding=1000)
+    assert padded == size + 2 * disk.sector_size
+    assert Disk.open(new_image).size == padded
+
+
+def test_misaligned_partitions(new_image):
+    disk = Disk.open(new_image)
+    assert disk.table.partitions.misaligned() == []
+    problems = disk.table.partitions.misaligned(AlignmentPolicy.for_device())
+    assert {p.partition_name for p, _ in problems} == {"partition1", "partition2"}
+
+
+def test_disk_dict(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    disk_d = disk.to_dict()
+    assert disk_d == json.loads(str(disk))
+    disk_d["path"] = str(tmp_path / "copy.img")
+    copy = Disk.from_dict(disk_d)
+    assert copy.to_dict() == disk_d
+    with open(copy.image_path, "wb") as f:
+        f.truncate(DISK_SIZE)
+    copy.commit()
+    with open(new_image, "rb") as f, open(copy.image_path, "rb") as c:
+        assert f.read() == c.read()
@@ -0,0 +1,45 @@
+import os
+
+from gpt_image import extents
+
+
+def test_subtract():
+    assert extents.subtract([(0, 100)], [(10, 20), (50, 60)]) == [
+        (0, 10),
+        (20, 50),
+        (60, 100),
+    ]
+    assert extents.subtract([(0, 10), (20, 30)], [(5, 25)]) == [(0, 5), (25, 30)]
+    assert extents.subtract([(0, 10)], [(0, 10)]) == []
+    assert extents.subtract([(0, 10)], []) == [(0, 10)]
+
+
+def test_zero(tmp_path):
+    image = tmp_path / "test.img"
+    image.write_bytes(b"\xff" * 64 * 1024)
+    fd = os.open(image, os.O_RDWR)
+    try:
+        extents.zero(fd, 4096, 8192)
+    finally:
+        os.close(fd)
+    data = image.read_bytes()
+    assert len(data) == 64 * 1024
+    assert data[4096:8192] == bytes(4096)
+    assert data[:4096] == data[8192:12288] == b"\xff" * 4096
+
+
+def test_zero_fallback(tmp_path, monkeypatch):
+    monkeypatch.setattr(extents, "_fallocate", lambda: None)
+    monkeypatch.setattr(extents, "ZERO_CHUNK_SIZE", 1000)
+    image = tmp_path / "test.img"
+    image.write_bytes(b"\xff" * 16 * 1024)
+    fd = os.open(image, os.O_RDWR)
+    try:
+        assert not extents.punch_hole(fd, 0, 4096)
+        extents.zero(fd, 100, 5000)
+    finally:
+        os.close(fd)
+    data = image.read_bytes()
+    assert data[100:5000] == bytes(4900)
+    assert data[:100] == b"\xff" * 100
+    assert data[5000:] == b"\xff" * (16 * 1024 - 5000)
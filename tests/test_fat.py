@@ -0,0 +1,129 @@
+import struct
+
+import pytest
+
+from gpt_image import fat
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 48 * 1024 * 1024  # 48 MB
+ESP_SIZE = 40 * 1024 * 1024
+
+
+def read_tree(image: bytes) -> dict:
+    """Read the files of a FAT32 volume into a {path: bytes} dictionary"""
+
+    sector_size, per_cluster, reserved, fats = struct.unpack_from("<HBHB", image, 11)
+    fat_sectors, root = struct.unpack_from("<I4xI", image, 36)
+    cluster_size = sector_size * per_cluster
+    table = image[reserved * sector_size : (reserved + fat_sectors) * sector_size]
+    data_start = (reserved + fats * fat_sectors) * sector_size
+
+    def chain(cluster, size=None):
+        data = b""
+        while 2 <= cluster < 0x0FFFFFF8:
+            offset = data_start + (cluster - 2) * cluster_size
+            data += image[offset : offset + cluster_size]
+            cluster = struct.unpack_from("<I", table, cluster * 4)[0]
+        return data if size is None else data[:size]
+
+    tree = {}
+
+    def walk(cluster, prefix):
+        table = chain(cluster)
+        long_name = b""
+        for i in range(0, len(table), 32):
+            entry = table[i : i + 32]
+            if entry[0] == 0:
+                break
+            if entry[11] == fat.ATTR_LONG_NAME:
+                long_name = entry[1:11] + entry[14:26] + entry[28:32] + long_name
+                continue
+            name = long_name.decode("utf-16-le").split("\0")[0] if long_name else None
+            long_name = b""
+            if entry[11] & fat.ATTR_VOLUME_ID or entry[0] == ord("."):
+                continue
+            if name is None:
+                base, ext = entry[:8].decode().rstrip(), entry[8:11].decode().rstrip()
+                name = base + ("." + ext if ext else "")
+            hi, lo, size = struct.unpack_from("<H4xHI", entry, 20)
+            if entry[11] & fat.ATTR_DIRECTORY:
+                walk(hi << 16 | lo, prefix + name + "/")
+            else:
+                tree[prefix + name] = chain(hi << 16 | lo, size)
+
+    walk(root, "/")
+    return tree
+
+
+@pytest.fixture
+def esp(tmp_path):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    part = Partition("esp", ESP_SIZE, PartitionType.EFI_SYSTEM_PARTITION.value)
+    disk.table.partitions.add(part)
+    disk.commit()
+    return disk, part
+
+
+def test_format_fat32(tmp_path, esp):
+    disk, part = esp
+    source = tmp_path / "source"
+    (source / "EFI" / "BOOT").mkdir(parents=True)
+    (source / "loader" / "entries").mkdir(parents=True)
+    (source / "empty").mkdir()
+    files = {
+        "/EFI/BOOT/BOOTX64.EFI": bytes(range(256)) * 2000,
+        "/README.TXT": b"readme\n",
+        "/loader/loader.conf": b"default arch\n",
+        "/empty.txt": b"",
+        "/Große Datei mit langem Namen.conf": b"\xff" * 70000,
+    }
+    # enough entries that the directory takes more than one cluster
+    for i in range(30):
+        files[f"/loader/entries/entry {i}.conf"] = f"title {i}\n".encode()
+    for path, data in files.items():
+        (source / path[1:]).write_bytes(data)
+
+    layout = part.format_fat32(disk, str(source), label="ESP")
+    assert layout.clusters >= fat.MIN_CLUSTERS
+    image = bytes(part.read(disk))
+    assert image[510:512] == b"\x55\xaa"
+    assert image[82:90] == b"FAT32   "
+    # the backup boot sector matches
+    assert image[6 * 512 : 7 * 512] == image[:512]
+    assert read_tree(image) == files
+
+
+def test_short_names():
+    assert fat._basis_name("BOOTX64.EFI") == ("BOOTX64 EFI", False)
+    assert fat._basis_name("readme.txt") == ("README  TXT", False)
+    assert fat._basis_name("linux-signed.efi") == ("LINUX-SIEFI", True)
+    assert fat._basis_name(".config") == ("CONFIG     ", True)
+    assert fat._basis_name("a+b.tar.gz") == ("A_BTAR  GZ ", True)
+
+    class Node:
+        def __init__(self, name):
+            self.name = name
+            self.path = name
+
+    nodes = [Node(n) for n in ["LONGFI~1.TXT", "longfilename.txt", "longfile name.txt"]]
+    fat._short_names(nodes)
+    assert [n.short_name for n in nodes] == [b"LONGFI~1TXT", b"LONGFI~2TXT", b"LONGFI~3TXT"]
+    assert [n.long_name for n in nodes] == [False, True, True]
+
+
+def test_format_fat32_errors(tmp_path, esp):
+    disk, part = esp
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "big.bin").write_bytes(b"\x01" * ESP_SIZE)
+    with pytest.raises(fat.FatError, match="files do not fit"):
+        part.format_fat32(disk, str(source))
+    # nothing is written if the layout fails
+    assert part.read(disk, 512) == bytes(512)
+
+    with pytest.raises(fat.FatError, match="too small"):
+        fat.Layout(str(tmp_path), 16 * 1024 * 1024)
+    with pytest.raises(fat.FatError, match="volume label"):
+        fat.Layout(str(tmp_path), ESP_SIZE, label="lower")
@@ -0,0 +1,103 @@
+from gpt_image import backend, flash
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+PART_SIZE = 2 * 1024 * 1024
+DATA = bytes(range(256)) * 1024
+
+
+def test_flash_many(tmp_path, monkeypatch):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    for i in range(2):
+        disk.table.partitions.add(
+            Partition(f"partition{i}", PART_SIZE, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+    disk.commit()
+    disk.table.partitions.entries[1].write_data(disk, DATA)
+    # small queues and chunks, so that the reader waits on the writers
+    monkeypatch.setattr(flash, "QUEUE_DEPTH", 1)
+    targets = [tmp_path / f"target{i}.img" for i in range(4)]
+    # stale data in a target is cleared
+    targets[0].write_bytes(b"\xff" * DISK_SIZE)
+    results = flash.flash_many(disk, [str(t) for t in targets], chunk_size=16 * 1024)
+    assert [r.error for r in results] == [None] * 4
+    with open(disk.image_path, "rb") as f:
+        image = f.read()
+    for target, result in zip(targets, results):
+        assert target.read_bytes() == image
+        # only the GPT metadata and the partition data are written
+        assert result.bytes_written < DISK_SIZE // 2
+
+
+def test_flash_many_failed_target(tmp_path):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    good = tmp_path / "good.img"
+    results = disk.flash_many([str(tmp_path / "missing" / "bad.img"), str(good)])
+    assert results[0].error.startswith("unable to open target")
+    assert results[1].error is None
+    assert good.read_bytes() == disk.image_path.read_bytes()
+
+
+def test_flash_many_verify(tmp_path, monkeypatch):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    disk.table.partitions.add(
+        Partition("partition", PART_SIZE, PartitionType.LINUX_FILE_SYSTEM.value)
+    )
+    disk.commit()
+    part = disk.table.partitions.entries[0]
+    part.write_data(disk, DATA)
+    bad = part.first_lba * disk.sector_size + 1000
+    open_target = flash._open_target
+
+    def faulty_target(target, size):
+        storage = open_target(target, size)
+        if target.endswith("bad.img"):
+            pwrite = storage.pwrite
+
+            def drop_byte(data, offset):
+                if offset <= bad < offset + len(data):
+                    data = data[: bad - offset] + b"\x00" + data[bad - offset + 1 :]
+                return pwrite(data, offset)
+
+            storage.pwrite = drop_byte
+        return storage
+
+    monkeypatch.setattr(flash, "_open_target", faulty_target)
+    good, bad_target = tmp_path / "good.img", tmp_path / "bad.img"
+    results = disk.flash_many([str(good), str(bad_target)])
+    assert results[0].error is None
+    assert results[1].error.startswith("verification failed for LBA")
+    assert [m.partition for m in results[1].mismatches] == ["partition"]
+    # the target is compared with the image to find the sector
+    assert results[1].mismatches[0].first_lba == bad // disk.sector_size
+    assert results[1].mismatches[0].last_lba == bad // disk.sector_size
+
+
+def test_flash_many_backend_errors(tmp_path, monkeypatch):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    open_target = flash._open_target
+
+    def fail(*args):
+        raise backend.BackendError("device went away")
+
+    def faulty_target(target, size):
+        storage = open_target(target, size)
+        if target.endswith("write.img"):
+            storage.pwrite = fail
+        elif target.endswith("read.img"):
+            storage.pread = fail
+        return storage
+
+    monkeypatch.setattr(flash, "_open_target", faulty_target)
+    # a writer that stops draining its queue would block the reader
+    monkeypatch.setattr(flash, "QUEUE_DEPTH", 1)
+    targets = [str(tmp_path / name) for name in ("write.img", "read.img", "good.img")]
+    results = flash.flash_many(disk, targets, chunk_size=4096)
+    assert results[0].error.startswith("write failed at byte 0")
+    assert results[1].error.startswith("verification failed: device went away")
+    assert results[2].error is None
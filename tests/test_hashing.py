@@ -0,0 +1,73 @@
+import hashlib
+
+import pytest
+
+from gpt_image.backend import FileBackend
+from gpt_image.disk import Disk
+from gpt_image.hashing import HashError, MerkleTree, block_hashes
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+BYTE_DATA = b"\x01\x02\x03\x04" * 1024
+
+
+@pytest.fixture
+def new_image(tmp_path):
+    image_name = tmp_path / "test.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    part1 = Partition("partition1", 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    part2 = Partition("partition2", 2 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    disk.table.partitions.add(part1)
+    disk.table.partitions.add(part2)
+    disk.commit()
+    part1.write_data(disk, BYTE_DATA)
+    return image_name
+
+
+def test_hash_partitions(new_image):
+    disk = Disk.open(new_image)
+    digests = disk.hash_partitions(workers=2)
+    assert [d.partition_name for d in digests] == ["partition1", "partition2"]
+    for digest, part in zip(digests, disk.table.partitions.entries):
+        assert digest.digest == hashlib.sha256(part.read(disk)).hexdigest()
+        assert digest.tree is None
+    md5 = disk.hash_partitions("md5")
+    assert md5[0].digest == hashlib.md5(disk.table.partitions.entries[0].read(disk)).hexdigest()
+
+
+def test_merkle_tree(new_image):
+    disk = Disk.open(new_image)
+    before = disk.hash_partitions(merkle=True)
+    part = disk.table.partitions.find("partition2")
+    assert before[1].digest == hashlib.sha256(part.read(disk)).hexdigest()
+    tree = before[1].tree
+    # 2 MB of 4 KB blocks, 128 SHA-256 digests per hash block
+    assert [len(level) for level in tree.levels] == [512, 4, 1]
+
+    # corrupt a single block
+    part.write_data(disk, b"\xff", 300 * 4096 + 10)
+    after = disk.hash_partitions(merkle=True)
+    assert after[0].digest == before[0].digest
+    assert after[1].tree.root != tree.root
+    assert tree.diff(after[1].tree) == [300]
+
+    start = part.first_lba * disk.sector_size
+    end = (part.last_lba + 1) * disk.sector_size
+    with FileBackend(new_image, writable=False) as storage:
+        assert tree.verify_block(storage, start, end, 299)
+        assert not tree.verify_block(storage, start, end, 300)
+        assert after[1].tree.verify_block(storage, start, end, 300)
+
+
+def test_merkle_tree_shape():
+    tree = MerkleTree([b"\x00" * 32] * 3, 4096)
+    assert len(tree.levels) == 2
+    with pytest.raises(HashError):
+        tree.diff(MerkleTree([b"\x00" * 32] * 200, 4096))
+
+
+def test_block_hashes_short_read(new_image):
+    with FileBackend(new_image, writable=False) as storage:
+        with pytest.raises(HashError):
+            block_hashes(storage, DISK_SIZE - 512, DISK_SIZE + 512, 4096)
@@ -0,0 +1,72 @@
+import pytest
+
+from gpt_image import backend, instrument
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 4 * 1024 * 1024  # 4 MB
+PART_SIZE = 256 * 1024
+DATA = b"\x01" * PART_SIZE
+
+
+@pytest.fixture
+def spans():
+    recorded = []
+    instrument.add_listener(recorded.append)
+    yield recorded
+    instrument.remove_listener(recorded.append)
+
+
+def test_spans(tmp_path, spans):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    assert [s.operation for s in spans] == [
+        "partition_entry_array.commit",
+        "disk.commit",
+        "disk.create",
+    ]
+    assert spans[2].bytes_written == spans[1].bytes_written == spans[0].bytes_written > 0
+    assert spans[2].seconds >= spans[1].seconds >= spans[0].seconds
+
+    for i in range(3):
+        disk.table.partitions.add(
+            Partition(f"partition{i}", PART_SIZE, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+    disk.commit()
+    disk.table.partitions.entries[2].write_data(disk, DATA)
+    assert spans[-1].operation == "partition.write_data"
+    assert spans[-1].bytes_written == PART_SIZE
+    assert spans[-1].syscalls == 1
+
+    spans.clear()
+    disk.table.partitions.remove("partition0")
+    disk.commit()
+    operations = {s.operation: s for s in spans}
+    assert operations["partition_entry_array.commit"].partitions_moved == 2
+    assert operations["disk.commit"].partitions_moved == 2
+    assert operations["disk.commit"].bytes_read >= 2 * PART_SIZE
+    assert disk.table.partitions.entries[1].read(disk) == DATA
+    assert spans[-1].bytes_read == PART_SIZE
+
+
+def test_disabled():
+    storage = backend.MemoryBackend()
+    with instrument.span("disk.commit") as span:
+        assert span is None
+        assert instrument.wrap(storage) is storage
+
+
+def test_prometheus_exporter(tmp_path):
+    exporter = instrument.PrometheusExporter()
+    instrument.add_listener(exporter)
+    try:
+        disk = Disk(tmp_path / "test.img")
+        disk.create(DISK_SIZE)
+        disk.commit()
+    finally:
+        instrument.remove_listener(exporter)
+    text = exporter.render()
+    assert "# TYPE gpt_image_operations_total counter" in text
+    assert 'gpt_image_operations_total{operation="disk.commit"} 2' in text
+    assert 'gpt_image_operations_total{operation="disk.create"} 1' in text
+    assert 'gpt_image_operation_errors_total{operation="disk.commit"} 0' in text
@@ -0,0 +1,239 @@
+import os
+
+import pytest
+
+from gpt_image import backend, journal, move
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+PART_SIZE = 1024 * 1024  # 1 MB
+
+
+@pytest.fixture
+def image(tmp_path):
+    image_name = tmp_path / "test.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    for i in range(3):
+        part = Partition(f"partition{i}", PART_SIZE, PartitionType.LINUX_FILE_SYSTEM.value)
+        disk.table.partitions.add(part)
+    disk.commit()
+    for i, part in enumerate(disk.table.partitions.entries):
+        part.write_data(disk, bytes(range(256)) * (PART_SIZE // 256 - i) + bytes([i]) * 256 * i)
+    return image_name
+
+
+def _contents(disk):
+    return {p.partition_name: bytes(p.read(disk)) for p in disk.table.partitions.entries}
+
+
+def test_commit_moves_data(image):
+    disk = Disk.open(image)
+    before = _contents(disk)
+    disk.table.partitions.resize("partition0", PART_SIZE // 2)
+    disk.commit(workers=2, chunk_size=64 * 1024)
+    assert disk.move_stats.bytes_moved == 2 * PART_SIZE
+    assert not os.path.exists(journal.journal_path(str(image)))
+    reopened = Disk.open(image)
+    after = _contents(reopened)
+    assert after["partition0"] == before["partition0"][: PART_SIZE // 2]
+    assert after["partition1"] == before["partition1"]
+    assert after["partition2"] == before["partition2"]
+
+    # grow the first partition again, moving the others towards the end
+    reopened.table.partitions.resize("partition0", 2 * PART_SIZE)
+    reopened.commit()
+    after = _contents(Disk.open(image))
+    assert after["partition1"] == before["partition1"]
+    assert after["partition2"] == before["partition2"]
+
+
+def test_order_moves():
+    moves = [(100, 50, 10), (200, 150, 10), (300, 400, 10), (500, 600, 10), (0, 0, 10)]
+    assert journal.order_moves(moves) == [
+        (500, 600, 10),
+        (300, 400, 10),
+        (100, 50, 10),
+        (200, 150, 10),
+    ]
+
+
+def _interrupt_commit(disk, monkeypatch):
+    """Interrupt a commit after the first progress record inside a move"""
+
+    monkeypatch.setattr(journal, "CHECKPOINT_SIZE", 64 * 1024)
+    record = journal.Journal._record
+
+    def interrupt(self, index, done):
+        record(self, index, done)
+        if done:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(journal.Journal, "_record", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        disk.commit()
+    monkeypatch.setattr(journal.Journal, "_record", record)
+
+
+def test_recover_interrupted_commit(image, monkeypatch):
+    disk = Disk.open(image)
+    before = _contents(disk)
+    disk.table.partitions.remove("partition0")
+    _interrupt_commit(disk, monkeypatch)
+    assert os.path.exists(journal.journal_path(str(image)))
+
+    recovered = Disk.open(image)
+    assert not os.path.exists(journal.journal_path(str(image)))
+    assert [p.partition_name for p in recovered.table.partitions.entries] == [
+        "partition1",
+        "partition2",
+    ]
+    after = _contents(recovered)
+    assert after["partition1"] == before["partition1"]
+    assert after["partition2"] == before["partition2"]
+
+
+def test_small_shift_bounded_syncs(image, monkeypatch):
+    disk = Disk.open(image)
+    before = _contents(disk)
+    disk.table.partitions.resize("partition0", PART_SIZE + 4096)
+    syncs = []
+    fsync = os.fsync
+
+    def counting(fd):
+        syncs.append(fd)
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", counting)
+    disk.commit()
+    # a window per move rather than one per 4 KiB of distance
+    assert len(syncs) < 20
+    after = _contents(Disk.open(image))
+    assert after["partition1"] == before["partition1"]
+    assert after["partition2"] == before["partition2"]
+
+
+def test_recover_interrupted_window(image, monkeypatch):
+    disk = Disk.open(image)
+    # data that differs from itself shifted by the move distance
+    for part in disk.table.partitions.entries:
+        part.write_data(disk, os.urandom(PART_SIZE))
+    before = _contents(disk)
+    disk.table.partitions.resize("partition0", PART_SIZE + 4096)
+    copy = move.move
+
+    def interrupt(storage, src, dst, length, *args):
+        # the front of the window reaches the image first, overwriting source
+        # bytes of the rest of the window
+        copy(storage, src, dst, length // 2, *args)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(move, "move", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        disk.commit()
+    monkeypatch.setattr(move, "move", copy)
+
+    recovered = Disk.open(image)
+    assert not os.path.exists(journal.journal_path(str(image)))
+    after = _contents(recovered)
+    assert after["partition1"] == before["partition1"]
+    assert after["partition2"] == before["partition2"]
+
+
+def test_replay_drops_torn_record(image, monkeypatch):
+    disk = Disk.open(image)
+    before = _contents(disk)
+    disk.table.partitions.remove("partition0")
+    _interrupt_commit(disk, monkeypatch)
+    path = journal.journal_path(str(image))
+    loaded = journal.Journal.load(str(image))
+    # a save record interrupted while its bytes were being written
+    with open(path, "ab") as f:
+        f.write(b'{"save": [0, 65536, 0, 4096]}\n' + bytes(100))
+    reloaded = journal.Journal.load(str(image))
+    assert reloaded._progress == loaded._progress
+    assert reloaded._pending is None
+
+    recovered = Disk.open(image)
+    assert not os.path.exists(path)
+    assert _contents(recovered)["partition2"] == before["partition2"]
+
+
+def test_recover_through_backend(image, tmp_path, monkeypatch):
+    disk = Disk.open(image)
+    before = _contents(disk)
+    disk.table.partitions.remove("partition0")
+    _interrupt_commit(disk, monkeypatch)
+
+    # the journal is found next to the path of the backend, not the disk name
+    with backend.MmapBackend(str(image)) as storage:
+        recovered = Disk.open(tmp_path / "other.img", backend=storage)
+        assert not os.path.exists(journal.journal_path(str(image)))
+        assert _contents(recovered)["partition2"] == before["partition2"]
+
+
+def test_journal_directory(image, tmp_path, monkeypatch):
+    journals = tmp_path / "journals"
+    journals.mkdir()
+    disk = Disk.open(image, journal_dir=str(journals))
+    before = _contents(disk)
+    disk.table.partitions.remove("partition0")
+    _interrupt_commit(disk, monkeypatch)
+    assert not os.path.exists(journal.journal_path(str(image)))
+    assert os.path.exists(journal.journal_path(str(image), str(journals)))
+
+    recovered = Disk.open(image, journal_dir=str(journals))
+    assert os.listdir(journals) == []
+    assert _contents(recovered)["partition2"] == before["partition2"]
+
+
+def test_discard_incomplete_plan(image):
+    with open(image, "rb") as f:
+        original = f.read()
+    with open(journal.journal_path(str(image)), "w") as f:
+        f.write('{"version": 1, "size": ')
+    disk = Disk.open(image)
+    assert not os.path.exists(journal.journal_path(str(image)))
+    assert len(disk.table.partitions.entries) == 3
+    with open(image, "rb") as f:
+        assert f.read() == original
+
+
+def test_commit_frees_removed_space(image):
+    disk = Disk.open(image)
+    last = disk.table.partitions.entries[-1]
+    old_start = last.first_lba * disk.sector_size
+    disk.table.partitions.remove("partition2")
+    disk.table.partitions.resize("partition1", PART_SIZE // 2)
+    disk.commit()
+    # the removed partition and the tail of the shrunk one read back as zeros
+    freed_start = (disk.table.partitions.entries[-1].last_lba + 1) * disk.sector_size
+    with open(image, "rb") as f:
+        f.seek(freed_start)
+        assert f.read(old_start + PART_SIZE - freed_start) == bytes(
+            old_start + PART_SIZE - freed_start
+        )
+
+
+def test_wipe(image):
+    disk = Disk.open(image)
+    part = disk.table.partitions.find("partition1")
+    part.wipe(disk)
+    assert part.read(disk) == bytes(PART_SIZE)
+    assert disk.table.partitions.find("partition0").read(disk) != bytes(PART_SIZE)
+
+
+def test_compact_commit(image):
+    disk = Disk.open(image)
+    before = _contents(disk)
+    first_lba = disk.table.partitions.entries[0].first_lba
+    disk.table.partitions.remove("partition0", shift=False)
+    plan = disk.table.partitions.compact()
+    disk.commit()
+    assert disk.move_stats.bytes_moved == plan.bytes_moved == 2 * PART_SIZE
+    reopened = Disk.open(image)
+    assert reopened.table.partitions.entries[0].first_lba == first_lba
+    after = _contents(reopened)
+    assert after["partition1"] == before["partition1"]
+    assert after["partition2"] == before["partition2"]
@@ -0,0 +1,38 @@
+import pytest
+
+from gpt_image import backend, move
+
+DATA = bytes(range(256)) * 64  # 16 KB
+
+
+@pytest.fixture
+def image(tmp_path):
+    image_name = tmp_path / "test.img"
+    with open(image_name, "wb") as f:
+        f.write(bytes(4096) + DATA + bytes(4096))
+    return image_name
+
+
+@pytest.mark.parametrize("distance", [-4096, -1000, 10, 1000, 4096])
+@pytest.mark.parametrize("chunk_size", [512, 3000, 64 * 1024])
+def test_move_overlapping(image, distance, chunk_size):
+    expected = bytearray(bytes(4096) + DATA + bytes(4096))
+    expected[4096 + distance : 4096 + distance + len(DATA)] = DATA
+    with backend.FileBackend(image) as storage:
+        stats = move.move(storage, 4096, 4096 + distance, len(DATA), 4, chunk_size)
+    with open(image, "rb") as f:
+        assert f.read() == expected
+    assert stats.bytes_moved == len(DATA)
+    assert stats.chunks == -(-len(DATA) // chunk_size)
+    assert stats.throughput > 0
+
+
+def test_move_past_end(image):
+    with backend.FileBackend(image) as storage:
+        with pytest.raises(move.MoveError):
+            move.move(storage, 4096, 0, 64 * 1024, 2, 4096)
+
+
+def test_move_nothing(image):
+    with backend.FileBackend(image) as storage:
+        assert move.move(storage, 4096, 4096, len(DATA)).bytes_moved == 0
@@ -5,6 +5,7 @@ import pytest
 
 from gpt_image.geometry import Geometry
 from gpt_image.partition import (
+    AlignmentPolicy,
     Partition,
     PartitionAttribute,
     PartitionEntryArray,
@@ -266,3 +267,83 @@ def test_partition_find(geo):
     assert test_part.partition_name == PART_NAME_2
     test_part = part_array.find(PART_UUID_2)
     assert test_part == None
+
+
+def test_partition_entry_compact(geo):
+    part_array = PartitionEntryArray(geo)
+    sizes = [("a", 64), ("x", 64), ("b", 2048), ("y", 64), ("c", 64), ("d", 64)]
+    for name, size in sizes:
+        part_array.add(Partition(name, size * 1024, PartitionType.LINUX_FILE_SYSTEM.value))
+    for part in part_array.entries:
+        part._commit_attrs()
+    part_array.remove("x", shift=False)
+    part_array.remove("y", shift=False)
+    starts = {p.partition_name: p.first_lba for p in part_array.entries}
+
+    # closing both gaps in front of the pinned partition only needs b to move
+    plan = part_array.compact(pinned=["d"], dry_run=True)
+    assert [move[0].partition_name for move in plan.moves] == ["b"]
+    assert plan.bytes_moved == 2048 * 1024
+    assert {p.partition_name: p.first_lba_staged for p in part_array.entries} == starts
+
+    # without pins everything after the first gap moves towards the start
+    plan = part_array.compact(dry_run=True)
+    assert [move[0].partition_name for move in plan.moves] == ["b", "c", "d"]
+    assert plan.bytes_moved == (2048 + 64 + 64) * 1024
+
+    # on a tie the single gap is left as late as possible
+    part_array.compact(pinned=["d"])
+    a = part_array.find("a")
+    b = part_array.find("b")
+    assert b.first_lba_staged == a.last_lba_staged + 1
+    assert part_array.find("c").first_lba_staged == starts["c"]
+    assert part_array.compact(pinned=["d"], dry_run=True).moves == []
+    with pytest.raises(NameError):
+        part_array.compact(pinned=["does_not_exist"])
+
+
+def test_alignment_policy(geo):
+    policy = AlignmentPolicy(1024 * 1024, 1024 * 1024)
+    part_array = PartitionEntryArray(geo, policy)
+    part_array.add(Partition(PART_NAME, 100 * 1024, PartitionType.LINUX_FILE_SYSTEM.value))
+    part_array.add(Partition(PART_NAME_2, 3 * 1024, PartitionType.LINUX_FILE_SYSTEM.value))
+    for part in part_array.entries:
+        assert part.first_lba_staged % 2048 == 0
+        assert (part.last_lba_staged - part.first_lba_staged + 1) % 2048 == 0
+    assert part_array.misaligned() == []
+
+    part_array.resize(PART_NAME, 1024 * 1024 + 1)
+    assert part_array.find(PART_NAME_2).first_lba_staged == 3 * 2048
+    assert part_array.misaligned() == []
+
+
+def test_alignment_misaligned(part_array):
+    assert part_array.misaligned() == []
+    problems = part_array.misaligned(AlignmentPolicy(1024 * 1024, 1024 * 1024))
+    assert [p.partition_name for p, _ in problems] == [
+        PART_NAME,
+        PART_NAME,
+        PART_NAME_2,
+        PART_NAME_2,
+        PART_NAME_3,
+        PART_NAME_3,
+    ]
+    with pytest.raises(PartitionEntryError):
+        part_array.misaligned(AlignmentPolicy(1000))
+
+
+def test_alignment_for_device():
+    policy = AlignmentPolicy.for_device(erase_block_size=4 * 1024 * 1024, optimal_io_size=6 * 1024 * 1024)
+    assert policy.start == policy.size == 12 * 1024 * 1024
+    assert AlignmentPolicy.for_device().start == 1024 * 1024
+
+
+def test_partition_dict():
+    part = Partition(PART_NAME, 2 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    part.attribute_flags = PartitionAttribute.READ_ONLY
+    part.first_lba = 2048
+    part.last_lba = 2051
+    part._commit_attrs()
+    part_d = part.to_dict()
+    assert part_d["first_lba"] == 2048
+    assert Partition.from_dict(part_d).marshal() == part.marshal()
@@ -0,0 +1,59 @@
+import json
+import os
+
+import pytest
+
+from gpt_image import journal, scan
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 2 * 1024 * 1024  # 2 MB
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    images = tmp_path / "images"
+    (images / "nested").mkdir(parents=True)
+    for path in (images / "a.img", images / "nested" / "b.img"):
+        disk = Disk(path)
+        disk.create(DISK_SIZE)
+        disk.table.partitions.add(
+            Partition("partition1", 4 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+        disk.commit()
+    (images / "junk.img").write_bytes(b"not a disk image")
+    (images / "a.img.gptidx").write_bytes(b"sidecar")
+    return images
+
+
+def test_scan(image_dir, tmp_path):
+    output = tmp_path / "inventory.jsonl"
+    assert scan.main([str(image_dir), "--workers", "2", "--output", str(output)]) == 1
+    records = {
+        json.loads(line)["path"]: json.loads(line) for line in output.read_text().splitlines()
+    }
+    assert sorted(records) == sorted(
+        str(image_dir / name) for name in ("a.img", "junk.img", "nested/b.img")
+    )
+    record = records[str(image_dir / "a.img")]
+    assert record["image_size"] == DISK_SIZE
+    assert record["partitions"][0]["partition_name"] == "partition1"
+    assert "error" in records[str(image_dir / "junk.img")]
+
+
+def test_scan_pattern(image_dir, tmp_path):
+    output = tmp_path / "inventory.jsonl"
+    args = [str(image_dir), "-p", "b.*", "-o", str(output)]
+    assert scan.main(args) == 0
+    assert len(output.read_text().splitlines()) == 1
+
+
+def test_scan_pending_journal(image_dir):
+    image_path = str(image_dir / "a.img")
+    path = journal.journal_path(image_path)
+    with open(path, "wb") as f:
+        f.write(b'{"version": 2}\n')
+    assert scan.scan_image(image_path)["pending_journal"] is True
+    # the image is opened read-only, so the journal is left to be recovered
+    assert os.path.exists(path)
+    assert "pending_journal" not in scan.scan_image(str(image_dir / "nested" / "b.img"))
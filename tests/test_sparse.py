@@ -0,0 +1,108 @@
+import os
+import struct
+
+import pytest
+
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+from gpt_image.sparse import (
+    CHUNK_TYPE_DONT_CARE,
+    CHUNK_TYPE_RAW,
+    SparseImageError,
+    import_sparse,
+)
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+BYTE_DATA = b"\x01\x02\x03\x04" * 1024
+
+
+@pytest.fixture
+def new_image(tmp_path):
+    image_name = tmp_path / "test.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    part1 = Partition("partition1", 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    part2 = Partition("partition2", 2 * 1024 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+    disk.table.partitions.add(part1)
+    disk.table.partitions.add(part2)
+    disk.commit()
+    part2.write_data(disk, BYTE_DATA, 64 * 1024)
+    return image_name
+
+
+def chunk_types(sparse_path):
+    types = []
+    with open(sparse_path, "rb") as f:
+        header = f.read(28)
+        total_chunks = struct.unpack("<I", header[20:24])[0]
+        for _ in range(total_chunks):
+            chunk_type, _, _, total_size = struct.unpack("<HHII", f.read(12))
+            f.seek(total_size - 12, os.SEEK_CUR)
+            types.append(chunk_type)
+    return types
+
+
+def test_sparse_round_trip(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    sparse_path = tmp_path / "test.simg"
+    chunks = disk.export_sparse(sparse_path)
+    assert chunks == len(chunk_types(sparse_path))
+    # the sparse image only holds the metadata and the written data
+    assert os.path.getsize(sparse_path) < 64 * 1024
+
+    raw_path = tmp_path / "expanded.img"
+    expanded = Disk.import_sparse(sparse_path, raw_path)
+    assert expanded.size == DISK_SIZE
+    assert expanded.table.partitions.find("partition2") is not None
+    assert raw_path.read_bytes() == new_image.read_bytes()
+
+
+def test_sparse_skips_unused(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    sparse_path = tmp_path / "test.simg"
+    disk.export_sparse(sparse_path)
+    types = chunk_types(sparse_path)
+    assert types[0] == CHUNK_TYPE_RAW
+    assert types[-1] == CHUNK_TYPE_RAW
+    assert CHUNK_TYPE_DONT_CARE in types
+
+
+def test_sparse_partial_block(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    # a size that is a multiple of the sector size only
+    size = disk.minimize(padding=512)
+    assert size % 512 == 0 and size % 4096
+    sparse_path = tmp_path / "test.simg"
+    disk.export_sparse(sparse_path)
+    with open(sparse_path, "rb") as f:
+        header = f.read(28)
+    assert struct.unpack("<I", header[16:20])[0] == -(-size // 4096)
+
+    raw_path = tmp_path / "expanded.img"
+    expanded = Disk.import_sparse(sparse_path, raw_path)
+    assert expanded.size == size
+    assert raw_path.read_bytes() == new_image.read_bytes()
+
+
+def test_sparse_invalid(new_image, tmp_path):
+    disk = Disk.open(new_image)
+    with pytest.raises(SparseImageError):
+        disk.export_sparse(tmp_path / "test.simg", block_size=4098)
+    with pytest.raises(SparseImageError):
+        import_sparse(new_image, tmp_path / "expanded.img")
+
+
+def test_sparse_data_outside_partitions(new_image, tmp_path):
+    # a bootloader written in the free space after the partitions
+    with open(new_image, "r+b") as f:
+        f.seek(6 * 1024 * 1024)
+        f.write(BYTE_DATA)
+    disk = Disk.open(new_image)
+    raw_path = tmp_path / "expanded.img"
+    disk.export_sparse(tmp_path / "test.simg")
+    Disk.import_sparse(tmp_path / "test.simg", raw_path)
+    assert raw_path.read_bytes() == new_image.read_bytes()
+
+    disk.export_sparse(tmp_path / "parts.simg", partitions_only=True)
+    Disk.import_sparse(tmp_path / "parts.simg", raw_path)
+    assert BYTE_DATA not in raw_path.read_bytes()[6 * 1024 * 1024 :]
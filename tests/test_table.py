@@ -124,3 +124,10 @@ def test_update(new_geometry):
     assert table.secondary_header.header_crc32 != b"\x00" * 4
     assert table.primary_header.partition_entry_array_crc32 != b"\x00" * 4
     assert table.secondary_header.partition_entry_array_crc32 != b"\x00" * 4
+
+
+def test_header_dict(new_geometry: Geometry):
+    header = Header(new_geometry, guid=DISK_GUID, is_backup=True)
+    header_d = header.to_dict()
+    assert header_d == json.loads(str(header))
+    assert Header.from_dict(header_d, new_geometry).marshal() == header.marshal()
@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+from gpt_image import transfer
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+PART_SIZE = 1024 * 1024  # 1 MB
+
+
+def test_token_bucket():
+    bucket = transfer.TokenBucket(10 * PART_SIZE, burst=PART_SIZE)
+    started = time.monotonic()
+    for _ in range(3):
+        bucket.consume(PART_SIZE)
+    # the first megabyte is the burst, the next two take 0.1 seconds each
+    assert time.monotonic() - started >= 0.19
+    with pytest.raises(ValueError):
+        transfer.TokenBucket(0)
+
+
+def test_progress():
+    reports = []
+    progress = transfer.Progress(100, lambda *report: reports.append(report))
+    progress.update(40)
+    progress.update(60)
+    assert reports[0][:2] == (40, 100)
+    assert reports[-1] == (100, 100, 0.0)
+    assert transfer.start(100) is None
+
+
+def test_commit_progress(tmp_path):
+    disk = Disk(tmp_path / "test.img")
+    disk.create(DISK_SIZE)
+    for i in range(3):
+        disk.table.partitions.add(
+            Partition(f"partition{i}", PART_SIZE, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+    disk.commit()
+    reports = []
+    disk.progress = lambda *report: reports.append(report)
+    disk.bandwidth_limit = 20 * PART_SIZE
+    disk.table.partitions.entries[2].write_data(disk, b"\x01" * PART_SIZE)
+    assert reports[-1][:2] == (PART_SIZE, PART_SIZE)
+
+    reports.clear()
+    disk.table.partitions.remove("partition0")
+    disk.commit(chunk_size=64 * 1024)
+    assert reports[-1][:2] == (2 * PART_SIZE, 2 * PART_SIZE)
+    assert disk.table.partitions.entries[1].read(disk) == b"\x01" * PART_SIZE
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from gpt_image import journal, validate
+from gpt_image.disk import Disk
+from gpt_image.partition import AlignmentPolicy, Partition, PartitionType
+
+DISK_SIZE = 4 * 1024 * 1024  # 4 MB
+PART_UUID = "26be6d04-85fe-4fae-ba9c-1f47cf16f8d8"
+
+
+@pytest.fixture
+def new_image(tmp_path):
+    image_name = tmp_path / "test.img"
+    disk = Disk(image_name)
+    disk.create(DISK_SIZE)
+    for i in range(3):
+        disk.table.partitions.add(
+            Partition(f"partition{i}", 64 * 1024, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+    disk.commit()
+    return image_name
+
+
+def test_validate_valid(new_image):
+    disk = Disk.open(new_image)
+    assert disk.validate() == []
+    problems = disk.validate(AlignmentPolicy(1024 * 1024))
+    assert {p.code for p in problems} == {validate.MISALIGNED}
+
+
+def test_validate_problems(new_image):
+    disk = Disk.open(new_image)
+    part0, part1, part2 = disk.table.partitions.entries
+    # overlap the second partition with the first and third
+    part1.first_lba = part0.last_lba
+    part1.last_lba = part2.first_lba
+    part2.partition_guid = part0.partition_guid = PART_UUID
+    bad = Partition("bad", 512, PartitionType.LINUX_FILE_SYSTEM.value)
+    bad.first_lba = 2
+    bad.last_lba = 2
+    reversed_part = Partition("reversed", 512, PartitionType.LINUX_FILE_SYSTEM.value)
+    reversed_part.first_lba = 1000
+    reversed_part.last_lba = 900
+    disk.table.partitions.entries += [bad, reversed_part]
+
+    problems = disk.validate()
+    codes = sorted((p.code, tuple(p.partitions)) for p in problems)
+    assert codes == [
+        (validate.DUPLICATE_GUID, ("partition0", "partition2")),
+        (validate.INVALID_EXTENT, ("reversed",)),
+        (validate.OUT_OF_BOUNDS, ("bad",)),
+        (validate.OVERLAP, ("partition0", "partition1")),
+        (validate.OVERLAP, ("partition1", "partition2")),
+    ]
+
+
+def test_validate_nested_overlaps(new_image):
+    disk = Disk.open(new_image)
+    extents = {"a": (100, 1000), "b": (200, 300), "c": (250, 400)}
+    disk.table.partitions.entries = []
+    for name, (first_lba, last_lba) in extents.items():
+        part = Partition(name, 512, PartitionType.LINUX_FILE_SYSTEM.value)
+        part.first_lba = first_lba
+        part.last_lba = last_lba
+        disk.table.partitions.entries.append(part)
+
+    problems = disk.validate()
+    assert sorted(tuple(p.partitions) for p in problems if p.code == validate.OVERLAP) == [
+        ("a", "b"),
+        ("a", "c"),
+        ("b", "c"),
+    ]
+
+
+def test_validate_images(new_image, tmp_path):
+    missing = tmp_path / "missing.img"
+    results = validate.validate_images([new_image, missing], workers=2)
+    assert results[str(new_image)] == []
+    assert [p.code for p in results[str(missing)]] == [validate.UNREADABLE]
+
+
+def test_validate_images_pending_journal(new_image):
+    path = journal.journal_path(str(new_image))
+    with open(path, "wb") as f:
+        f.write(b'{"version": 2}\n')
+    results = validate.validate_images([new_image])
+    assert [p.code for p in results[str(new_image)]] == [validate.PENDING_JOURNAL]
+    # the image is opened read-only, so the journal is left to be recovered
+    assert os.path.exists(path)
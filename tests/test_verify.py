@@ -0,0 +1,78 @@
+import os
+
+from gpt_image import verify
+from gpt_image.backend import MemoryBackend
+from gpt_image.disk import Disk
+from gpt_image.partition import Partition, PartitionType
+
+DISK_SIZE = 8 * 1024 * 1024  # 8 MB
+PART_SIZE = 2 * 1024 * 1024
+DATA = bytes(range(256)) * 4096
+
+
+def test_write_log():
+    log = verify.WriteLog(block_size=4096)
+    log.record(0, bytes(10000))
+    assert [(s, e) for s, e, _ in log.entries()] == [(0, 4096), (4096, 8192), (8192, 10000)]
+    # without a read function, the blocks a later write overlaps are dropped
+    log.record(5000, b"\x01" * 100)
+    assert [(s, e) for s, e, _ in log.entries()] == [(0, 4096), (5000, 5100), (8192, 10000)]
+    log.discard(9000, 20000)
+    assert [(s, e) for s, e, _ in log.entries()] == [(0, 4096), (5000, 5100)]
+
+
+def test_write_log_overlap():
+    log = verify.WriteLog()
+    storage = verify.RecordingBackend(MemoryBackend(bytes(2 * 1024 * 1024)), log)
+    storage.pwrite(os.urandom(1024 * 1024), 0)
+    storage.pwrite(b"\x01" * 512, 4096)
+    storage.pwrite(b"\x02" * 100, 10000)
+    assert [(s, e) for s, e, _ in log.entries()] == [
+        (0, 4096),
+        (4096, 4608),
+        (4608, 10000),
+        (10000, 10100),
+        (10100, 1024 * 1024),
+    ]
+    assert verify.check(storage, log.entries()) == []
+    # the data kept from the first write is still checked
+    source = MemoryBackend(storage.pread(2 * 1024 * 1024, 0))
+    storage.storage.pwrite(b"\x03", 500000)
+    assert verify.check(storage, log.entries()) == [(10100, 1024 * 1024)]
+    # a source still holding the written data finds the sector
+    assert verify.check(storage, log.entries(), source) == [(499712, 500224)]
+
+
+def test_recording_backend():
+    log = verify.WriteLog(block_size=4096)
+    storage = verify.RecordingBackend(MemoryBackend(bytes(16384)), log)
+    storage.pwrite(b"\x01" * 16384, 0)
+    storage.zero(4096, 8192)
+    assert verify.check(storage, log.entries()) == []
+    storage.storage.pwrite(b"\x02", 12000)
+    assert verify.check(storage, log.entries()) == [(8192, 12288)]
+
+
+def test_verify_disk(tmp_path):
+    disk = Disk(tmp_path / "test.img")
+    disk.write_log = verify.WriteLog(block_size=64 * 1024)
+    disk.create(DISK_SIZE)
+    for i in range(2):
+        disk.table.partitions.add(
+            Partition(f"partition{i}", PART_SIZE, PartitionType.LINUX_FILE_SYSTEM.value)
+        )
+    disk.commit()
+    part = disk.table.partitions.entries[1]
+    part.write_data(disk, DATA)
+    assert disk.verify() == []
+
+    # corrupt one byte of the partition data behind the back of the disk
+    offset = part.first_lba * disk.sector_size + 100 * 1024
+    with open(disk.image_path, "r+b") as f:
+        f.seek(offset)
+        f.write(b"\xff")
+    mismatches = disk.verify()
+    assert len(mismatches) == 1
+    assert mismatches[0].partition == "partition1"
+    assert mismatches[0].first_lba <= offset // disk.sector_size <= mismatches[0].last_lba
+    assert mismatches[0].last_lba - mismatches[0].first_lba + 1 == 128